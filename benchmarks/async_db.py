@@ -0,0 +1,115 @@
+"""
+Concurrent lookup throughput with a blocking (sync) session against an async one.
+
+Every "request" resolves a short code from the DB, and every `--slow-every` one also
+runs a slow query (a sqlite function which sleeps), like a heavy search would.
+With a sync session the slow query blocks the event loop and every other
+request waits for it, with an async one the lookups keep flowing.
+
+    python -m benchmarks.async_db --requests 2000 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, event, text, insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, select
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+
+
+def _register_sleep(dbapi_connection, _):
+    dbapi_connection.create_function(
+        "sleep_ms", 1, lambda ms: time.sleep(ms / 1000) or ms
+    )
+
+
+def _prepare(path: Path, links: int):
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(name="bench", email="bench@a.nl", hashed_password=""))
+        session.commit()
+        session.exec(  # type: ignore
+            insert(Link),
+            params=[
+                {
+                    "short_code": f"c{i}",
+                    "original_url": f"https://{i}.com",
+                    "user_id": 1,
+                }
+                for i in range(links)
+            ],
+        )
+        session.commit()
+    engine.dispose()
+
+
+async def _run(handle, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await handle(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return time.perf_counter() - started
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "bench.db"
+        _prepare(path, args.links)
+
+        sync_engine = create_engine(
+            f"sqlite:///{path}",
+            pool_size=args.concurrency,
+            connect_args={"check_same_thread": False},
+        )
+        async_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{path}", pool_size=args.concurrency
+        )
+        event.listen(sync_engine, "connect", _register_sleep)
+        event.listen(async_engine.sync_engine, "connect", _register_sleep)
+        slow_query = text("SELECT sleep_ms(:ms)").bindparams(ms=args.slow_ms)
+
+        def lookup(i: int):
+            return select(Link).where(Link.short_code == f"c{i % args.links}")
+
+        async def handle_sync(i: int):
+            with Session(sync_engine) as session:
+                session.exec(lookup(i)).first()
+                if i % args.slow_every == 0:
+                    session.exec(slow_query)  # type: ignore
+
+        async def handle_async(i: int):
+            async with create_session(async_engine) as session:
+                (await session.exec(lookup(i))).first()
+                if i % args.slow_every == 0:
+                    await session.exec(slow_query)  # type: ignore
+
+        for name, handle in [
+            ("sync session", handle_sync),
+            ("async session", handle_async),
+        ]:
+            elapsed = await _run(handle, args.requests, args.concurrency)
+            print(f"{name:>14}: {args.requests / elapsed:8.1f} req/s ({elapsed:.2f} s)")
+
+        sync_engine.dispose()
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--slow-every", type=int, default=20)
+    parser.add_argument("--slow-ms", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
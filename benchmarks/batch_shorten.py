@@ -0,0 +1,84 @@
+"""
+Link creation throughput one by one against /links/shorten/batch style batches.
+
+Both go through LinkService, one commit per link against one multi-row insert
+per batch. Runs on a temporary sqlite file unless `--db-url` points to another
+database (e.g. postgresql+asyncpg://...), whose tables are created if missing.
+Redis is an in-process mock, so the results cover the DB side only.
+
+    python -m benchmarks.batch_shorten --links 5000 --batch-size 1000
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from hse_hw3_ap_url_shortener.db import create_db_and_tables, create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.model.model import LinkCreateIn
+from hse_hw3_ap_url_shortener.service.link import LinkService
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheService
+from hse_hw3_ap_url_shortener.service.short_code import ShortCodeService
+from hse_hw3_ap_url_shortener.settings.config import Config
+from tests.mock.redis import MockRedis
+
+
+async def _run(db_url: str, args):
+    config = Config(
+        db_url=db_url, redis_url="redis://localhost", secret_key="bench", algo="HS256"
+    )
+    redis = MockRedis()
+    engine = create_async_engine(db_url)
+    service = LinkService(
+        config,
+        redis,
+        LocalCacheService(config),
+        ShortCodeService(config, redis, engine),
+        engine,
+    )
+    await create_db_and_tables(engine)
+    async with create_session(engine) as session:
+        user = User(name=f"bench{time.time()}", email="", hashed_password="")
+        session.add(user)
+        await session.commit()
+
+        links_in = [
+            LinkCreateIn(original_url=f"https://{i}.com") for i in range(args.links)
+        ]
+
+        started = time.perf_counter()
+        for link_in in links_in[: args.single_links]:
+            await service.create_link(session, user, link_in.original_url)
+        single = (time.perf_counter() - started) / args.single_links
+
+        started = time.perf_counter()
+        for start in range(0, args.links, args.batch_size):
+            await service.create_links(
+                session, user, links_in[start : start + args.batch_size]
+            )
+        batch = (time.perf_counter() - started) / args.links
+
+    await engine.dispose()
+    print(f"  one by one: {1 / single:8.1f} links/s")
+    print(f"     batches: {1 / batch:8.1f} links/s ({single / batch:.1f}x)")
+
+
+async def main(args):
+    if args.db_url:
+        await _run(args.db_url, args)
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        await _run(f"sqlite+aiosqlite:///{Path(directory) / 'bench.db'}", args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=5_000)
+    parser.add_argument("--single-links", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    parser.add_argument("--db-url", default=None)
+    asyncio.run(main(parser.parse_args()))
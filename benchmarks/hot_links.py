@@ -0,0 +1,98 @@
+"""
+Simulated cache hit ratio of the populated top links: all-time visits against
+decayed Space-Saving counters.
+
+Traffic is a Zipf distribution over `--links` old links, plus new links going
+viral now and then, peaking right away and fading over `--viral-minutes`.
+Every `--populate-minutes` the cache is refilled with `--cache-size` links by
+each policy, a request is a hit if its link is in the cache at that moment.
+
+    python -m benchmarks.hot_links --hours 24 --requests-per-minute 1000
+"""
+
+import argparse
+import heapq
+import itertools
+import math
+import random
+
+from hse_hw3_ap_url_shortener.service.hot_links import SpaceSaving
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    base = [f"old{i}" for i in range(args.links)]
+    base_cum = list(
+        itertools.accumulate(1 / (rank + 1) ** args.zipf for rank in range(args.links))
+    )
+    # Years of history, so lifetime totals follow the base popularity
+    lifetime = {
+        code: args.history * (weight - previous) / base_cum[-1]
+        for code, weight, previous in zip(base, base_cum, [0.0] + base_cum)
+    }
+    tracker: SpaceSaving[str] = SpaceSaving(args.capacity)
+    half_life = args.half_life_minutes
+    virals = {}
+
+    cached = {"all-time": set(), "hot": set()}
+    hits = {name: 0 for name in cached}
+    total = 0
+    for minute in range(args.hours * 60):
+        if minute % args.populate_minutes == 0:
+            cached["all-time"] = set(
+                heapq.nlargest(args.cache_size, lifetime, key=lifetime.__getitem__)
+            )
+            # Rebase forward decay, as HotLinksService does before publishing
+            tracker.decay(0.5 ** (args.populate_minutes / half_life))
+            cached["hot"] = {code for code, _ in tracker.top(args.cache_size)}
+
+        if rng.random() < args.virals_per_hour / 60:
+            virals[f"viral{minute}"] = minute
+        weights = {
+            code: args.viral_peak * math.exp(-(minute - start) / args.viral_minutes)
+            for code, start in virals.items()
+        }
+        virals = {
+            code: virals[code] for code, weight in weights.items() if weight > 1e-4
+        }
+        viral_share = sum(weights.values()) / (1 + sum(weights.values()))
+
+        viral_requests = sum(
+            rng.random() < viral_share for _ in range(args.requests_per_minute)
+        )
+        requests = rng.choices(
+            base, cum_weights=base_cum, k=args.requests_per_minute - viral_requests
+        )
+        if viral_requests:
+            requests += rng.choices(
+                list(weights), list(weights.values()), k=viral_requests
+            )
+
+        growth = 2 ** ((minute % args.populate_minutes) / half_life)
+        for code in requests:
+            for name, codes in cached.items():
+                hits[name] += code in codes
+            lifetime[code] = lifetime.get(code, 0) + 1
+            tracker.add(code, growth)
+        total += len(requests)
+
+    for name, count in hits.items():
+        print(f"{name:>9}: {count / total:6.1%} of {total} requests hit the cache")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--requests-per-minute", type=int, default=1_000)
+    parser.add_argument("--links", type=int, default=10_000)
+    parser.add_argument("--zipf", type=float, default=0.8)
+    parser.add_argument("--history", type=int, default=10_000_000)
+    parser.add_argument("--virals-per-hour", type=float, default=2)
+    parser.add_argument("--viral-peak", type=float, default=0.3)
+    parser.add_argument("--viral-minutes", type=float, default=60)
+    parser.add_argument("--cache-size", type=int, default=10)
+    parser.add_argument("--populate-minutes", type=int, default=5)
+    parser.add_argument("--half-life-minutes", type=float, default=10)
+    parser.add_argument("--capacity", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,122 @@
+"""
+Cached link size and decode time: full Link JSON against CachedLink records.
+
+Writes `--links` links in each format to redis and reports memory per million
+links, then times decoding one value per lookup and measures the process
+memory of the decoded objects, as kept by the local cache. Without
+`--redis-url` nothing is written: memory is the sum of the encoded value
+sizes, without redis' per-key overhead, so only the comparison between the
+formats is meaningful. Results say what they were measured on.
+
+    python -m benchmarks.link_records --links 100000 --redis-url redis://localhost
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Optional
+
+from redis.asyncio import Redis
+
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.service.link_record import decode_link, encode_link
+
+CHUNK_SIZE = 10_000
+
+
+def _links(count: int, rng: random.Random):
+    now = datetime.now()
+    for i in range(count):
+        url = f"https://example{i % 1000}.com/articles/{i}"
+        # Every fifth link carries a long tracking query
+        if rng.random() < 0.2:
+            url += "?" + "&".join(
+                f"utm_{key}=campaign{rng.randrange(100)}" for key in range(20)
+            )
+        yield Link(
+            id=i,
+            short_code=f"{i:06x}",
+            original_url=url,
+            user_id=rng.randrange(10_000),
+            created_at=now,
+            expires_at=now + timedelta(days=30) if i % 2 else None,
+            visits=rng.randrange(10_000),
+            last_visit=now,
+        )
+
+
+async def _memory_per_million(redis: Optional[Redis], values: dict) -> float:
+    if redis is None:
+        used = sum(len(value.encode()) for value in values.values())
+        return used / len(values) * 1_000_000
+
+    before = (await redis.info("memory"))["used_memory"]
+    items = list(values.items())
+    for start in range(0, len(items), CHUNK_SIZE):
+        async with redis.pipeline(transaction=False) as pipe:
+            for key, value in items[start : start + CHUNK_SIZE]:
+                await pipe.setex(key, 3600, value)
+            await pipe.execute()
+    used = (await redis.info("memory"))["used_memory"] - before
+    for start in range(0, len(items), CHUNK_SIZE):
+        await redis.delete(*[key for key, _ in items[start : start + CHUNK_SIZE]])
+    return used / len(values) * 1_000_000
+
+
+def _decode_time(decode, values: dict) -> float:
+    started = time.perf_counter()
+    for key, value in values.items():
+        decode(key, value)
+    return (time.perf_counter() - started) / len(values)
+
+
+def _object_memory(decode, values: dict) -> float:
+    tracemalloc.start()
+    objects = [decode(key, value) for key, value in values.items()]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return used / len(values)
+
+
+async def main(args):
+    redis = None
+    memory_of = "of values"
+    if args.redis_url:
+        redis = Redis.from_url(args.redis_url, decode_responses=True)
+        memory_of = "in redis"
+    print(f"redis: {args.redis_url or 'none, encoded value sizes only'}")
+
+    links = list(_links(args.links, random.Random(1)))
+    formats = {
+        "json": (
+            {f"link:{link.short_code}": link.model_dump_json() for link in links},
+            lambda key, value: Link.model_validate_json(value),
+        ),
+        "record": (
+            {f"link:{link.short_code}": encode_link(link) for link in links},
+            lambda key, value: decode_link(key[5:], value),
+        ),
+    }
+    for name, (values, decode) in formats.items():
+        memory = await _memory_per_million(redis, values)
+        decode_time = _decode_time(decode, values)
+        object_memory = _object_memory(decode, values)
+        print(
+            f"{name:>6}: {memory / 2**20:7.1f} MiB {memory_of} per million links, "
+            f"{decode_time * 1e6:5.2f} us per decode, "
+            f"{object_memory:6.0f} bytes per decoded link"
+        )
+
+    if args.redis_url:
+        await redis.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=100_000)
+    parser.add_argument("--redis-url", default=None)
+    asyncio.run(main(parser.parse_args()))
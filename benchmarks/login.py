@@ -0,0 +1,89 @@
+"""
+Login throughput under contention: bcrypt inline on the event loop, as the
+login endpoint did, against PasswordService's process pool.
+
+`--logins` password checks are started at once, while a probe measures how
+late the event loop answers a 10 ms timer, i.e. how long every other request
+served by this worker waits.
+
+    python -m benchmarks.login --logins 64 --workers 4
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from passlib.context import CryptContext
+
+from hse_hw3_ap_url_shortener.service.password import PasswordService
+from hse_hw3_ap_url_shortener.settings.config import Config
+
+PROBE_INTERVAL = 0.01
+
+
+async def _probe(delays: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        delays.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def _run(name: str, verify, logins: int):
+    delays: list = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(_probe(delays, stop))
+    await asyncio.sleep(PROBE_INTERVAL)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[verify() for _ in range(logins)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    assert all(results)
+
+    delays.sort()
+    p99 = delays[min(len(delays) - 1, int(len(delays) * 0.99))]
+    print(
+        f"{name:>6}: {logins / elapsed:7.1f} logins/s, event loop delay "
+        f"median {statistics.median(delays) * 1000:7.1f} ms, p99 {p99 * 1000:7.1f} ms"
+    )
+
+
+async def main(args):
+    config = Config(
+        db_url="sqlite://",
+        redis_url="redis://localhost",
+        secret_key="bench",
+        algo="HS256",
+        bcrypt_rounds=args.rounds,
+        password_hash_workers=args.workers,
+        password_hash_max_pending=args.logins,
+    )
+    context = CryptContext(
+        schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=args.rounds
+    )
+    hashed = context.hash("password")
+
+    async def inline():
+        return context.verify("password", hashed)
+
+    service = PasswordService(config)
+
+    async def pool():
+        valid, _ = await service.verify_and_update("password", hashed)
+        return valid
+
+    # Starts the worker processes
+    await pool()
+    await _run("inline", inline, args.logins)
+    await _run("pool", pool, args.logins)
+    service.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=12)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,124 @@
+"""
+Redirect requests/s and latency: the lean redirect route against the FastAPI
+handler with full dependency resolution (LEAN_REDIRECT=false), and the lean
+route with the per IP rate limit checked (limits high enough to pass).
+
+Requests go through the whole ASGI app in process, `--concurrency` clients
+follow `--links` cached links. Runs on a temporary sqlite file with an
+in-memory redis mock, so it measures the app, not the network.
+
+    python -m benchmarks.redirect --requests 20000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from hse_hw3_ap_url_shortener.db import (
+    create_db_and_tables,
+    create_session,
+    get_engine,
+    get_redis,
+)
+from hse_hw3_ap_url_shortener.main import app, lean_redirect
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.model.model import LinkCreateIn
+from hse_hw3_ap_url_shortener.service.link import LinkService
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheService
+from hse_hw3_ap_url_shortener.service.short_code import ShortCodeService
+from hse_hw3_ap_url_shortener.settings.config import Config, RateLimit, get_config
+from tests.mock.redis import MockRedis
+
+
+async def _run(name: str, client: httpx.AsyncClient, codes: list, args):
+    latencies = []
+    rng = random.Random(1)
+
+    async def worker():
+        for _ in range(args.requests // args.concurrency):
+            started = time.perf_counter()
+            response = await client.get(f"/links/{rng.choice(codes)}")
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 307
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{name:>7}: {len(latencies) / elapsed:8.1f} requests/s, "
+        f"p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms, p99 {p99 * 1000:6.2f} ms"
+    )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        config = Config(
+            db_url=f"sqlite+aiosqlite:///{Path(directory) / 'bench.db'}",
+            redis_url="redis://localhost",
+            secret_key="bench",
+            algo="HS256",
+        )
+        engine = create_async_engine(config.db_url)
+        redis = MockRedis()
+        app.dependency_overrides[get_config] = lambda: config
+        app.dependency_overrides[get_engine] = lambda: engine
+        app.dependency_overrides[get_redis] = lambda: redis
+
+        await create_db_and_tables(engine)
+        service = LinkService(
+            config,
+            redis,
+            LocalCacheService(config),
+            ShortCodeService(config, redis, engine),
+            engine,
+        )
+        async with create_session(engine) as session:
+            user = User(name="bench", email="bench@a.nl", hashed_password="")
+            session.add(user)
+            await session.commit()
+            results = await service.create_links(
+                session,
+                user,
+                [
+                    LinkCreateIn(original_url=f"https://{i}.com")
+                    for i in range(args.links)
+                ],
+            )
+        codes = [link.short_code for link, _ in results]
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            unlimited = {"redirect": {"default": RateLimit(rate=1e9, burst=10**9)}}
+            for name, lean, limited in [
+                ("handler", False, False),
+                ("lean", True, False),
+                ("limited", True, True),
+            ]:
+                config.lean_redirect = lean
+                config.rate_limit_enabled = limited
+                config.rate_limits = unlimited
+                lean_redirect.reset()
+                # Warms up both caches
+                for code in codes:
+                    await client.get(f"/links/{code}")
+                await _run(name, client, codes, args)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--links", type=int, default=1_000)
+    asyncio.run(main(parser.parse_args()))
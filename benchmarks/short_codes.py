@@ -0,0 +1,133 @@
+"""
+Link creation throughput with random short codes against sequence based ones.
+
+The table is filled with `--links` existing links first. In random mode every
+creation looks the candidate code up before inserting it, in sequence mode the
+code comes from a block of ids taken from redis and goes straight to INSERT.
+Without `--redis-url` an in-process redis mock is used, so redis round trips
+(one script call per block of ids in sequence mode) cost nothing and the
+results compare the DB side only. Results say which redis they were
+measured on.
+
+    python -m benchmarks.short_codes --links 1000000 --creates 2000
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.service.link import LinkService
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheService
+from hse_hw3_ap_url_shortener.service.short_code import (
+    ShortCodeScrambler,
+    ShortCodeService,
+)
+from hse_hw3_ap_url_shortener.settings.config import Config
+
+CHUNK_SIZE = 50_000
+
+
+def _prepare(path: Path, links: int, scrambler):
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(name="bench", email="bench@a.nl", hashed_password=""))
+        session.commit()
+        # Existing codes come from another secret, as if made by random mode
+        for start in range(0, links, CHUNK_SIZE):
+            session.exec(  # type: ignore
+                insert(Link),
+                params=[
+                    {
+                        "short_code": scrambler.encode(i),
+                        "original_url": f"https://{i}.com",
+                        "user_id": 1,
+                    }
+                    for i in range(start, min(start + CHUNK_SIZE, links))
+                ],
+            )
+            session.commit()
+    engine.dispose()
+
+
+async def _make_redis(url):
+    if url:
+        from redis.asyncio import Redis
+
+        redis = Redis.from_url(url, decode_responses=True)
+        await redis.flushdb()
+        return redis
+    from tests.mock.redis import MockRedis
+
+    return MockRedis()
+
+
+async def main(args):
+    config = Config(
+        db_url="sqlite://",
+        redis_url=args.redis_url or "redis://localhost",
+        secret_key="bench",
+        algo="HS256",
+    )
+    print(f"redis: {args.redis_url or 'in-process mock, no round trips'}")
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "bench.db"
+        existing = ShortCodeScrambler(
+            secret=b"existing", min_length=config.short_code_length
+        )
+        started = time.perf_counter()
+        _prepare(path, args.links, existing)
+        print(f"prepared {args.links} links in {time.perf_counter() - started:.1f} s")
+
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        queries = []
+        event.listen(
+            engine.sync_engine,
+            "before_cursor_execute",
+            lambda *args: queries.append(args[2]),
+        )
+
+        for mode in ["random", "sequence"]:
+            mode_config = config.model_copy(update=dict(short_code_mode=mode))
+            redis = await _make_redis(args.redis_url)
+            service = LinkService(
+                mode_config,
+                redis,
+                LocalCacheService(mode_config),
+                ShortCodeService(mode_config, redis, engine),
+                engine,
+            )
+            queries.clear()
+
+            started = time.perf_counter()
+            async with create_session(engine) as session:
+                user = await session.get(User, 1)
+                for i in range(args.creates):
+                    await service.create_link(session, user, f"https://new{i}.com")
+            elapsed = time.perf_counter() - started
+
+            selects = sum(query.startswith("SELECT") for query in queries)
+            print(
+                f"{mode:>9}: {args.creates / elapsed:8.1f} links/s "
+                f"({elapsed:.2f} s, {selects / args.creates:.2f} SELECT per link)"
+            )
+            if args.redis_url:
+                await redis.aclose()
+
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=1_000_000)
+    parser.add_argument("--creates", type=int, default=2_000)
+    parser.add_argument("--redis-url", default=None)
+    asyncio.run(main(parser.parse_args()))
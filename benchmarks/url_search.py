@@ -0,0 +1,130 @@
+"""
+/links/search latency: comparing original_url directly against looking up
+url_hash through the (user_id, url_hash) index, and a prefix search through
+the trigram index.
+
+    python -m benchmarks.url_search --links 2000000 --queries 100
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, select
+
+from hse_hw3_ap_url_shortener.db import create_db_and_tables, create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.service.link import LinkService
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheService
+from hse_hw3_ap_url_shortener.service.url_hash import url_hash
+from hse_hw3_ap_url_shortener.settings.config import Config
+from tests.mock.redis import MockRedis
+
+CHUNK_SIZE = 50_000
+
+
+def _url(i: int) -> str:
+    return f"https://example.com/articles/{i}?utm_source=benchmark"
+
+
+def _prepare(path: Path, links: int, users: int):
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(users):
+            session.add(User(name=f"u{i}", email=f"u{i}@a.nl", hashed_password=""))
+        session.commit()
+        for start in range(0, links, CHUNK_SIZE):
+            session.exec(  # type: ignore
+                insert(Link),
+                params=[
+                    {
+                        "short_code": f"c{i}",
+                        "original_url": _url(i),
+                        "url_hash": url_hash(_url(i)),
+                        "user_id": i % users + 1,
+                    }
+                    for i in range(start, min(start + CHUNK_SIZE, links))
+                ],
+            )
+            session.commit()
+    engine.dispose()
+
+
+async def main(args):
+    config = Config(
+        db_url="sqlite://", redis_url="redis://localhost", secret_key="b", algo="HS256"
+    )
+    rng = random.Random(1)
+    targets = [rng.randrange(args.links) for _ in range(args.queries)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "bench.db"
+        started = time.perf_counter()
+        _prepare(path, args.links, args.users)
+        print(f"prepared {args.links} links in {time.perf_counter() - started:.1f} s")
+
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        service = LinkService(
+            config,
+            # Search does not touch redis
+            MockRedis(),
+            LocalCacheService(config),
+            # Nothing is created
+            None,
+            engine,
+        )
+        started = time.perf_counter()
+        await create_db_and_tables(engine)
+        print(f"indexed urls in {time.perf_counter() - started:.1f} s")
+        async with create_session(engine) as session:
+            users = {i: await session.get(User, i) for i in range(1, args.users + 1)}
+
+            async def by_url(i: int):
+                result = await session.exec(
+                    select(Link).where(
+                        Link.original_url == _url(i),
+                        Link.user_id == i % args.users + 1,
+                    )
+                )
+                return result.all()
+
+            async def by_hash(i: int):
+                links, _ = await service.search_links(
+                    session, users[i % args.users + 1], _url(i)
+                )
+                return links
+
+            async def by_prefix(i: int):
+                links, _ = await service.search_links(
+                    session,
+                    users[i % args.users + 1],
+                    _url(i).split("?")[0] + "?",
+                    "prefix",
+                )
+                return links
+
+            for name, search in [
+                ("original_url", by_url),
+                ("url_hash", by_hash),
+                ("prefix", by_prefix),
+            ]:
+                started = time.perf_counter()
+                for i in targets:
+                    assert len(await search(i)) == 1
+                elapsed = (time.perf_counter() - started) / args.queries
+                print(f"{name:>12}: {elapsed * 1000:8.2f} ms per search")
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
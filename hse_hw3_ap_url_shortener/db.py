@@ -1,36 +1,376 @@
-from typing import Annotated
+import logging
+import time
+from typing import Annotated, List, Optional
 
 from fastapi.params import Depends
-from sqlalchemy import create_engine, Engine
-from sqlmodel import Session, SQLModel
-from redis.asyncio import Redis, ConnectionPool
+from sqlalchemy import (
+    make_url,
+    URL,
+    AsyncAdaptedQueuePool,
+    Index,
+    Table,
+    event,
+    inspect,
+    text,
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Dialect
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine, AsyncEngine
+from sqlalchemy.schema import CreateIndex
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.asyncio.client import Pipeline
 
-from hse_hw3_ap_url_shortener.settings.config import ConfigDep
+from hse_hw3_ap_url_shortener.metrics import DB_QUERY_SECONDS, REDIS_COMMAND_SECONDS
+from hse_hw3_ap_url_shortener.model.model import (
+    DbPoolStatsOut,
+    RedisPoolStatsOut,
+)
+from hse_hw3_ap_url_shortener.settings.config import ConfigDep, Config
 
+logger = logging.getLogger(__name__)
 
-def get_engine(config: ConfigDep) -> Engine:
-    return create_engine(config.db_url)
+# Async drivers used for plain (sync) database urls from the config
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
 
 
-EngineDep = Annotated[Engine, Depends(get_engine)]
+def to_async_url(db_url: str) -> URL:
+    url = make_url(db_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
 
 
-def get_session(engine: EngineDep):
-    with Session(engine) as session:
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool which counts checkouts that had to wait for a free connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        if self.checkedout() < self.size() + self._max_overflow:
+            return super()._do_get()
+
+        self.waits += 1
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_seconds += time.perf_counter() - started
+
+
+# Statements are labelled by their first word, the rest are "OTHER"
+QUERY_STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    # Queries on a connection run one at a time
+    conn.info["query_started"] = time.perf_counter()
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop("query_started")
+    kind = statement.lstrip()[:6].upper()
+    DB_QUERY_SECONDS.observe(
+        time.perf_counter() - started, kind if kind in QUERY_STATEMENTS else "OTHER"
+    )
+
+
+def instrument_queries(engine: AsyncEngine) -> AsyncEngine:
+    """Records the count and latency of the queries of the engine"""
+    event.listen(engine.sync_engine, "before_cursor_execute", _query_started)
+    event.listen(engine.sync_engine, "after_cursor_execute", _query_finished)
+    return engine
+
+
+_engine: Optional[AsyncEngine] = None
+
+
+def _create_engine(config: Config) -> AsyncEngine:
+    url = to_async_url(config.db_url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory sqlite lives in a single connection, nothing to size
+        return instrument_queries(create_async_engine(url))
+    engine = create_async_engine(
+        url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout_seconds,
+        pool_recycle=config.db_pool_recycle_seconds,
+        pool_pre_ping=config.db_pool_pre_ping,
+    )
+    return instrument_queries(engine)
+
+
+def get_engine(config: ConfigDep) -> AsyncEngine:
+    global _engine
+    if not _engine:
+        _engine = _create_engine(config)
+    return _engine
+
+
+async def dispose_engine():
+    global _engine
+    if _engine:
+        await _engine.dispose()
+        _engine = None
+
+
+EngineDep = Annotated[AsyncEngine, Depends(get_engine)]
+
+
+def create_session(engine: AsyncEngine) -> AsyncSession:
+    # Objects are used after commit, and lazy refresh is not possible in async code
+    return AsyncSession(engine, expire_on_commit=False)
+
+
+async def get_session(engine: EngineDep):
+    async with create_session(engine) as session:
         yield session
 
 
-def create_db_and_tables(engine: EngineDep):
-    SQLModel.metadata.create_all(engine)
+def dialect_insert(connection: AsyncConnection, table: Table):
+    """INSERT with on_conflict_do_update / do_nothing of the connection's DB"""
+    if connection.dialect.name == "postgresql":
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
 
+def _add_missing_columns(connection):
+    # create_all skips tables which exist, so nullable columns added later are made here
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    # Another worker starting at the same time may add it first
+    if_not_exists = "IF NOT EXISTS " if connection.dialect.name == "postgresql" else ""
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            try:
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {preparer.format_table(table)} "
+                        f"ADD COLUMN {if_not_exists}"
+                        f"{preparer.format_column(column)} {column_type}"
+                    )
+                )
+            except DBAPIError:
+                # SQLite has no IF NOT EXISTS for columns, and a failed
+                # statement does not abort its transaction
+                added = inspect(connection).get_columns(table.name)
+                if column.name not in {added_column["name"] for added_column in added}:
+                    raise
 
-SessionDep = Annotated[Session, Depends(get_session)]
 
+def _missing_indexes(connection) -> List[Index]:
+    # create_all skips tables which exist, so indexes added later are made here
+    inspector = inspect(connection)
+    missing = []
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
 
-async def get_redis(config: ConfigDep) -> Redis:
-    return Redis(
-        connection_pool=ConnectionPool.from_url(config.redis_url, decode_responses=True)
+
+def _create_index_concurrently(index: Index, dialect: Dialect) -> str:
+    preparer = dialect.identifier_preparer
+    columns = ", ".join(preparer.format_column(column) for column in index.columns)
+    return (
+        f"CREATE {'UNIQUE ' if index.unique else ''}INDEX CONCURRENTLY IF NOT EXISTS "
+        f"{preparer.quote(index.name)} "
+        f"ON {preparer.format_table(index.table)} ({columns})"
     )
 
 
+async def _create_missing_indexes(engine: AsyncEngine):
+    if engine.dialect.name != "postgresql":
+        async with engine.begin() as connection:
+            for index in await connection.run_sync(_missing_indexes):
+                await connection.execute(CreateIndex(index, if_not_exists=True))
+        return
+
+    # As the url search index, built without blocking writes to the table
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        for index in await connection.run_sync(_missing_indexes):
+            try:
+                await connection.execute(
+                    text(_create_index_concurrently(index, connection.dialect))
+                )
+            except DBAPIError:
+                # E.g. another worker is building it. A failed build leaves an
+                # invalid index, which has to be dropped by hand
+                logger.warning("Could not create %s", index.name, exc_info=True)
+
+
+# Trigram index over link.original_url for substring search, a GIN index on
+# Postgres and an FTS5 table kept in sync by triggers on SQLite
+URL_SEARCH_INDEX = "ix_link_original_url_trgm"
+URL_SEARCH_TABLE = "link_url_search"
+
+_SQLITE_URL_SEARCH = [
+    f"""CREATE VIRTUAL TABLE {URL_SEARCH_TABLE} USING fts5(
+        original_url, content='link', content_rowid='id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER {URL_SEARCH_TABLE}_insert AFTER INSERT ON link BEGIN
+        INSERT INTO {URL_SEARCH_TABLE}(rowid, original_url)
+        VALUES (new.id, new.original_url);
+    END""",
+    f"""CREATE TRIGGER {URL_SEARCH_TABLE}_delete AFTER DELETE ON link BEGIN
+        INSERT INTO {URL_SEARCH_TABLE}({URL_SEARCH_TABLE}, rowid, original_url)
+        VALUES ('delete', old.id, old.original_url);
+    END""",
+    f"""CREATE TRIGGER {URL_SEARCH_TABLE}_update AFTER UPDATE OF original_url ON link
+    BEGIN
+        INSERT INTO {URL_SEARCH_TABLE}({URL_SEARCH_TABLE}, rowid, original_url)
+        VALUES ('delete', old.id, old.original_url);
+        INSERT INTO {URL_SEARCH_TABLE}(rowid, original_url)
+        VALUES (new.id, new.original_url);
+    END""",
+    f"INSERT INTO {URL_SEARCH_TABLE}({URL_SEARCH_TABLE}) VALUES ('rebuild')",
+]
+
+
+def _create_sqlite_url_search(connection):
+    if not inspect(connection).has_table(URL_SEARCH_TABLE):
+        for statement in _SQLITE_URL_SEARCH:
+            connection.execute(text(statement))
+
+
+async def _create_url_search_index(engine: AsyncEngine):
+    if engine.dialect.name == "sqlite":
+        async with engine.begin() as connection:
+            await connection.run_sync(_create_sqlite_url_search)
+    elif engine.dialect.name == "postgresql":
+        # CONCURRENTLY does not block writes to link while the index is built,
+        # and cannot run in a transaction
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(
+                isolation_level="AUTOCOMMIT"
+            )
+            try:
+                await connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                await connection.execute(
+                    text(
+                        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {URL_SEARCH_INDEX} "
+                        "ON link USING gin (original_url gin_trgm_ops)"
+                    )
+                )
+            except DBAPIError:
+                # E.g. no rights to create the extension, or another worker is
+                # building the index. Search works without it, scanning more
+                logger.warning(
+                    "Could not create %s, substring search of links scans "
+                    "each user's links",
+                    URL_SEARCH_INDEX,
+                    exc_info=True,
+                )
+
+
+async def create_db_and_tables(engine: EngineDep):
+    async with engine.begin() as connection:
+        await connection.run_sync(SQLModel.metadata.create_all)
+        await connection.run_sync(_add_missing_columns)
+    await _create_missing_indexes(engine)
+    await _create_url_search_index(engine)
+
+
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        command = "MULTI" if self.is_transaction else "PIPELINE"
+        with REDIS_COMMAND_SECONDS.time(command):
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """Redis client which records command latency, a pipeline as one command"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_SECONDS.observe(
+                time.perf_counter() - started, str(args[0]).upper()
+            )
+
+    def pipeline(
+        self, transaction: bool = True, shard_hint: Optional[str] = None
+    ) -> Pipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+_redis: Optional[Redis] = None
+
+
+def get_redis(config: ConfigDep) -> Redis:
+    global _redis
+    if not _redis:
+        pool = BlockingConnectionPool.from_url(
+            config.redis_url,
+            decode_responses=True,
+            max_connections=config.redis_max_connections,
+            timeout=config.redis_pool_timeout_seconds,
+            socket_timeout=config.redis_socket_timeout_seconds,
+            socket_connect_timeout=config.redis_socket_timeout_seconds,
+            health_check_interval=config.redis_health_check_interval_seconds,
+        )
+        _redis = InstrumentedRedis(connection_pool=pool)
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis:
+        await _redis.aclose(close_connection_pool=True)
+        _redis = None
+
+
 RedisDep = Annotated[Redis, Depends(get_redis)]
+
+
+def get_db_pool_stats(engine: AsyncEngine) -> Optional[DbPoolStatsOut]:
+    pool = engine.pool
+    if not isinstance(pool, InstrumentedQueuePool):
+        return None
+    return DbPoolStatsOut(
+        size=pool.size(),
+        max_overflow=pool._max_overflow,
+        checked_out=pool.checkedout(),
+        checked_in=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+        waits=pool.waits,
+        wait_seconds=pool.wait_seconds,
+        timeouts=pool.timeouts,
+    )
+
+
+def get_redis_pool_stats(redis: Redis) -> Optional[RedisPoolStatsOut]:
+    pool = getattr(redis, "connection_pool", None)
+    if not isinstance(pool, BlockingConnectionPool):
+        return None
+    return RedisPoolStatsOut(
+        max_connections=pool.max_connections,
+        in_use=len(pool._in_use_connections),
+        available=len(pool._available_connections),
+    )
@@ -19,21 +19,21 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 
 @auth_router.post("/auth/register", response_model=UserCreateOut, status_code=201)
-def register(
+async def register(
     user_in: UserCreateIn,
     user_service: UserServiceDep,
     auth_service: AuthServiceDep,
     session: SessionDep,
 ) -> UserCreateOut:
-    existing = user_service.find_user(email=user_in.email, session=session)
+    existing = await user_service.find_user(email=user_in.email, session=session)
     if existing:
         raise HTTPException(status_code=403, detail="User already exists")
     user = User(
         email=user_in.email,
         name=user_in.name,
-        hashed_password=auth_service.hash_password(user_in.password),
+        hashed_password=await auth_service.hash_password(user_in.password),
     )
-    user = user_service.create_user(user, session)
+    user = await user_service.create_user(user, session)
     return UserCreateOut(
         id=user.id,  # type: ignore
         name=user.name,
@@ -42,12 +42,14 @@ def register(
 
 
 @auth_router.post("/auth/login", response_model=UserLoginOut)
-def login(
+async def login(
     user_in: UserLoginIn,
     auth_service: AuthServiceDep,
     session: SessionDep,
 ) -> UserLoginOut:
-    user = auth_service.authenticate_user(user_in.email, user_in.password, session)
+    user = await auth_service.authenticate_user(
+        user_in.email, user_in.password, session
+    )
     if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
     access_token = auth_service.create_access_token(user)
@@ -55,7 +57,7 @@ def login(
 
 
 @auth_router.get("/auth/whoami", response_model=WhoamiOut)
-def whoami(current_user: CurrentUserDep) -> WhoamiOut:
+async def whoami(current_user: CurrentUserDep) -> WhoamiOut:
     return WhoamiOut(
         name=current_user.name,
         email=current_user.email,
@@ -0,0 +1,61 @@
+from typing import Optional
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from hse_hw3_ap_url_shortener.db import (
+    EngineDep,
+    RedisDep,
+    get_db_pool_stats,
+    get_redis_pool_stats,
+)
+from hse_hw3_ap_url_shortener.model.model import (
+    CleanupStatsOut,
+    LocalCacheStatsOut,
+    PoolStatsOut,
+    PopulateCacheStatsOut,
+)
+from hse_hw3_ap_url_shortener.service.cleanup import CleanupServiceDep
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheServiceDep
+from hse_hw3_ap_url_shortener.service.metrics import MetricsServiceDep
+from hse_hw3_ap_url_shortener.service.populate_cache import PopulateCacheServiceDep
+
+internal_router = APIRouter()
+
+
+@internal_router.get("/internal/pools", response_model=PoolStatsOut)
+async def pool_stats(engine: EngineDep, redis: RedisDep) -> PoolStatsOut:
+    return PoolStatsOut(
+        db=get_db_pool_stats(engine),
+        redis=get_redis_pool_stats(redis),
+    )
+
+
+@internal_router.get("/internal/cache", response_model=LocalCacheStatsOut)
+async def local_cache_stats(local_cache: LocalCacheServiceDep) -> LocalCacheStatsOut:
+    return local_cache.get_stats()
+
+
+@internal_router.get("/internal/cleanup", response_model=Optional[CleanupStatsOut])
+async def cleanup_stats(cleanup: CleanupServiceDep) -> Optional[CleanupStatsOut]:
+    """Stats of the last expired links cleanup in this process"""
+    return cleanup.last_stats
+
+
+@internal_router.get(
+    "/internal/populate-cache", response_model=Optional[PopulateCacheStatsOut]
+)
+async def populate_cache_stats(
+    populate_cache: PopulateCacheServiceDep,
+) -> Optional[PopulateCacheStatsOut]:
+    """Warmed cache size chosen by the last run and the hit ratio behind it"""
+    return await populate_cache.get_last_stats()
+
+
+@internal_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(metrics_service: MetricsServiceDep) -> PlainTextResponse:
+    """Metrics of all workers in the Prometheus text format"""
+    return PlainTextResponse(
+        await metrics_service.collect(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
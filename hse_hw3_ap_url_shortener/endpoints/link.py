@@ -1,19 +1,40 @@
 import logging
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
 from fastapi.responses import RedirectResponse
+from redis.exceptions import RedisError
 
 from hse_hw3_ap_url_shortener.db import SessionDep
 from hse_hw3_ap_url_shortener.model.model import (
+    ClickBucketSize,
+    LinkBatchCreateOut,
+    LinkClickStatsOut,
     LinkCreateIn,
     LinkCreateOut,
+    LinkSearchMode,
     LinkUpdateIn,
     LinkStatsOut,
 )
 from hse_hw3_ap_url_shortener.service.auth import CurrentUserDep
-from hse_hw3_ap_url_shortener.service.link import LinkServiceDep
+from hse_hw3_ap_url_shortener.service.clicks import (
+    ClickService,
+    ClickServiceDep,
+    bucket_count,
+    naive_local,
+)
+from hse_hw3_ap_url_shortener.service.hot_links import (
+    HotLinksService,
+    HotLinksServiceDep,
+)
+from hse_hw3_ap_url_shortener.service.link import LinkService, LinkServiceDep
+from hse_hw3_ap_url_shortener.service.link_record import CachedLink
+from hse_hw3_ap_url_shortener.service.rate_limit import (
+    RateLimitServiceDep,
+    user_rate_limit,
+)
+from hse_hw3_ap_url_shortener.settings.config import ConfigDep
 
 links_router = APIRouter()
 
@@ -21,7 +42,10 @@ logger = logging.getLogger(__name__)
 
 
 @links_router.post(
-    "/links/shorten", response_model=LinkCreateOut, status_code=status.HTTP_201_CREATED
+    "/links/shorten",
+    response_model=LinkCreateOut,
+    status_code=status.HTTP_201_CREATED,
+    dependencies=[user_rate_limit("shorten")],
 )
 async def create_short_link(
     link_in: LinkCreateIn,
@@ -49,14 +73,65 @@ async def create_short_link(
     )
 
 
+@links_router.post(
+    "/links/shorten/batch",
+    response_model=List[LinkBatchCreateOut],
+    dependencies=[user_rate_limit("shorten_batch")],
+)
+async def create_short_links(
+    links_in: List[LinkCreateIn],
+    current_user: CurrentUserDep,
+    link_service: LinkServiceDep,
+    session: SessionDep,
+    config: ConfigDep,
+):
+    if len(links_in) > config.max_shorten_batch_size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {config.max_shorten_batch_size} links per batch",
+        )
+    results = await link_service.create_links(session, current_user, links_in)
+    return [
+        LinkBatchCreateOut(
+            link=(
+                LinkCreateOut(
+                    short_code=link.short_code,
+                    original_url=link.original_url,
+                    created_at=link.created_at,
+                    expires_at=link.expires_at,
+                )
+                if link
+                else None
+            ),
+            error=error,
+        )
+        for link, error in results
+    ]
+
+
 @links_router.get("/links/search", response_model=List[LinkStatsOut])
 async def search_links_by_url(
     original_url: str,
     current_user: CurrentUserDep,
     link_service: LinkServiceDep,
     session: SessionDep,
+    config: ConfigDep,
+    response: Response,
+    mode: LinkSearchMode = "exact",
+    limit: Optional[int] = Query(default=None, ge=1),
+    cursor: Optional[int] = None,
 ):
-    links = link_service.search_by_original_url(session, current_user, original_url)
+    links, next_cursor = await link_service.search_links(
+        session,
+        current_user,
+        original_url,
+        mode,
+        min(limit or config.search_page_size, config.search_max_page_size),
+        cursor,
+    )
+    # Passed back as `cursor` for the next page, absent on the last one
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
     return [
         LinkStatsOut(
             short_code=link.short_code,
@@ -74,23 +149,47 @@ async def search_links_by_url(
 async def redirect_to_original(
     short_code: str,
     link_service: LinkServiceDep,
+    hot_links: HotLinksServiceDep,
+    clicks: ClickServiceDep,
+    rate_limits: RateLimitServiceDep,
     session: SessionDep,
+    request: Request,
 ):
+    client = rate_limits.client_address(request)
+    await rate_limits.check_client("redirect", client)
     link = await link_service.get_link_by_short_code(session, short_code)
+    return await follow_link(link, link_service, hot_links, clicks, request, client)
+
+
+async def follow_link(
+    link: Optional[CachedLink],
+    link_service: LinkService,
+    hot_links: HotLinksService,
+    clicks: ClickService,
+    request: Request,
+    client: Optional[str],
+) -> RedirectResponse:
+    """Shared by redirect_to_original and the lean redirect route"""
     if not link:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Link not found"
         )
 
+    # Deleted by ExpiryService, not on the request path
     if link.expires_at and link.expires_at < datetime.now():
-        session.delete(link)
-        session.commit()
         raise HTTPException(
             status_code=status.HTTP_410_GONE,
             detail="This link is expired",
         )
 
-    link_service.update_visit(session, link)
+    click = clicks.click_event(link.short_code, request.headers, client)
+    try:
+        await link_service.record_visit(link, click)
+    except RedisError:
+        # The link may come from the local cache, the redirect still works
+        logger.warning("Could not record a visit of %s", link.short_code)
+        clicks.buffer_click(click)
+    hot_links.record_visit(link.short_code)
     return RedirectResponse(url=link.original_url)
 
 
@@ -126,18 +225,46 @@ async def update_short_link(
     )
 
 
-@links_router.get("/links/{short_code}/stats", response_model=LinkStatsOut)
+@links_router.get("/links/{short_code}/stats", response_model=LinkClickStatsOut)
 async def get_link_statistics(
     short_code: str,
     link_service: LinkServiceDep,
+    clicks: ClickServiceDep,
     session: SessionDep,
+    config: ConfigDep,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    bucket: ClickBucketSize = "hour",
 ):
+    """With `since`, adds clicks by hour or day in [since, until) from the rollups"""
     link = await link_service.get_stats(session, short_code)
-    return LinkStatsOut(
+    stats = LinkClickStatsOut(
         short_code=link.short_code,
         original_url=link.original_url,
         created_at=link.created_at,
         visits=link.visits,
         last_visit=link.last_visit,
         expires_at=link.expires_at,
+        unique_visitors=await clicks.get_unique_visitors(
+            session, link.short_code, link.created_at
+        ),
+    )
+    if since is None:
+        return stats
+
+    since = naive_local(since)
+    until = naive_local(until) if until else datetime.now()
+    if since >= until:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="since must be before until",
+        )
+    if bucket_count(since, until, bucket) > config.clicks_max_buckets:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {config.clicks_max_buckets} buckets per request",
+        )
+    stats.clicks = await clicks.get_clicks(
+        session, link.short_code, link.created_at, since, until, bucket
     )
+    return stats
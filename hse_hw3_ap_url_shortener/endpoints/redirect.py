@@ -0,0 +1,121 @@
+from contextlib import AsyncExitStack
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fastapi import FastAPI
+from fastapi.dependencies.utils import get_dependant, solve_dependencies
+from fastapi.routing import APIRoute
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.requests import Request
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+
+from hse_hw3_ap_url_shortener.db import EngineDep, create_session
+from hse_hw3_ap_url_shortener.endpoints.link import follow_link, redirect_to_original
+from hse_hw3_ap_url_shortener.service.clicks import ClickService, ClickServiceDep
+from hse_hw3_ap_url_shortener.service.hot_links import (
+    HotLinksService,
+    HotLinksServiceDep,
+)
+from hse_hw3_ap_url_shortener.service.link import LinkService, LinkServiceDep
+from hse_hw3_ap_url_shortener.service.rate_limit import (
+    RateLimitService,
+    RateLimitServiceDep,
+)
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+
+async def _redirect_dependencies(
+    config: ConfigDep,
+    engine: EngineDep,
+    link_service: LinkServiceDep,
+    hot_links: HotLinksServiceDep,
+    clicks: ClickServiceDep,
+    rate_limits: RateLimitServiceDep,
+) -> Tuple[
+    Config, AsyncEngine, LinkService, HotLinksService, ClickService, RateLimitService
+]:
+    return config, engine, link_service, hot_links, clicks, rate_limits
+
+
+class LeanRedirect:
+    """
+    GET /links/{short_code} without dependency resolution per request: the
+    services are solved once and reused, and a DB session is opened only when
+    the link is in neither cache. Falls back to redirect_to_original when
+    lean_redirect is off.
+
+    Only dependencies which are the same for every request may be solved
+    here, i.e. the service singletons and the services built from them alone.
+    They are solved again when app.dependency_overrides changes, but not when
+    something else replaces a singleton, call reset() then
+    """
+
+    def __init__(self, fallback: APIRoute):
+        self.fallback = fallback
+        self._dependant = get_dependant(path=fallback.path, call=_redirect_dependencies)
+        self._dependencies: Optional[
+            Tuple[
+                Config,
+                AsyncEngine,
+                LinkService,
+                HotLinksService,
+                ClickService,
+                RateLimitService,
+            ]
+        ] = None
+        # The overrides the dependencies were solved with
+        self._overrides: Dict[Callable[..., Any], Callable[..., Any]] = {}
+
+    def reset(self):
+        """Solves the dependencies again on the next request, e.g. for overrides"""
+        self._dependencies = None
+
+    async def _solve(self, request: Request):
+        async with AsyncExitStack() as async_exit_stack:
+            solved = await solve_dependencies(
+                request=request,
+                dependant=self._dependant,
+                async_exit_stack=async_exit_stack,
+                embed_body_fields=False,
+                dependency_overrides_provider=request.app,
+            )
+        return await _redirect_dependencies(**solved.values)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        overrides = scope["app"].dependency_overrides
+        if self._dependencies is None or overrides != self._overrides:
+            self._overrides = dict(overrides)
+            self._dependencies = await self._solve(Request(scope, receive))
+        config, engine, link_service, hot_links, clicks, rate_limits = (
+            self._dependencies
+        )
+        if not config.lean_redirect:
+            await self.fallback.handle(scope, receive, send)
+            return
+
+        # Labels the request metrics, as matching the APIRoute would
+        scope["route"] = self.fallback
+        request = Request(scope, receive)
+        client = rate_limits.client_address(request)
+        await rate_limits.check_client("redirect", client)
+        short_code = scope["path_params"]["short_code"]
+        found, link = await link_service.get_cached_link(short_code)
+        if not found:
+            async with create_session(engine) as session:
+                link = await link_service.load_link(session, short_code)
+        response = await follow_link(
+            link, link_service, hot_links, clicks, request, client
+        )
+        await response(scope, receive, send)
+
+
+def install_lean_redirect(app: FastAPI) -> LeanRedirect:
+    """Puts the lean route in front of redirect_to_original, which stays in docs"""
+    for index, route in enumerate(app.router.routes):
+        if isinstance(route, APIRoute) and route.endpoint is redirect_to_original:
+            lean_redirect = LeanRedirect(route)
+            app.router.routes.insert(
+                index, Route(route.path, lean_redirect, methods=["GET"])
+            )
+            return lean_redirect
+    raise ValueError("redirect_to_original is not routed")
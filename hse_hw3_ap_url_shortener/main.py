@@ -5,11 +5,31 @@ from fastapi import FastAPI
 from fastapi.dependencies.utils import get_dependant, solve_dependencies
 from starlette.requests import Request
 
-from hse_hw3_ap_url_shortener.db import create_db_and_tables, EngineDep
+from hse_hw3_ap_url_shortener.db import (
+    create_db_and_tables,
+    EngineDep,
+    RedisDep,
+    dispose_engine,
+    close_redis,
+)
 from hse_hw3_ap_url_shortener.endpoints.auth import auth_router
+from hse_hw3_ap_url_shortener.endpoints.internal import internal_router
 from hse_hw3_ap_url_shortener.endpoints.link import links_router
-from hse_hw3_ap_url_shortener.service.cleanup import CleanupServiceDep
-from hse_hw3_ap_url_shortener.service.populate_cache import PopulateCacheServiceDep
+from hse_hw3_ap_url_shortener.endpoints.redirect import install_lean_redirect
+from hse_hw3_ap_url_shortener.metrics import MetricsMiddleware
+from hse_hw3_ap_url_shortener.service.cleanup import CLEANUP_ELECTION, CleanupServiceDep
+from hse_hw3_ap_url_shortener.service.clicks import ClickServiceDep
+from hse_hw3_ap_url_shortener.service.expiry import ExpiryServiceDep
+from hse_hw3_ap_url_shortener.service.flush_visits import FlushVisitsServiceDep
+from hse_hw3_ap_url_shortener.service.hot_links import HotLinksServiceDep
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheServiceDep
+from hse_hw3_ap_url_shortener.service.password import PasswordServiceDep
+from hse_hw3_ap_url_shortener.service.leader import LeaderServiceDep
+from hse_hw3_ap_url_shortener.service.metrics import MetricsServiceDep
+from hse_hw3_ap_url_shortener.service.populate_cache import (
+    POPULATE_CACHE_ELECTION,
+    PopulateCacheServiceDep,
+)
 from hse_hw3_ap_url_shortener.settings.logging import configure_logging
 
 configure_logging()
@@ -56,18 +76,46 @@ def solve_lifespan(lifespan):
 @solve_lifespan
 async def lifespan(
     engine: EngineDep,
+    redis: RedisDep,
     cleanup_service: CleanupServiceDep,
     populate_cache_service: PopulateCacheServiceDep,
+    flush_visits_service: FlushVisitsServiceDep,
+    local_cache_service: LocalCacheServiceDep,
+    expiry_service: ExpiryServiceDep,
+    hot_links_service: HotLinksServiceDep,
+    password_service: PasswordServiceDep,
+    click_service: ClickServiceDep,
+    leader_service: LeaderServiceDep,
+    metrics_service: MetricsServiceDep,
 ):
-    create_db_and_tables(engine)
+    await create_db_and_tables(engine)
+    local_cache_service.start_listener(redis)
+    expiry_service.start_reaper()
+    await leader_service.start_elections(CLEANUP_ELECTION, POPULATE_CACHE_ELECTION)
     cleanup_service.start_scheduler()
     populate_cache_service.start_scheduler()
+    flush_visits_service.start_scheduler()
+    hot_links_service.start_scheduler()
+    click_service.start_consumer()
+    metrics_service.start_flusher()
     yield
+    await flush_visits_service.shutdown()
+    await local_cache_service.stop_listener()
+    await expiry_service.stop_reaper()
+    await click_service.stop_consumer()
+    await leader_service.stop_elections()
+    await metrics_service.stop_flusher()
+    password_service.shutdown()
+    await dispose_engine()
+    await close_redis()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 app.include_router(auth_router)
 app.include_router(links_router)
+app.include_router(internal_router)
+lean_redirect = install_lean_redirect(app)
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,309 @@
+import json
+import math
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Upper bounds in seconds, from a local cache hit to a slow query
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+Labels = Tuple[str, ...]
+# Bucket index, "sum", or None for a counter
+SampleKey = Optional[int | str]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Metric(ABC):
+    """
+    Values only ever grow, so each worker keeps what it has added since the
+    last take() and the totals of all workers are sums of those deltas
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple[Labels, SampleKey], float] = defaultdict(float)
+
+    def take(self) -> Dict[Tuple[Labels, SampleKey], float]:
+        values, self._values = self._values, defaultdict(float)
+        return values
+
+    def add(self, labels: Labels, key: SampleKey, value: float):
+        self._values[(labels, key)] += value
+
+    def _series(self, labels: Labels, suffix: str = "", **extra: str) -> str:
+        pairs = list(zip(self.labels, labels)) + list(extra.items())
+        if not pairs:
+            return f"{self.name}{suffix}"
+        rendered = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+        return f"{self.name}{suffix}{{{rendered}}}"
+
+    @abstractmethod
+    def render(self, totals: Dict[Tuple[Labels, SampleKey], float]) -> List[str]:
+        pass
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, value: float = 1):
+        self._values[(labels, None)] += value
+
+    def render(self, totals: Dict[Tuple[Labels, SampleKey], float]) -> List[str]:
+        return [
+            f"{self._series(labels)} {_format_value(value)}"
+            for (labels, _), value in sorted(totals.items())
+        ]
+
+
+class Histogram(Metric):
+    """
+    Counts per bucket, not cumulative, so that an observation is one increment.
+    Samples are stored by bucket index, so changing the buckets of a metric
+    needs a new name
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Labels = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, seconds: float, *labels: str):
+        self._values[(labels, bisect_left(self.buckets, seconds))] += 1
+        self._values[(labels, "sum")] += seconds
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self, totals: Dict[Tuple[Labels, SampleKey], float]) -> List[str]:
+        by_labels: Dict[Labels, Dict[SampleKey, float]] = defaultdict(dict)
+        for (labels, key), value in totals.items():
+            by_labels[labels][key] = value
+
+        lines = []
+        for labels, values in sorted(by_labels.items()):
+            count = 0.0
+            for index, bound in enumerate(self.buckets + (math.inf,)):
+                count += values.get(index, 0)
+                le = _format_value(float(bound))
+                lines.append(
+                    f"{self._series(labels, '_bucket', le=le)} {_format_value(count)}"
+                )
+            lines.append(
+                f"{self._series(labels, '_sum')} {_format_value(values.get('sum', 0))}"
+            )
+            lines.append(f"{self._series(labels, '_count')} {_format_value(count)}")
+        return lines
+
+
+class Registry:
+    """Metrics of this process, in the Prometheus text format when rendered"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def take(self) -> Dict[str, float]:
+        """Takes what was added since the previous call, by encoded sample"""
+        return {
+            json.dumps([name, labels, key]): value
+            for name, metric in self.metrics.items()
+            for (labels, key), value in metric.take().items()
+        }
+
+    def _decode(self, samples: Dict[str, Any]):
+        for field, value in samples.items():
+            name, labels, key = json.loads(field)
+            # Left by an older version which had other metrics
+            if name in self.metrics:
+                yield self.metrics[name], (tuple(labels), key), float(value)
+
+    def restore(self, samples: Dict[str, float]):
+        """Puts back what take() returned, e.g. when it could not be stored"""
+        for metric, (labels, key), value in self._decode(samples):
+            metric.add(labels, key, value)
+
+    def totals(
+        self, metric: Metric, samples: Dict[str, Any]
+    ) -> Dict[Tuple[Labels, SampleKey], float]:
+        """Picks the values of one metric out of samples in the encoding of take()"""
+        return {
+            sample: value
+            for found, sample, value in self._decode(samples)
+            if found is metric
+        }
+
+    def render(self, samples: Dict[str, Any]) -> str:
+        """Renders totals in the encoding of take(), e.g. summed across workers"""
+        totals: Dict[str, Dict[Tuple[Labels, SampleKey], float]] = defaultdict(dict)
+        for metric, sample, value in self._decode(samples):
+            totals[metric.name][sample] = value
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.render(totals[name]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(
+    Counter(
+        "http_requests_total",
+        "HTTP requests by route template and status",
+        ("method", "route", "status"),
+    )
+)
+HTTP_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "HTTP request latency by route template",
+        ("method", "route"),
+    )
+)
+LINK_LOOKUPS = REGISTRY.register(
+    Counter(
+        "link_lookups_total",
+        "Short code lookups by where they were answered: local, redis, db "
+        "or not_found (from any of them)",
+        ("result",),
+    )
+)
+LINK_CACHE_LOOKUPS = REGISTRY.register(
+    Counter(
+        "link_cache_lookups_total",
+        "Short code lookups answered by the local cache or redis (hit) "
+        "or left for the DB (miss)",
+        ("result",),
+    )
+)
+DB_QUERY_SECONDS = REGISTRY.register(
+    Histogram(
+        "db_query_duration_seconds",
+        "DB query latency by statement",
+        ("statement",),
+    )
+)
+REDIS_COMMAND_SECONDS = REGISTRY.register(
+    Histogram(
+        "redis_command_duration_seconds",
+        "Redis command latency, pipelines as PIPELINE or MULTI",
+        ("command",),
+    )
+)
+VISIT_FLUSH_SECONDS = REGISTRY.register(
+    Histogram(
+        "visit_flush_commit_duration_seconds",
+        "Latency of a transaction writing a batch of buffered visits",
+    )
+)
+JOB_SECONDS = REGISTRY.register(
+    Histogram(
+        "job_duration_seconds",
+        "Scheduled job run time",
+        ("job",),
+        JOB_BUCKETS,
+    )
+)
+JOB_FAILURES = REGISTRY.register(
+    Counter("job_failures_total", "Scheduled job runs which failed", ("job",))
+)
+
+
+def timed_job(
+    name: str, job: Callable[[], Awaitable[Any]]
+) -> Callable[[], Awaitable[Any]]:
+    """Wraps a scheduled job to record its run time and failures"""
+
+    async def run():
+        with JOB_SECONDS.time(name):
+            try:
+                return await job()
+            except Exception:
+                JOB_FAILURES.inc(name)
+                raise
+
+    return run
+
+
+class MetricsMiddleware:
+    """
+    Counts requests and their latency by route template, so that short codes
+    do not become labels. Plain ASGI, it adds two dict updates per request
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_status(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # The router puts the matched route into the scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method, route, str(status_code))
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method, route)
@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import Optional
 
+from sqlalchemy import BigInteger, Index
 from sqlmodel import SQLModel, Field
 
 
@@ -9,14 +10,66 @@ class User(SQLModel, table=True):
     name: str = Field(index=True, unique=True)
     email: str = Field(index=True, unique=True)
     hashed_password: str = Field()
+    # Rate limits tier, see Config.rate_limits, None for "default"
+    tier: Optional[str] = None
 
 
 class Link(SQLModel, table=True):
+    __table_args__ = (Index("ix_link_user_id_url_hash", "user_id", "url_hash"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     short_code: str = Field(index=True, unique=True)
     original_url: str
     user_id: int = Field(foreign_key="user.id")
     created_at: datetime = Field(default_factory=lambda: datetime.now())
-    expires_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = Field(default=None, index=True)
     visits: int = Field(default=0)
     last_visit: Optional[datetime] = None
+    # Hash of the normalised original_url for search, see service/url_hash.py
+    url_hash: Optional[int] = Field(default=None, sa_type=BigInteger)
+
+
+class ShortCodeSequence(SQLModel, table=True):
+    """Highest id taken from a redis sequence, restores it if redis loses it"""
+
+    __tablename__ = "short_code_sequence"
+
+    name: str = Field(primary_key=True)
+    value: int = Field(sa_type=BigInteger)
+
+
+class LinkClicksBase(SQLModel):
+    """Clicks of a link in a time bucket, by referrer host and user agent class"""
+
+    short_code: str = Field(primary_key=True)
+    bucket: datetime = Field(primary_key=True)
+    referrer: str = Field(primary_key=True, max_length=255)
+    agent: str = Field(primary_key=True, max_length=16)
+    clicks: int = Field(default=0)
+
+
+class LinkClicksHourly(LinkClicksBase, table=True):
+    __tablename__ = "link_clicks_hourly"
+
+
+class LinkClicksDaily(LinkClicksBase, table=True):
+    __tablename__ = "link_clicks_daily"
+
+
+class LinkVisitors(SQLModel, table=True):
+    """HyperLogLog sketch of a link's visitors, see service/hyperloglog.py"""
+
+    __tablename__ = "link_visitors"
+
+    short_code: str = Field(primary_key=True)
+    # Day of the first ingested visit, older than the link for a reused alias
+    first_seen: datetime
+    sketch: bytes
+
+
+class LinkVisitorsDaily(SQLModel, table=True):
+    __tablename__ = "link_visitors_daily"
+
+    short_code: str = Field(primary_key=True)
+    bucket: datetime = Field(primary_key=True)
+    sketch: bytes
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, Annotated
+from typing import Dict, List, Optional, Annotated, Literal
 
 from pydantic import BaseModel, Field, HttpUrl, EmailStr
 
@@ -48,10 +48,20 @@ class LinkCreateOut(BaseModel):
     expires_at: Optional[datetime]
 
 
+class LinkBatchCreateOut(BaseModel):
+    link: Optional[LinkCreateOut] = None
+    error: Optional[str] = None
+
+
 class LinkUpdateIn(BaseModel):
     original_url: Annotated[str, HttpUrl]
 
 
+# exact: the same normalised URL, prefix: URLs starting with the query,
+# domain: URLs on the host or its subdomains, contains: URLs with the substring
+LinkSearchMode = Literal["exact", "prefix", "domain", "contains"]
+
+
 class LinkStatsOut(BaseModel):
     short_code: str
     original_url: Annotated[str, HttpUrl]
@@ -59,3 +69,72 @@ class LinkStatsOut(BaseModel):
     visits: int
     last_visit: Optional[datetime]
     expires_at: Optional[datetime]
+
+
+ClickBucketSize = Literal["hour", "day"]
+
+
+class ClickBucketOut(BaseModel):
+    start: datetime
+    clicks: int
+    # Referrer host ("" for direct clicks) and user agent class to clicks
+    referrers: Dict[str, int]
+    agents: Dict[str, int]
+    # Approximate, for day buckets only
+    unique_visitors: Optional[int] = None
+
+
+class LinkClickStatsOut(LinkStatsOut):
+    # Approximate, see service/hyperloglog.py
+    unique_visitors: int = 0
+    # Only buckets with clicks, when a range is requested
+    clicks: Optional[List[ClickBucketOut]] = None
+
+
+class DbPoolStatsOut(BaseModel):
+    size: int
+    max_overflow: int
+    checked_out: int
+    checked_in: int
+    overflow: int
+    waits: int
+    wait_seconds: float
+    timeouts: int
+
+
+class RedisPoolStatsOut(BaseModel):
+    max_connections: int
+    in_use: int
+    available: int
+
+
+class PoolStatsOut(BaseModel):
+    db: Optional[DbPoolStatsOut]
+    redis: Optional[RedisPoolStatsOut]
+
+
+class LocalCacheStatsOut(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+class CleanupStatsOut(BaseModel):
+    started_at: datetime
+    deleted: int
+    chunks: int
+    duration_seconds: float
+    finished: bool
+
+
+class PopulateCacheStatsOut(BaseModel):
+    updated_at: datetime
+    # Hit ratio of link lookups measured while previous_size links were warmed
+    previous_size: int
+    hit_ratio: Optional[float]
+    lookups: int
+    # Average size of a warmed link, size is capped by the memory budget
+    entry_bytes: Optional[float]
+    size: int
@@ -1,3 +1,4 @@
+import time
 from datetime import timedelta, datetime, timezone
 from typing import Annotated
 
@@ -5,24 +6,23 @@ import jwt
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jwt import InvalidTokenError
-from passlib.context import CryptContext
+from sqlalchemy.orm import make_transient_to_detached
 from starlette import status
 
 from hse_hw3_ap_url_shortener.db import SessionDep
 from hse_hw3_ap_url_shortener.model.dbmodel import User
 from hse_hw3_ap_url_shortener.model.model import TokenData
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheServiceDep
+from hse_hw3_ap_url_shortener.service.password import (
+    PasswordService,
+    PasswordServiceDep,
+)
 from hse_hw3_ap_url_shortener.service.user import UserService, UserServiceDep
 from hse_hw3_ap_url_shortener.settings.config import ConfigDep, Config
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
 def _create_access_token(
     data: dict, secret_key: str, algo: str, expires_delta: timedelta | None = None
 ) -> str:
@@ -37,16 +37,29 @@ def _create_access_token(
 
 
 class AuthService:
-    def __init__(self, config: Config, user_service: UserService):
+    def __init__(
+        self,
+        config: Config,
+        user_service: UserService,
+        password_service: PasswordService,
+    ):
         self.config = config
         self.user_service = user_service
+        self.password_service = password_service
 
-    def authenticate_user(self, email: str, password: str, session: SessionDep):
-        user = self.user_service.find_user(email, session)
+    async def authenticate_user(self, email: str, password: str, session: SessionDep):
+        user = await self.user_service.find_user(email, session)
         if not user:
             return False
-        if not verify_password(password, user.hashed_password):
+        valid, new_hash = await self.password_service.verify_and_update(
+            password, user.hashed_password
+        )
+        if not valid:
             return False
+        # Hashed with another bcrypt cost factor, only now we know the password
+        if new_hash:
+            user.hashed_password = new_hash
+            user = await self.user_service.update_user(user, session)
         return user
 
     def create_access_token(self, user: User) -> str:
@@ -57,27 +70,36 @@ class AuthService:
             expires_delta=timedelta(minutes=self.config.access_token_expire_minutes),
         )
 
-    def hash_password(self, password: str) -> str:
-        return pwd_context.hash(password)
+    async def hash_password(self, password: str) -> str:
+        return await self.password_service.hash(password)
 
 
 _service = None
 
 
-def get_service(config: ConfigDep, user_service: UserServiceDep) -> AuthService:
+def get_service(
+    config: ConfigDep,
+    user_service: UserServiceDep,
+    password_service: PasswordServiceDep,
+) -> AuthService:
     global _service
     if not _service:
-        _service = AuthService(config=config, user_service=user_service)
+        _service = AuthService(
+            config=config,
+            user_service=user_service,
+            password_service=password_service,
+        )
     return _service
 
 
 AuthServiceDep = Annotated[AuthService, Depends(get_service)]
 
 
-def get_current_user(
+async def get_current_user(
     token: Annotated[str, Depends(oauth2_scheme)],
     config: ConfigDep,
     service: UserServiceDep,
+    local_cache: LocalCacheServiceDep,
     session: SessionDep,
 ):
     credentials_exception = HTTPException(
@@ -85,18 +107,37 @@ def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, config.secret_key, algorithms=[config.algo])
-        email = payload.get("sub")
-        if email is None:
+    # Tokens seen before skip the signature check, until they expire
+    found, email = local_cache.tokens.get(token)
+    if not found:
+        try:
+            payload = jwt.decode(token, config.secret_key, algorithms=[config.algo])
+            email = payload.get("sub")
+            if email is None:
+                raise credentials_exception
+            token_data = TokenData(email=email)
+        except InvalidTokenError:
+            raise credentials_exception
+        email = token_data.email
+        ttl = config.principal_cache_ttl_seconds
+        if "exp" in payload:
+            ttl = min(ttl, payload["exp"] - time.time())
+        local_cache.tokens.set(token, email, ttl)
+
+    found, fields = local_cache.principals.get(email)
+    if not found:
+        user = await service.find_user(email, session)
+        if user is None:
             raise credentials_exception
-        token_data = TokenData(email=email)
-    except InvalidTokenError:
-        raise credentials_exception
-    user = service.find_user(token_data.email, session)
-    if user is None:
-        raise credentials_exception
-    return user
+        local_cache.principals.set(email, user.model_dump(exclude={"hashed_password"}))
+        return user
+
+    # An instance outlives neither a rollback nor the session which loaded it,
+    # so each request gets its own, attached without a query. hashed_password
+    # is left unloaded, only logins need it
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return await session.merge(user, load=False)
 
 
 CurrentUserDep = Annotated[User, Depends(get_current_user)]
@@ -1,40 +1,94 @@
 import logging
+import time
 from datetime import datetime
-from typing import Annotated
+from typing import Annotated, List, Optional
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import Depends
-from sqlalchemy import Engine
-from sqlmodel import select, Session
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine
 
 from hse_hw3_ap_url_shortener.db import EngineDep
+from hse_hw3_ap_url_shortener.metrics import timed_job
 from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.model.model import CleanupStatsOut
+from hse_hw3_ap_url_shortener.service.leader import LeaderService, LeaderServiceDep
 from hse_hw3_ap_url_shortener.service.link import LinkService, LinkServiceDep
 from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
 
 logger = logging.getLogger(__name__)
 
+_link_table = Link.__table__  # type: ignore
+
+# Runs on one worker, see LeaderService
+CLEANUP_ELECTION = "cleanup"
+
 
 class CleanupService:
-    def __init__(self, config: Config, engine: Engine, link_service: LinkService):
+    def __init__(
+        self,
+        config: Config,
+        engine: AsyncEngine,
+        link_service: LinkService,
+        leader: LeaderService,
+    ):
         self.scheduler = AsyncIOScheduler()
         self.config = config
         self.engine = engine
         self.link_service = link_service
+        self.leader = leader
+        self.last_stats: Optional[CleanupStatsOut] = None
+
+    async def _delete_chunk(self, now: datetime) -> List[str]:
+        expired_ids = (
+            select(_link_table.c.id)
+            .where(_link_table.c.expires_at < now)
+            .limit(self.config.cleanup_batch_size)
+        )
+        async with self.engine.begin() as connection:
+            result = await connection.execute(
+                delete(_link_table)
+                .where(_link_table.c.id.in_(expired_ids.scalar_subquery()))
+                .returning(_link_table.c.short_code)
+            )
+            return list(result.scalars())
+
+    async def delete_expired_links(self) -> CleanupStatsOut:
+        """
+        Deletes expired links in chunks of cleanup_batch_size, each chunk in its
+        own transaction. Stops after cleanup_time_budget_seconds, the rest is
+        left for the next run. Deleting expired links is idempotent, so a
+        leader losing its lease midway needs no fencing
+        """
+        started_at = datetime.now()
+        started = time.monotonic()
+        deleted = chunks = 0
+        finished = False
+        while time.monotonic() - started < self.config.cleanup_time_budget_seconds:
+            short_codes = await self._delete_chunk(started_at)
+            if short_codes:
+                chunks += 1
+                deleted += len(short_codes)
+                await self.link_service.invalidate_cached(short_codes)
+            if len(short_codes) < self.config.cleanup_batch_size:
+                finished = True
+                break
 
-    async def delete_expired_links(self):
-        with Session(self.engine) as session:
-            expired_links = session.exec(
-                select(Link).where(Link.expires_at < datetime.now())
-            ).all()
-            logging.info("Expiring links: %s", expired_links)
-            if len(expired_links) > 0:
-                await self.link_service.batch_delete(expired_links, session)
-                session.commit()
+        self.last_stats = CleanupStatsOut(
+            started_at=started_at,
+            deleted=deleted,
+            chunks=chunks,
+            duration_seconds=time.monotonic() - started,
+            finished=finished,
+        )
+        logger.info("Expired links cleanup: %s", self.last_stats)
+        return self.last_stats
 
     def start_scheduler(self):
         self.scheduler.add_job(
-            self.delete_expired_links,
+            self.leader.leader_only(
+                CLEANUP_ELECTION, timed_job(CLEANUP_ELECTION, self.delete_expired_links)
+            ),
             "interval",
             minutes=self.config.cleanup_interval_minutes,
             next_run_time=datetime.now(),
@@ -46,12 +100,15 @@ _service = None
 
 
 def get_service(
-    config: ConfigDep, engine: EngineDep, link_service: LinkServiceDep
+    config: ConfigDep,
+    engine: EngineDep,
+    link_service: LinkServiceDep,
+    leader: LeaderServiceDep,
 ) -> CleanupService:
     global _service
     if not _service:
         _service = CleanupService(
-            config=config, engine=engine, link_service=link_service
+            config=config, engine=engine, link_service=link_service, leader=leader
         )
     return _service
 
@@ -0,0 +1,484 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import (
+    Annotated,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+from urllib.parse import urlsplit
+
+from fastapi import Depends
+from redis.asyncio import Redis
+from redis.exceptions import RedisError, ResponseError
+from sqlalchemy import Row, Table, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from hse_hw3_ap_url_shortener.db import EngineDep, RedisDep, dialect_insert
+from hse_hw3_ap_url_shortener.model.dbmodel import (
+    LinkClicksDaily,
+    LinkClicksHourly,
+    LinkVisitors,
+    LinkVisitorsDaily,
+)
+from hse_hw3_ap_url_shortener.model.model import ClickBucketOut, ClickBucketSize
+from hse_hw3_ap_url_shortener.service.hyperloglog import HyperLogLog
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+# Stream of click events: c - short code, r - referrer host, a - user agent
+# class, v - visitor fingerprint (hex of a 64-bit keyed hash), t - click time
+# in ms if it differs from the entry id (buffered clicks)
+CLICKS_STREAM = "links:clicks"
+# Consumer group of the workers writing the events into the rollup tables
+CLICKS_GROUP = "rollups"
+
+_hourly_table: Table = LinkClicksHourly.__table__  # type: ignore
+_daily_table: Table = LinkClicksDaily.__table__  # type: ignore
+_rollup_tables: Dict[ClickBucketSize, Table] = {
+    "hour": _hourly_table,
+    "day": _daily_table,
+}
+_visitors_table: Table = LinkVisitors.__table__  # type: ignore
+_daily_visitors_table: Table = LinkVisitorsDaily.__table__  # type: ignore
+
+_BOT = re.compile(r"bot|crawl|spider|slurp|preview|curl|wget|python", re.I)
+_MOBILE = re.compile(r"mobile|android|iphone|ipad|ipod|windows phone", re.I)
+
+
+def referrer_host(referrer: Optional[str]) -> str:
+    """Host of the Referer header, "" for direct clicks"""
+    if not referrer:
+        return ""
+    try:
+        host = urlsplit(referrer).hostname or ""
+    except ValueError:
+        return ""
+    return host[:255]
+
+
+def agent_class(user_agent: Optional[str]) -> str:
+    if not user_agent:
+        return "other"
+    if _BOT.search(user_agent):
+        return "bot"
+    if _MOBILE.search(user_agent):
+        return "mobile"
+    if user_agent.startswith("Mozilla/"):
+        return "desktop"
+    return "other"
+
+
+async def append_click(redis: Redis, config: Config, event: Dict[str, str]):
+    """Also queues the XADD when given a pipeline"""
+    await redis.xadd(
+        CLICKS_STREAM,
+        event,  # type: ignore
+        maxlen=config.clicks_stream_max_length,
+        approximate=True,
+    )
+
+
+def naive_local(moment: datetime) -> datetime:
+    """Buckets, like all stored timestamps, are in naive local time"""
+    if moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def bucket_start(moment: datetime, bucket: ClickBucketSize) -> datetime:
+    if bucket == "day":
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def bucket_count(since: datetime, until: datetime, bucket: ClickBucketSize) -> int:
+    step = timedelta(days=1) if bucket == "day" else timedelta(hours=1)
+    return -(-(until - bucket_start(since, bucket)) // step)
+
+
+def _event_time(entry_id: str, event: Dict[str, str]) -> datetime:
+    return datetime.fromtimestamp(int(event.get("t") or entry_id.split("-")[0]) / 1000)
+
+
+def _rollup_rows(entries: List[Tuple[str, Dict[str, str]]]) -> Dict[Table, List]:
+    counts: Dict[Table, Counter] = {
+        table: Counter() for table in _rollup_tables.values()
+    }
+    for entry_id, event in entries:
+        if not event:
+            # Trimmed from the stream before it was acknowledged
+            continue
+        moment = _event_time(entry_id, event)
+        for bucket, table in _rollup_tables.items():
+            key = (event["c"], bucket_start(moment, bucket), event["r"], event["a"])
+            counts[table][key] += 1
+
+    # Sorted by key, so that concurrent upserts lock rows in the same order
+    return {
+        table: [
+            {
+                "short_code": short_code,
+                "bucket": bucket,
+                "referrer": referrer,
+                "agent": agent,
+                "clicks": clicks,
+            }
+            for (short_code, bucket, referrer, agent), clicks in sorted(
+                table_counts.items()
+            )
+        ]
+        for table, table_counts in counts.items()
+    }
+
+
+async def _upsert_clicks(connection: AsyncConnection, table: Table, rows: List):
+    statement = dialect_insert(connection, table)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={"clicks": table.c.clicks + statement.excluded.clicks},
+    )
+    await connection.execute(statement, rows)
+
+
+async def _merge_sketches(
+    connection: AsyncConnection,
+    table: Table,
+    rows: Dict[Tuple, Dict],
+    merge: Callable[[Dict, Row], None],
+):
+    """
+    Merges rows with HyperLogLog sketches into the stored ones by primary key,
+    locked until the commit. FOR UPDATE does not lock rows which do not exist
+    yet, so rows another ingest has inserted meanwhile are read and merged
+    again instead of being overwritten
+    """
+    key_columns = list(table.primary_key.columns)
+
+    def stored_rows(rows: List[Dict]) -> List[Dict]:
+        return [{**row, "sketch": row["sketch"].to_bytes()} for row in rows]
+
+    pending = dict(rows)
+    while pending:
+        stored = await connection.execute(
+            select(table)
+            .where(tuple_(*key_columns).in_(list(pending)))
+            .order_by(*key_columns)
+            .with_for_update()
+        )
+        existing = []
+        for row in stored:
+            key = tuple(getattr(row, column.name) for column in key_columns)
+            merge(pending[key], row)
+            existing.append(pending.pop(key))
+        statement = dialect_insert(connection, table)
+        if existing:
+            # Locked, so overwriting them with the merged sketches is safe
+            await connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=key_columns,
+                    set_={
+                        name: statement.excluded[name]
+                        for name in existing[0]
+                        if name not in table.primary_key.columns
+                    },
+                ),
+                stored_rows(existing),
+            )
+        if pending:
+            inserted = await connection.execute(
+                statement.on_conflict_do_nothing().returning(*key_columns),
+                stored_rows(list(pending.values())),
+            )
+            for row in inserted:
+                pending.pop(tuple(row))
+
+
+def _merge_visitor_row(row: Dict, stored: Row):
+    row["sketch"].merge(HyperLogLog.from_bytes(stored.sketch))
+    if "first_seen" in row:
+        row["first_seen"] = min(row["first_seen"], stored.first_seen)
+
+
+async def _merge_visitors(
+    connection: AsyncConnection, entries: List[Tuple[str, Dict[str, str]]]
+):
+    """Adds the fingerprints to the stored sketches, locked until the commit"""
+    overall: Dict[Tuple, Dict] = {}
+    daily: Dict[Tuple, Dict] = {}
+    for entry_id, event in entries:
+        if not event or not event.get("v"):
+            continue
+        short_code, hashed = event["c"], int(event["v"], 16)
+        day = bucket_start(_event_time(entry_id, event), "day")
+        row = overall.setdefault(
+            (short_code,),
+            {"short_code": short_code, "first_seen": day, "sketch": HyperLogLog()},
+        )
+        row["sketch"].add(hashed)
+        row["first_seen"] = min(row["first_seen"], day)
+        daily.setdefault(
+            (short_code, day),
+            {"short_code": short_code, "bucket": day, "sketch": HyperLogLog()},
+        )["sketch"].add(hashed)
+    if not overall:
+        return
+
+    await _merge_sketches(connection, _visitors_table, overall, _merge_visitor_row)
+    await _merge_sketches(connection, _daily_visitors_table, daily, _merge_visitor_row)
+
+
+class ClickService:
+    """
+    Click analytics off the redirect path: a redirect appends a compact event
+    to the links:clicks stream, or to an in-process ring buffer while redis is
+    down. Each worker consumes the stream in the rollups group and adds the
+    events up into hourly and daily rollup tables and HyperLogLog sketches of
+    visitors, which is all the stats endpoint reads. Events are acknowledged
+    after the commit, so a worker dying in between counts its clicks twice
+    (but not its visitors)
+    """
+
+    def __init__(self, config: Config, redis: Redis, engine: AsyncEngine):
+        self.config = config
+        self.redis = redis
+        self.engine = engine
+        self.worker_id = uuid.uuid4().hex
+        # Fingerprints can not be matched to addresses without the secret
+        self._visitor_key = hashlib.sha256(
+            f"visitors:{config.secret_key}".encode()
+        ).digest()
+        self.buffer: Deque[Dict[str, str]] = deque(maxlen=config.clicks_buffer_size)
+        # Buffered events pushed out by newer ones while redis was down
+        self.dropped = 0
+        self._group_created = False
+        self._consumer: Optional[asyncio.Task] = None
+
+    def click_event(
+        self, short_code: str, headers: Mapping[str, str], client: Optional[str]
+    ) -> Dict[str, str]:
+        user_agent = headers.get("user-agent")
+        visitor = hashlib.blake2b(
+            f"{client or ''}|{user_agent or ''}".encode(),
+            key=self._visitor_key,
+            digest_size=8,
+        )
+        return {
+            "c": short_code,
+            "r": referrer_host(headers.get("referer")),
+            "a": agent_class(user_agent),
+            "v": visitor.hexdigest(),
+        }
+
+    def buffer_click(self, event: Dict[str, str]):
+        """Keeps a click the redirect could not append while redis is down"""
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append({**event, "t": str(int(time.time() * 1000))})
+
+    async def publish_buffered(self) -> int:
+        """Moves the events buffered while redis was down to the stream"""
+        events = list(self.buffer)
+        if not events:
+            return 0
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for event in events:
+                await append_click(pipe, self.config, event)
+            await pipe.execute()
+        # Clicks may have been buffered meanwhile, they go next time
+        for _ in events:
+            self.buffer.popleft()
+        return len(events)
+
+    async def _create_group(self):
+        if self._group_created:
+            return
+        try:
+            await self.redis.xgroup_create(
+                CLICKS_STREAM, CLICKS_GROUP, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_created = True
+
+    async def _read(self, block: Optional[int]) -> List[Tuple[str, Dict[str, str]]]:
+        batch_size = self.config.clicks_ingest_batch_size
+        # Events a dead worker has read but not written go first
+        _, entries, *_ = await self.redis.xautoclaim(
+            CLICKS_STREAM,
+            CLICKS_GROUP,
+            self.worker_id,
+            min_idle_time=int(self.config.clicks_claim_idle_seconds * 1000),
+            count=batch_size,
+        )
+        if entries:
+            return entries
+        response = await self.redis.xreadgroup(
+            CLICKS_GROUP,
+            self.worker_id,
+            {CLICKS_STREAM: ">"},
+            count=batch_size,
+            block=block,
+        )
+        return response[0][1] if response else []
+
+    async def ingest(self, block: Optional[int] = None) -> int:
+        """Adds one batch of events into the rollups, returns its size"""
+        await self._create_group()
+        await self.publish_buffered()
+        entries = await self._read(block)
+        if not entries:
+            return 0
+
+        async with self.engine.begin() as connection:
+            for table, rows in _rollup_rows(entries).items():
+                if rows:
+                    await _upsert_clicks(connection, table, rows)
+            await _merge_visitors(connection, entries)
+        await self.redis.xack(
+            CLICKS_STREAM, CLICKS_GROUP, *[entry_id for entry_id, _ in entries]
+        )
+        return len(entries)
+
+    async def _consume(self):
+        while True:
+            try:
+                await self.ingest(block=self.config.clicks_ingest_block_ms)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Click events ingestion failed")
+                # The stream may be gone with its group if redis restarted
+                self._group_created = False
+                await asyncio.sleep(self.config.clicks_ingest_block_ms / 1000)
+
+    def start_consumer(self):
+        if not self._consumer:
+            self._consumer = asyncio.create_task(self._consume())
+
+    async def stop_consumer(self):
+        if self._consumer:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+        try:
+            await self.publish_buffered()
+        except RedisError:
+            logger.warning("Lost %s buffered click events", len(self.buffer))
+
+    async def get_clicks(
+        self,
+        session: AsyncSession,
+        short_code: str,
+        created_at: datetime,
+        since: datetime,
+        until: datetime,
+        bucket: ClickBucketSize,
+    ) -> List[ClickBucketOut]:
+        """
+        Clicks in [since, until) from the rollups, by bucket, with unique
+        visitors for days. Buckets before the link was created belong to an
+        older link with the same short code
+        """
+        table = _rollup_tables[bucket]
+        since = max(bucket_start(since, bucket), bucket_start(created_at, bucket))
+        rows = (
+            await session.exec(  # type: ignore
+                select(table.c.bucket, table.c.referrer, table.c.agent, table.c.clicks)
+                .where(
+                    table.c.short_code == short_code,
+                    table.c.bucket >= since,
+                    table.c.bucket < until,
+                )
+                .order_by(table.c.bucket)
+            )
+        ).all()
+
+        buckets: Dict[datetime, ClickBucketOut] = {}
+        for row in rows:
+            out = buckets.get(row.bucket)
+            if not out:
+                out = buckets[row.bucket] = ClickBucketOut(
+                    start=row.bucket, clicks=0, referrers={}, agents={}
+                )
+            out.clicks += row.clicks
+            out.referrers[row.referrer] = (
+                out.referrers.get(row.referrer, 0) + row.clicks
+            )
+            out.agents[row.agent] = out.agents.get(row.agent, 0) + row.clicks
+
+        if bucket == "day":
+            for day, sketch in await self._daily_sketches(
+                session, short_code, since, until
+            ):
+                if day in buckets:
+                    buckets[day].unique_visitors = sketch.count()
+        return list(buckets.values())
+
+    async def get_unique_visitors(
+        self, session: AsyncSession, short_code: str, created_at: datetime
+    ) -> int:
+        table = _visitors_table
+        row = (
+            await session.exec(  # type: ignore
+                select(table.c.first_seen, table.c.sketch).where(
+                    table.c.short_code == short_code
+                )
+            )
+        ).first()
+        if not row:
+            return 0
+        created_day = bucket_start(created_at, "day")
+        if row.first_seen >= created_day:
+            return HyperLogLog.from_bytes(row.sketch).count()
+
+        # The sketch counts visitors of an older link with the same alias too
+        sketch = HyperLogLog()
+        for _, daily in await self._daily_sketches(
+            session, short_code, created_day, datetime.max
+        ):
+            sketch.merge(daily)
+        return sketch.count()
+
+    @staticmethod
+    async def _daily_sketches(
+        session: AsyncSession, short_code: str, since: datetime, until: datetime
+    ) -> List[Tuple[datetime, HyperLogLog]]:
+        table = _daily_visitors_table
+        rows = await session.exec(  # type: ignore
+            select(table.c.bucket, table.c.sketch).where(
+                table.c.short_code == short_code,
+                table.c.bucket >= since,
+                table.c.bucket < until,
+            )
+        )
+        return [(row.bucket, HyperLogLog.from_bytes(row.sketch)) for row in rows]
+
+
+_service = None
+
+
+def get_service(config: ConfigDep, redis: RedisDep, engine: EngineDep) -> ClickService:
+    global _service
+    if not _service:
+        _service = ClickService(config=config, redis=redis, engine=engine)
+    return _service
+
+
+ClickServiceDep = Annotated[ClickService, Depends(get_service)]
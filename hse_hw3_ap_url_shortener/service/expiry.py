@@ -0,0 +1,199 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Annotated, Dict, List, Optional
+
+from fastapi import Depends
+from redis.asyncio import Redis
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from hse_hw3_ap_url_shortener.db import EngineDep, RedisDep
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.service.link import (
+    EXPIRY_KEY,
+    LinkService,
+    LinkServiceDep,
+)
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+_link_table = Link.__table__  # type: ignore
+
+# KEYS[1] - expiry index, ARGV - now, batch size. Takes due links off the
+# index, so that every worker reaps its own ones. Returns members and scores
+CLAIM_SCRIPT = """
+local due = redis.call(
+    "ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "WITHSCORES", "LIMIT", 0, ARGV[2]
+)
+for i = 1, #due, 2 do
+    redis.call("ZREM", KEYS[1], due[i])
+end
+return due
+"""
+
+# Added last by a rebuild, never due. A link added after redis lost the index
+# recreates the set without it, so a missing marker means a rebuild is needed
+INDEXED_MARKER = ""
+
+
+class ExpiryService:
+    """
+    Deletes links when they expire. LinkService keeps deadlines in the
+    links:expiry sorted set, the reaper sleeps until the earliest one, but at
+    most expiry_reaper_max_sleep_seconds, since other workers add links too.
+    Due links are taken off the set atomically, so workers reap different ones.
+    Every loop checks that the set still has the rebuild marker and refills it
+    from the DB otherwise, since redis may restart or evict it
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        redis: Redis,
+        engine: AsyncEngine,
+        link_service: LinkService,
+    ):
+        self.config = config
+        self.redis = redis
+        self.engine = engine
+        self.link_service = link_service
+        self._claim = redis.register_script(CLAIM_SCRIPT)
+        self._reaper: Optional[asyncio.Task] = None
+
+    async def rebuild_index(self) -> int:
+        """Fills the sorted set from the DB if redis has lost it"""
+        if await self.redis.zscore(EXPIRY_KEY, INDEXED_MARKER) is not None:
+            return 0
+
+        indexed = last_id = 0
+        batch_size = self.config.expiry_reaper_batch_size
+        while True:
+            async with self.engine.connect() as connection:
+                rows = (
+                    await connection.execute(
+                        select(
+                            _link_table.c.id,
+                            _link_table.c.short_code,
+                            _link_table.c.expires_at,
+                        )
+                        .where(
+                            _link_table.c.expires_at.is_not(None),
+                            _link_table.c.id > last_id,
+                        )
+                        .order_by(_link_table.c.id)
+                        .limit(batch_size)
+                    )
+                ).all()
+            if rows:
+                await self.redis.zadd(
+                    EXPIRY_KEY,
+                    {row.short_code: row.expires_at.timestamp() for row in rows},
+                )
+                indexed += len(rows)
+                last_id = rows[-1].id
+            if len(rows) < batch_size:
+                break
+        await self.redis.zadd(EXPIRY_KEY, {INDEXED_MARKER: float("inf")})
+
+        logger.info("Rebuilt the link expiry index with %s links", indexed)
+        return indexed
+
+    async def _delete_due(self, due: Dict[str, float], now: datetime) -> List[str]:
+        try:
+            async with self.engine.begin() as connection:
+                result = await connection.execute(
+                    delete(_link_table)
+                    .where(
+                        _link_table.c.short_code.in_(due),
+                        _link_table.c.expires_at <= now,
+                    )
+                    .returning(_link_table.c.short_code)
+                )
+                deleted = list(result.scalars())
+                # Extended since they were indexed, put back with the new deadline
+                kept = await connection.execute(
+                    select(_link_table.c.short_code, _link_table.c.expires_at).where(
+                        _link_table.c.short_code.in_(due.keys() - set(deleted)),
+                        _link_table.c.expires_at.is_not(None),
+                    )
+                )
+                rescheduled = {
+                    row.short_code: row.expires_at.timestamp() for row in kept
+                }
+        except Exception:
+            # A newer deadline added meanwhile wins over the claimed one
+            await self.redis.zadd(EXPIRY_KEY, due, nx=True)
+            raise
+        if rescheduled:
+            await self.redis.zadd(EXPIRY_KEY, rescheduled)
+        return deleted
+
+    async def reap_due_links(self) -> float:
+        """Deletes due links, returns how long to sleep until the next deadline"""
+        now = datetime.now()
+        batch_size = self.config.expiry_reaper_batch_size
+        claimed = await self._claim(
+            keys=[EXPIRY_KEY], args=[now.timestamp(), batch_size]
+        )
+        due = {
+            member: float(score) for member, score in zip(claimed[::2], claimed[1::2])
+        }
+        if due:
+            deleted = await self._delete_due(due, now)
+            await self.link_service.invalidate_cached(list(due))
+            logger.info("Deleted %s expired links", len(deleted))
+            if len(due) == batch_size:
+                return 0
+
+        max_sleep = self.config.expiry_reaper_max_sleep_seconds
+        upcoming = await self.redis.zrange(EXPIRY_KEY, 0, 0, withscores=True)
+        if not upcoming:
+            return max_sleep
+        return min(max(upcoming[0][1] - now.timestamp(), 0), max_sleep)
+
+    async def _reap(self):
+        while True:
+            try:
+                await self.rebuild_index()
+                delay = await self.reap_due_links()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Expired links reaper failed")
+                delay = self.config.expiry_reaper_max_sleep_seconds
+            await asyncio.sleep(delay)
+
+    def start_reaper(self):
+        if not self._reaper:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def stop_reaper(self):
+        if self._reaper:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+
+
+_service = None
+
+
+def get_service(
+    config: ConfigDep,
+    redis: RedisDep,
+    engine: EngineDep,
+    link_service: LinkServiceDep,
+) -> ExpiryService:
+    global _service
+    if not _service:
+        _service = ExpiryService(
+            config=config, redis=redis, engine=engine, link_service=link_service
+        )
+    return _service
+
+
+ExpiryServiceDep = Annotated[ExpiryService, Depends(get_service)]
@@ -0,0 +1,139 @@
+import logging
+from datetime import datetime
+from typing import Annotated, Dict, List
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from fastapi import Depends
+from redis.asyncio import Redis
+from sqlalchemy import update, bindparam, case, DateTime
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from hse_hw3_ap_url_shortener.db import RedisDep, EngineDep
+from hse_hw3_ap_url_shortener.metrics import VISIT_FLUSH_SECONDS, timed_job
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.service.link import VISITS_COUNT_KEY, VISITS_LAST_KEY
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+_link_table = Link.__table__  # type: ignore
+
+# Core statement, so that executemany does not turn into ORM bulk update by id
+_flush_statement = (
+    update(_link_table)
+    .where(_link_table.c.short_code == bindparam("code"))
+    .values(
+        visits=_link_table.c.visits + bindparam("delta"),
+        last_visit=case(
+            (
+                _link_table.c.last_visit.is_(None)
+                | (_link_table.c.last_visit < bindparam("last", type_=DateTime)),
+                bindparam("last", type_=DateTime),
+            ),
+            else_=_link_table.c.last_visit,
+        ),
+    )
+)
+
+
+# Puts drained visits back after a failed flush. KEYS - counts, last visits,
+# ARGV - (code, count, last visit) triples. Keeps the later last visit, as one
+# may have been recorded since the drain. ISO timestamps compare as strings
+RESTORE_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    redis.call("HINCRBY", KEYS[1], ARGV[i], ARGV[i + 1])
+    local last = redis.call("HGET", KEYS[2], ARGV[i])
+    if not last or last < ARGV[i + 2] then
+        redis.call("HSET", KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+end
+return #ARGV / 3
+"""
+
+
+class FlushVisitsService:
+    def __init__(self, config: Config, redis: Redis, engine: AsyncEngine):
+        self.scheduler = AsyncIOScheduler()
+        self.config = config
+        self.redis = redis
+        self.engine = engine
+        self._restore = redis.register_script(RESTORE_SCRIPT)
+
+    async def _drain_pending(self) -> List[Dict]:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.hgetall(VISITS_COUNT_KEY)
+            await pipe.hgetall(VISITS_LAST_KEY)
+            await pipe.delete(VISITS_COUNT_KEY, VISITS_LAST_KEY)
+            counts, last_visits, _ = await pipe.execute()
+
+        now = datetime.now()
+        return [
+            {
+                "code": code,
+                "delta": int(count),
+                "last": (
+                    datetime.fromisoformat(last_visits[code])
+                    if code in last_visits
+                    else now
+                ),
+            }
+            for code, count in counts.items()
+        ]
+
+    async def _restore_pending(self, rows: List[Dict]):
+        await self._restore(
+            keys=[VISITS_COUNT_KEY, VISITS_LAST_KEY],
+            args=[
+                value
+                for row in rows
+                for value in (row["code"], row["delta"], row["last"].isoformat())
+            ],
+        )
+
+    async def flush_visits(self) -> int:
+        rows = await self._drain_pending()
+        if not rows:
+            return 0
+
+        batch_size = self.config.visit_flush_batch_size
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            try:
+                with VISIT_FLUSH_SECONDS.time():
+                    async with self.engine.begin() as connection:
+                        await connection.execute(_flush_statement, batch)
+            except Exception:
+                logger.exception("Could not flush visits, returning them to redis")
+                await self._restore_pending(rows[start:])
+                raise
+
+        logger.info("Flushed visits for %s links", len(rows))
+        return len(rows)
+
+    def start_scheduler(self):
+        self.scheduler.add_job(
+            timed_job("flush_visits", self.flush_visits),
+            "interval",
+            seconds=self.config.visit_flush_interval_seconds,
+        )
+        self.scheduler.start()
+
+    async def shutdown(self):
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        await self.flush_visits()
+
+
+_service = None
+
+
+def get_service(
+    config: ConfigDep, redis: RedisDep, engine: EngineDep
+) -> FlushVisitsService:
+    global _service
+    if not _service:
+        _service = FlushVisitsService(config=config, redis=redis, engine=engine)
+    return _service
+
+
+FlushVisitsServiceDep = Annotated[FlushVisitsService, Depends(get_service)]
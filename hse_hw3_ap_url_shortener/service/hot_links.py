@@ -0,0 +1,148 @@
+import heapq
+import logging
+import time
+import uuid
+from collections import defaultdict
+from typing import Annotated, Dict, Generic, Hashable, List, Tuple, TypeVar
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from fastapi import Depends
+from redis.asyncio import Redis
+
+from hse_hw3_ap_url_shortener.db import RedisDep
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+# Sorted set of worker ids by the time they last published their counters
+HOT_WORKERS_KEY = "links:hot:workers"
+# Sorted set of short codes by decayed visit count, one per worker
+HOT_LINKS_KEY = "links:hot:{worker}"
+
+K = TypeVar("K", bound=Hashable)
+
+
+class SpaceSaving(Generic[K]):
+    """
+    Space-Saving heavy hitters: keeps at most `capacity` counters, a new key
+    takes over the smallest counter. Counts are overestimated by at most the
+    smallest count, so every key with a larger true count is kept
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[K, float] = {}
+        # Lazy min-heap, an entry may hold an older (smaller) count of its key
+        self._heap: List[Tuple[float, K]] = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key: K, weight: float = 1.0):
+        if key in self.counts:
+            self.counts[key] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            heapq.heappush(self._heap, (weight, key))
+            return
+
+        count, victim = self._heap[0]
+        while self.counts[victim] != count:
+            heapq.heapreplace(self._heap, (self.counts[victim], victim))
+            count, victim = self._heap[0]
+        del self.counts[victim]
+        self.counts[key] = count + weight
+        heapq.heapreplace(self._heap, (count + weight, key))
+
+    def decay(self, factor: float):
+        self.counts = {key: count * factor for key, count in self.counts.items()}
+        self._heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def top(self, limit: int) -> List[Tuple[K, float]]:
+        return heapq.nlargest(limit, self.counts.items(), key=lambda item: item[1])
+
+
+class HotLinksService:
+    """
+    Tracks which links are visited the most right now. Every worker counts its
+    redirects with exponential decay (hot_links_half_life_minutes) and
+    publishes the counters to redis, readers sum the counters of live workers
+    """
+
+    def __init__(self, config: Config, redis: Redis):
+        self.scheduler = AsyncIOScheduler()
+        self.config = config
+        self.redis = redis
+        self.worker_id = uuid.uuid4().hex
+        self.tracker: SpaceSaving[str] = SpaceSaving(config.hot_links_capacity)
+        self._decayed_at = time.monotonic()
+
+    def _growth(self) -> float:
+        half_life = self.config.hot_links_half_life_minutes * 60
+        return 2 ** ((time.monotonic() - self._decayed_at) / half_life)
+
+    def record_visit(self, short_code: str):
+        # Forward decay: newer visits weigh more, until the next rebase in _decay
+        self.tracker.add(short_code, self._growth())
+
+    def _decay(self):
+        self.tracker.decay(1 / self._growth())
+        self._decayed_at = time.monotonic()
+
+    async def publish(self):
+        self._decay()
+        key = HOT_LINKS_KEY.format(worker=self.worker_id)
+        # Counters of a worker which stopped publishing are ignored and expire
+        ttl = 3 * self.config.hot_links_publish_interval_seconds
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.delete(key)
+            if len(self.tracker):
+                await pipe.zadd(key, self.tracker.counts)
+                await pipe.expire(key, ttl)
+            await pipe.zadd(HOT_WORKERS_KEY, {self.worker_id: time.time()})
+            await pipe.zremrangebyscore(HOT_WORKERS_KEY, "-inf", time.time() - ttl)
+            await pipe.execute()
+
+    async def get_hot_short_codes(self, limit: int) -> List[str]:
+        ttl = 3 * self.config.hot_links_publish_interval_seconds
+        workers = await self.redis.zrangebyscore(
+            HOT_WORKERS_KEY, time.time() - ttl, "+inf"
+        )
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for worker in workers:
+                await pipe.zrevrange(
+                    HOT_LINKS_KEY.format(worker=worker),
+                    0,
+                    self.config.hot_links_capacity - 1,
+                    withscores=True,
+                )
+            snapshots = await pipe.execute()
+
+        totals: Dict[str, float] = defaultdict(float)
+        for snapshot in snapshots:
+            for short_code, count in snapshot:
+                totals[short_code] += count
+        return heapq.nlargest(limit, totals, key=totals.__getitem__)
+
+    def start_scheduler(self):
+        self.scheduler.add_job(
+            self.publish,
+            "interval",
+            seconds=self.config.hot_links_publish_interval_seconds,
+        )
+        self.scheduler.start()
+
+
+_service = None
+
+
+def get_service(config: ConfigDep, redis: RedisDep) -> HotLinksService:
+    global _service
+    if not _service:
+        _service = HotLinksService(config=config, redis=redis)
+    return _service
+
+
+HotLinksServiceDep = Annotated[HotLinksService, Depends(get_service)]
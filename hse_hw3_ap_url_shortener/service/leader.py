@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Annotated, Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi import Depends
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError, WatchError
+
+from hse_hw3_ap_url_shortener.db import RedisDep
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+# "{worker id}:{fencing token}" of the leader, expires unless renewed
+LEADER_KEY = "leader:{name}"
+# Fencing tokens, a new one for every new leader
+FENCING_KEY = "leader:{name}:fencing"
+
+# KEYS[1] - lease, KEYS[2] - fencing counter, ARGV - worker id, lease ms.
+# Renews the lease of its holder, or takes a free one with the next token.
+# Returns the lease value, or nil when another worker holds it
+ACQUIRE_SCRIPT = """
+local current = redis.call("GET", KEYS[1])
+if current then
+    if string.match(current, "^([^:]*):") ~= ARGV[1] then
+        return nil
+    end
+    redis.call("PEXPIRE", KEYS[1], ARGV[2])
+    return current
+end
+local value = ARGV[1] .. ":" .. redis.call("INCR", KEYS[2])
+redis.call("SET", KEYS[1], value, "PX", ARGV[2])
+return value
+"""
+
+# KEYS[1] - lease, ARGV[1] - its value. Frees the lease if it is still ours
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class NotLeaderError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Lease:
+    token: int
+    value: str
+    # Monotonic time the lease surely lasts until, counted from before the
+    # request that took or renewed it
+    valid_until: float
+
+
+class LeaderService:
+    """
+    One leader per election across all workers and replicas, on redis
+    leases. Every worker tries to take or renew the leases it takes part in
+    each third of leader_lease_seconds, and a lease lasts two thirds, so a
+    dead leader is replaced within leader_lease_seconds. A leader which
+    could not renew steps down locally before its lease expires in redis.
+    Writes which must not come from a deposed leader go through
+    execute_fenced
+    """
+
+    def __init__(self, config: Config, redis: Redis):
+        self.config = config
+        self.redis = redis
+        self.worker_id = uuid.uuid4().hex
+        self.elections: Set[str] = set()
+        self.leases: Dict[str, Lease] = {}
+        self._acquire = redis.register_script(ACQUIRE_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+        self._elector: Optional[asyncio.Task] = None
+
+    @property
+    def renew_interval(self) -> float:
+        return self.config.leader_lease_seconds / 3
+
+    @property
+    def lease_ttl(self) -> float:
+        return self.config.leader_lease_seconds - self.renew_interval
+
+    def is_leader(self, name: str) -> bool:
+        lease = self.leases.get(name)
+        return lease is not None and lease.valid_until > time.monotonic()
+
+    def fencing_token(self, name: str) -> Optional[int]:
+        return self.leases[name].token if self.is_leader(name) else None
+
+    async def elect(self, name: str) -> bool:
+        """Takes or renews the lease, returns whether this worker leads"""
+        started = time.monotonic()
+        try:
+            value = await self._acquire(
+                keys=[LEADER_KEY.format(name=name), FENCING_KEY.format(name=name)],
+                args=[self.worker_id, int(self.lease_ttl * 1000)],
+            )
+        except RedisError:
+            logger.warning("Could not renew the %s lease", name)
+            return self.is_leader(name)
+
+        if not value:
+            if self.leases.pop(name, None):
+                logger.info("Lost the %s lease", name)
+            return False
+        token = int(value.rsplit(":", 1)[1])
+        previous = self.leases.get(name)
+        if not previous or previous.token != token:
+            logger.info("Leading %s with fencing token %s", name, token)
+        self.leases[name] = Lease(token, value, started + self.lease_ttl)
+        return True
+
+    async def _elect_all(self):
+        while True:
+            for name in self.elections:
+                try:
+                    await self.elect(name)
+                except Exception:
+                    logger.exception("Election of %s failed", name)
+            await asyncio.sleep(self.renew_interval)
+
+    async def start_elections(self, *names: str):
+        """Runs the first round right away, so that the leaders are known"""
+        self.elections.update(names)
+        for name in names:
+            try:
+                await self.elect(name)
+            except Exception:
+                logger.exception("Election of %s failed", name)
+        if not self._elector:
+            self._elector = asyncio.create_task(self._elect_all())
+
+    async def stop_elections(self):
+        if self._elector:
+            self._elector.cancel()
+            try:
+                await self._elector
+            except asyncio.CancelledError:
+                pass
+            self._elector = None
+        # Lets another worker take over now instead of after the lease
+        for name, lease in list(self.leases.items()):
+            try:
+                await self._release(
+                    keys=[LEADER_KEY.format(name=name)], args=[lease.value]
+                )
+            except RedisError:
+                logger.warning("Could not release the %s lease", name)
+        self.leases.clear()
+
+    def leader_only(
+        self, name: str, job: Callable[[], Awaitable[Any]]
+    ) -> Callable[[], Awaitable[Any]]:
+        """Wraps a scheduled job to run on the leader of `name` only"""
+
+        async def run():
+            if self.is_leader(name):
+                return await job()
+            logger.debug("Skipping %s, not the leader", name)
+
+        return run
+
+    async def execute_fenced(
+        self, name: str, queue: Callable[[Pipeline], Awaitable[None]]
+    ) -> List[Any]:
+        """
+        Runs the commands `queue` adds to a MULTI block only if this worker
+        still holds its lease when the block executes
+        """
+        key = LEADER_KEY.format(name=name)
+        # Renewing the lease touches the watched key too, that is retried once
+        for _ in range(2):
+            if not self.is_leader(name):
+                raise NotLeaderError(name)
+            lease = self.leases[name]
+            async with self.redis.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(key)
+                    if await pipe.get(key) != lease.value:
+                        raise NotLeaderError(name)
+                    pipe.multi()
+                    await queue(pipe)
+                    return await pipe.execute()
+                except WatchError:
+                    logger.info("The %s lease changed during a fenced write", name)
+        raise NotLeaderError(name)
+
+
+_service = None
+
+
+def get_service(config: ConfigDep, redis: RedisDep) -> LeaderService:
+    global _service
+    if not _service:
+        _service = LeaderService(config=config, redis=redis)
+    return _service
+
+
+LeaderServiceDep = Annotated[LeaderService, Depends(get_service)]
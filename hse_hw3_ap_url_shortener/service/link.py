@@ -1,21 +1,105 @@
+import asyncio
+import logging
+import math
+import random
 import secrets
 import string
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from typing import Annotated
-from typing import Optional, List
-from urllib.parse import quote
+from typing import Callable, Dict, Optional, List, Tuple
+from urllib.parse import urlsplit
 
 from fastapi import Depends
 from fastapi import HTTPException, status
 from pydantic import HttpUrl
 from redis.asyncio import Redis
-from sqlmodel import select, Session
+from sqlalchemy import insert, literal_column, table, text, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from hse_hw3_ap_url_shortener.db import RedisDep
+from hse_hw3_ap_url_shortener.db import (
+    URL_SEARCH_TABLE,
+    EngineDep,
+    RedisDep,
+    create_session,
+)
+from hse_hw3_ap_url_shortener.metrics import LINK_CACHE_LOOKUPS, LINK_LOOKUPS
 from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.model.model import LinkCreateIn, LinkSearchMode
+from hse_hw3_ap_url_shortener.service.clicks import append_click
+from hse_hw3_ap_url_shortener.service.leader import RELEASE_SCRIPT
+from hse_hw3_ap_url_shortener.service.link_record import (
+    CachedLink,
+    decode_link,
+    encode_link,
+)
+from hse_hw3_ap_url_shortener.service.local_cache import (
+    LocalCacheService,
+    LocalCacheServiceDep,
+)
+from hse_hw3_ap_url_shortener.service.short_code import (
+    ShortCodeService,
+    ShortCodeServiceDep,
+)
+from hse_hw3_ap_url_shortener.service.url_hash import (
+    normalize_url,
+    quote_url,
+    url_hash,
+)
 from hse_hw3_ap_url_shortener.settings.config import Config
 from hse_hw3_ap_url_shortener.settings.config import ConfigDep
 
+logger = logging.getLogger(__name__)
+
+# Generated codes can still be taken by a custom alias, then we take the next one
+MAX_CREATE_ATTEMPTS = 5
+
+# Visits are buffered in redis and written to the DB by FlushVisitsService
+VISITS_COUNT_KEY = "visits:count"
+VISITS_LAST_KEY = "visits:last"
+
+# Sorted set of short codes by expires_at timestamp, see ExpiryService
+EXPIRY_KEY = "links:expiry"
+
+# Cached in place of a link for short codes which do not exist
+LINK_TOMBSTONE = "-"
+
+# Taken by the worker loading a link from the DB, see single_flight_redis_lock
+LINK_LOCK_KEY = "link:{short_code}:lock"
+# How often other workers check whether the link has been loaded
+SINGLE_FLIGHT_POLL_SECONDS = 0.02
+
+# Bumped by every invalidation, so that a load started before it does not
+# cache what it has read. Outlives any load, then goes away with the link
+LINK_GENERATION_KEY = "link:{short_code}:gen"
+LINK_GENERATION_TTL_SECONDS = 3600
+
+# KEYS[1] - cached link, KEYS[2] - its generation, ARGV - the generation read
+# before the DB, value, TTL in ms. Returns 0 if the link has been invalidated
+CACHE_LOADED_SCRIPT = """
+if (redis.call("GET", KEYS[2]) or "") ~= ARGV[1] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "PX", ARGV[3])
+return 1
+"""
+
+
+def link_cache_ttl(
+    link: Link | CachedLink, cache_ttl_hours: int, jitter: float = 0
+) -> Optional[timedelta]:
+    """
+    TTL for a cached link, so that it never outlives its expiration.
+    Up to `jitter` of it is cut at random, so links cached together expire apart
+    """
+    ttl = timedelta(hours=cache_ttl_hours) * (1 - jitter * random.random())
+    if link.expires_at:
+        ttl = min(ttl, link.expires_at - datetime.now())
+    return ttl if ttl.total_seconds() >= 1 else None
+
 
 def _generate_random_string(length: int) -> str:
     chars = string.ascii_letters + string.digits
@@ -23,61 +107,382 @@ def _generate_random_string(length: int) -> str:
 
 
 class LinkService:
-    def __init__(self, config: Config, redis: Redis):
+    def __init__(
+        self,
+        config: Config,
+        redis: Redis,
+        local_cache: LocalCacheService,
+        short_codes: ShortCodeService,
+        engine: AsyncEngine,
+    ):
         self.config = config
         self.redis = redis
+        self.local_cache = local_cache
+        self.short_codes = short_codes
+        # Deletes the single-flight lock only while this worker still holds it
+        self._release_lock = redis.register_script(RELEASE_SCRIPT)
+        self._cache_loaded = redis.register_script(CACHE_LOADED_SCRIPT)
+        # For refreshes, which outlive the request and its session
+        self.engine = engine
 
     async def create_link(
         self,
-        session: Session,
+        session: AsyncSession,
         user: User,
         original_url: HttpUrl,
         custom_alias: Optional[str] = None,
         expires_at: Optional[datetime] = None,
     ) -> Link:
-        original_url = quote(str(original_url), safe="%/:=&?~#+!$,;'@()*[]")
+        original_url = quote_url(str(original_url))
+        alias_taken = HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Custom alias already exists",
+        )
 
         if custom_alias:
-            existing_link = await self.get_link_by_short_code(session, custom_alias)
+            existing_link = await self._find_link(session, custom_alias)
             if existing_link:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Custom alias already exists",
+                raise alias_taken
+
+        # Rollback expires the user, so remember the id
+        user_id = user.id
+        for _ in range(MAX_CREATE_ATTEMPTS):
+            short_code = custom_alias or await self.generate_unique_short_code(session)
+            row = Link(
+                short_code=short_code,
+                original_url=original_url,
+                url_hash=url_hash(original_url),
+                user_id=user_id,
+                expires_at=expires_at,
+            ).model_dump(exclude={"id"})
+            try:
+                # RETURNING gives the id without reading the link back
+                created = await session.exec(  # type: ignore
+                    insert(Link).values(**row).returning(Link)
                 )
-            short_code = custom_alias
+                link = created.scalar_one()
+                await session.commit()
+                break
+            except IntegrityError:
+                await session.rollback()
+                if custom_alias:
+                    raise alias_taken
+                logger.warning("Generated short code %s is taken", short_code)
         else:
-            short_code = await self.generate_unique_short_code(session)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Could not generate a short code",
+            )
 
-        link = Link(
-            short_code=short_code,
-            original_url=original_url,
-            user_id=user.id,
-            expires_at=expires_at,
-        )
-        session.add(link)
-        session.commit()
-        session.refresh(link)
+        # The code could have been looked up and cached as missing before
+        await self.invalidate_cached([short_code])
+        await self.schedule_expiry([link])
         return link
 
+    async def create_links(
+        self, session: AsyncSession, user: User, links_in: List[LinkCreateIn]
+    ) -> List[Tuple[Optional[Link], Optional[str]]]:
+        """
+        Creates links in one multi-row insert per attempt.
+        Returns a (link, error) pair for every item, in the same order
+        """
+        results: List[Tuple[Optional[Link], Optional[str]]] = [(None, None)] * len(
+            links_in
+        )
+        now = datetime.now()
+        pending = {}
+        aliases = set()
+        for index, link_in in enumerate(links_in):
+            if link_in.expires_at and link_in.expires_at < now:
+                results[index] = (None, "expires_at must be in the future")
+            elif link_in.custom_alias and link_in.custom_alias in aliases:
+                results[index] = (None, "Custom alias already exists")
+            else:
+                if link_in.custom_alias:
+                    aliases.add(link_in.custom_alias)
+                pending[index] = None
+
+        user_id = user.id
+        for _ in range(MAX_CREATE_ATTEMPTS):
+            if not pending:
+                break
+            generated = [index for index in pending if not links_in[index].custom_alias]
+            for index, short_code in zip(
+                generated, await self._generate_short_codes(len(generated))
+            ):
+                pending[index] = short_code
+            for index in pending.keys() - set(generated):
+                pending[index] = links_in[index].custom_alias
+
+            taken = await session.exec(
+                select(Link.short_code).where(
+                    Link.short_code.in_(pending.values())  # type: ignore
+                )
+            )
+            indexes = {short_code: index for index, short_code in pending.items()}
+            for short_code in taken.all():
+                index = indexes[short_code]
+                if links_in[index].custom_alias:
+                    results[index] = (None, "Custom alias already exists")
+                    del pending[index]
+                else:
+                    logger.warning("Generated short code %s is taken", short_code)
+                    pending[index] = None
+            if None in pending.values():
+                continue
+
+            rows = [
+                Link(
+                    short_code=short_code,
+                    original_url=quote_url(str(links_in[index].original_url)),
+                    url_hash=url_hash(str(links_in[index].original_url)),
+                    user_id=user_id,
+                    created_at=now,
+                    expires_at=links_in[index].expires_at,
+                ).model_dump(exclude={"id"})
+                for index, short_code in pending.items()
+            ]
+            try:
+                created = await session.exec(  # type: ignore
+                    insert(Link).returning(Link), params=rows
+                )
+                created = {link.short_code: link for link in created.scalars()}
+                await session.commit()
+            except IntegrityError:
+                # Someone took one of the codes since the check, check again
+                await session.rollback()
+                continue
+
+            for index, short_code in pending.items():
+                results[index] = (created[short_code], None)
+            await self.invalidate_cached(list(created))
+            await self.schedule_expiry(list(created.values()))
+            pending = {}
+
+        for index in pending:
+            results[index] = (None, "Could not generate a short code")
+        return results
+
+    async def _generate_short_codes(self, count: int) -> List[str]:
+        if not count:
+            return []
+        if self.config.short_code_mode == "sequence":
+            return await self.short_codes.generate(count)
+        # Checked against the DB together with custom aliases
+        return [
+            _generate_random_string(self.config.short_code_length) for _ in range(count)
+        ]
+
     async def generate_unique_short_code(
-        self, session: Session, length: int = 6
+        self, session: AsyncSession, length: Optional[int] = None
     ) -> str:
+        if self.config.short_code_mode == "sequence":
+            return (await self.short_codes.generate())[0]
+
         while True:
-            short_code = _generate_random_string(length)
-            existing = await self.get_link_by_short_code(session, short_code)
+            short_code = _generate_random_string(
+                length or self.config.short_code_length
+            )
+            existing = await self._find_link(session, short_code)
             if not existing:
                 return short_code
 
-    async def get_link_by_short_code(
-        self, session: Session, short_code: str
+    async def _find_link(
+        self, session: AsyncSession, short_code: str
     ) -> Optional[Link]:
-        cached = await self.redis.get(f"link:{short_code}")
-        if cached:
-            return Link.model_validate_json(cached)
-        return session.exec(select(Link).where(Link.short_code == short_code)).first()
+        result = await session.exec(select(Link).where(Link.short_code == short_code))
+        return result.first()
+
+    async def get_link_by_short_code(
+        self, session: AsyncSession, short_code: str
+    ) -> Optional[CachedLink]:
+        """
+        Resolves a link for redirects: local cache, then redis, then the DB.
+        Misses are cached as tombstones for negative_cache_ttl_seconds.
+        Cached links are shared and immutable, use _find_link to modify a link
+        """
+        found, link = await self.get_cached_link(short_code)
+        if found:
+            return link
+        return await self.load_link(session, short_code)
+
+    async def get_cached_link(
+        self, short_code: str
+    ) -> Tuple[bool, Optional[CachedLink]]:
+        """The local cache and redis part of get_link_by_short_code, no DB"""
+        found, link = self.local_cache.links.get(short_code)
+        if found:
+            LINK_CACHE_LOOKUPS.inc("hit")
+            LINK_LOOKUPS.inc("local" if link else "not_found")
+            return True, link
+
+        found, link = await self._get_redis_link(short_code)
+        LINK_CACHE_LOOKUPS.inc("hit" if found else "miss")
+        if found:
+            LINK_LOOKUPS.inc("redis" if link else "not_found")
+        return found, link
+
+    async def _get_redis_link(
+        self, short_code: str
+    ) -> Tuple[bool, Optional[CachedLink]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await pipe.get(f"link:{short_code}")
+            await pipe.pttl(f"link:{short_code}")
+            cached, ttl_ms = await pipe.execute()
+        if cached == LINK_TOMBSTONE:
+            self._cache_missing_locally(short_code)
+            return True, None
+        link = decode_link(short_code, cached) if cached else None
+        if link:
+            self._cache_locally(link)
+            if self._should_refresh(link, ttl_ms / 1000):
+                self._refresh_in_background(short_code)
+            return True, link
+        return False, None
+
+    def _should_refresh(self, link: CachedLink, ttl_seconds: float) -> bool:
+        """
+        Probabilistic early expiration (XFetch): the closer the entry is to its
+        TTL, the likelier a lookup reloads it, so popular links are reloaded
+        before they expire and rarely visited ones are left to expire
+        """
+        window = self.config.cache_refresh_ahead_seconds
+        if window <= 0 or ttl_seconds < 0:
+            return False
+        # A reload would not extend an entry capped by the link expiration
+        if link.expires_at and (
+            (link.expires_at - datetime.now()).total_seconds() <= ttl_seconds + 1
+        ):
+            return False
+        return -window * math.log(1 - random.random()) >= ttl_seconds
+
+    def _refresh_in_background(self, short_code: str):
+        refreshing = self.local_cache.refreshing
+        if short_code in refreshing or short_code in self.local_cache.loading:
+            return
+        task = asyncio.create_task(self._refresh(short_code))
+        refreshing[short_code] = task
+        task.add_done_callback(lambda _: refreshing.pop(short_code, None))
+
+    async def _refresh(self, short_code: str):
+        try:
+            async with create_session(self.engine) as session:
+                await self._load_link_shared(session, short_code)
+        except Exception:
+            logger.exception("Failed to refresh cached link %s", short_code)
+
+    async def load_link(
+        self, session: AsyncSession, short_code: str
+    ) -> Optional[CachedLink]:
+        """The DB part of get_link_by_short_code, caches what it finds"""
+        link = await self._load_link_shared(session, short_code)
+        LINK_LOOKUPS.inc("db" if link else "not_found")
+        return link
+
+    async def _load_link_shared(
+        self, session: AsyncSession, short_code: str
+    ) -> Optional[CachedLink]:
+        """
+        Concurrent misses of a short code in a worker wait for the first one,
+        across workers too with single_flight_redis_lock. A waiter gives up
+        after single_flight_timeout_seconds and queries the DB itself
+        """
+        timeout = self.config.single_flight_timeout_seconds
+        loading = self.local_cache.loading.get(short_code)
+        if loading:
+            try:
+                loaded, link = await asyncio.wait_for(asyncio.shield(loading), timeout)
+                if loaded:
+                    return link
+            except asyncio.TimeoutError:
+                logger.warning("Timed out waiting for link %s to load", short_code)
+            return await self._load_link(session, short_code)
+
+        loading = asyncio.get_running_loop().create_future()
+        self.local_cache.loading[short_code] = loading
+        try:
+            link = await self._load_link_once(session, short_code)
+            loading.set_result((True, link))
+            return link
+        finally:
+            # Waiters load the link themselves if this load has failed
+            if not loading.done():
+                loading.set_result((False, None))
+            del self.local_cache.loading[short_code]
+
+    async def _load_link_once(
+        self, session: AsyncSession, short_code: str
+    ) -> Optional[CachedLink]:
+        if not self.config.single_flight_redis_lock:
+            return await self._load_link(session, short_code)
+
+        lock = LINK_LOCK_KEY.format(short_code=short_code)
+        timeout = self.config.single_flight_timeout_seconds
+        token = secrets.token_hex(8)
+        if await self.redis.set(lock, token, nx=True, px=int(timeout * 1000)):
+            try:
+                return await self._load_link(session, short_code)
+            finally:
+                await self._release_lock(keys=[lock], args=[token])
+
+        # Another worker is loading it, wait for it to fill the cache
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+            found, link = await self._get_redis_link(short_code)
+            if found:
+                return link
+            # Finished without caching, e.g. an expired link
+            if not await self.redis.exists(lock):
+                break
+        return await self._load_link(session, short_code)
+
+    async def _load_link(
+        self, session: AsyncSession, short_code: str
+    ) -> Optional[CachedLink]:
+        generation_key = LINK_GENERATION_KEY.format(short_code=short_code)
+        generation = await self.redis.get(generation_key) or ""
+        found = await self._find_link(session, short_code)
+        if not found:
+            ttl_ms = int(self.config.negative_cache_ttl_seconds * 1000)
+            if await self._cache_loaded(
+                keys=[f"link:{short_code}", generation_key],
+                args=[generation, LINK_TOMBSTONE, ttl_ms],
+            ):
+                self._cache_missing_locally(short_code)
+            return None
 
-    async def delete_link(self, session: Session, user: User, short_code: str) -> None:
-        link = await self.get_link_by_short_code(session, short_code)
+        link = CachedLink.from_link(found)
+        ttl = link_cache_ttl(
+            link, self.config.cache_ttl_hours, self.config.cache_ttl_jitter
+        )
+        if ttl and await self._cache_loaded(
+            keys=[f"link:{short_code}", generation_key],
+            args=[generation, encode_link(link), int(ttl.total_seconds() * 1000)],
+        ):
+            self._cache_locally(link)
+        return link
+
+    def _cache_locally(self, link: CachedLink):
+        ttl = link_cache_ttl(link, self.config.cache_ttl_hours)
+        if ttl:
+            self.local_cache.links.set(
+                link.short_code,
+                link,
+                ttl_seconds=min(
+                    self.local_cache.links.ttl_seconds, ttl.total_seconds()
+                ),
+            )
+
+    def _cache_missing_locally(self, short_code: str):
+        self.local_cache.links.set(
+            short_code, None, ttl_seconds=self.config.negative_cache_ttl_seconds
+        )
+
+    async def _get_owned_link(
+        self, session: AsyncSession, user: User, short_code: str
+    ) -> Link:
+        link = await self._find_link(session, short_code)
         if not link:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="Link not found"
@@ -87,67 +492,220 @@ class LinkService:
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You dont have access to that link",
             )
+        return link
+
+    async def invalidate_cached(self, short_codes: List[str]):
+        # One round trip, but no single huge DEL blocking redis
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for short_code in short_codes:
+                generation_key = LINK_GENERATION_KEY.format(short_code=short_code)
+                await pipe.incrby(generation_key, 1)
+                await pipe.expire(generation_key, LINK_GENERATION_TTL_SECONDS)
+                await pipe.delete(f"link:{short_code}")
+            await self.local_cache.publish_invalidation(pipe, short_codes)
+            await pipe.execute()
+
+    async def schedule_expiry(self, links: List[Link]):
+        deadlines = {
+            link.short_code: link.expires_at.timestamp()
+            for link in links
+            if link.expires_at
+        }
+        if deadlines:
+            await self.redis.zadd(EXPIRY_KEY, deadlines)
+
+    async def delete_link(
+        self, session: AsyncSession, user: User, short_code: str
+    ) -> None:
+        link = await self._get_owned_link(session, user, short_code)
         await self.batch_delete([link], session)
 
-    async def batch_delete(self, links: List[Link], session: Session):
-        await self.redis.delete(*[f"link:{link.short_code}" for link in links])
+    async def batch_delete(self, links: List[Link], session: AsyncSession):
         for link in links:
-            session.delete(link)
-        session.commit()
+            await session.delete(link)
+        await session.commit()
+        short_codes = [link.short_code for link in links]
+        await self.invalidate_cached(short_codes)
+        await self.redis.zrem(EXPIRY_KEY, *short_codes)
 
     async def update_link(
         self,
-        session: Session,
+        session: AsyncSession,
         user: User,
         short_code: str,
         new_url: str,
     ) -> Link:
-        link = await self.get_link_by_short_code(session, short_code)
-        if not link:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Link not found",
-            )
-        if link.user_id != user.id:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="You dont have access to that link",
-            )
-        await self.redis.delete(f"link:{short_code}")
+        link = await self._get_owned_link(session, user, short_code)
         link.original_url = new_url
+        link.url_hash = url_hash(new_url)
         session.add(link)
-        session.commit()
-        session.refresh(link)
+        await session.commit()
+        await session.refresh(link)
+        await self.invalidate_cached([short_code])
         return link
 
-    def update_visit(self, session: Session, link: Link) -> None:
-        link.visits += 1
-        link.last_visit = datetime.now()
-        session.add(link)
-        session.commit()
+    async def record_visit(
+        self, link: Link | CachedLink, click: Optional[Dict[str, str]] = None
+    ) -> None:
+        """Appends the click event, see ClickService, in the same round trip"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await pipe.hincrby(VISITS_COUNT_KEY, link.short_code, 1)
+            await pipe.hset(
+                VISITS_LAST_KEY, link.short_code, datetime.now().isoformat()
+            )
+            if click:
+                await append_click(pipe, self.config, click)
+            await pipe.execute()
+
+    async def get_pending_visits(
+        self, short_code: str
+    ) -> Tuple[int, Optional[datetime]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            await pipe.hget(VISITS_COUNT_KEY, short_code)
+            await pipe.hget(VISITS_LAST_KEY, short_code)
+            count, last_visit = await pipe.execute()
+        return (
+            int(count) if count else 0,
+            datetime.fromisoformat(last_visit) if last_visit else None,
+        )
 
-    async def get_stats(self, session: Session, short_code: str) -> Link:
-        link = await self.get_link_by_short_code(session, short_code)
+    async def get_stats(self, session: AsyncSession, short_code: str) -> Link:
+        link = await self._find_link(session, short_code)
         if not link:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="Link not found"
             )
+        # Merge visits which are not flushed to the DB yet
+        pending_visits, pending_last_visit = await self.get_pending_visits(short_code)
+        link.visits += pending_visits
+        if pending_last_visit and (
+            not link.last_visit or link.last_visit < pending_last_visit
+        ):
+            link.last_visit = pending_last_visit
         return link
 
-    def search_by_original_url(
-        self, session: Session, user: User, original_url: str
-    ) -> List[Link]:
-        return list(
-            session.exec(
-                select(Link).where(
-                    (Link.original_url == original_url) & (Link.user_id == user.id)
-                )
+    async def search_links(
+        self,
+        session: AsyncSession,
+        user: User,
+        query: str,
+        mode: LinkSearchMode = "exact",
+        limit: int = 50,
+        cursor: Optional[int] = None,
+    ) -> Tuple[List[Link], Optional[int]]:
+        """
+        Finds links of the user by URL, ordered by id. Returns at most `limit`
+        links and the cursor of the next page, None on the last page.
+        Candidates are read from the index page by page and confirmed here
+        """
+        branches, matches = _search_conditions(session, query, mode)
+        links: List[Link] = []
+        last_id = cursor or 0
+        while True:
+            candidates = (
+                await session.exec(_search_statement(user, branches, last_id, limit))
             ).all()
+            for link in candidates:
+                if matches(link.original_url):
+                    links.append(link)
+                    if len(links) == limit:
+                        return links, link.id
+            if len(candidates) < limit:
+                return links, None
+            last_id = candidates[-1].id
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _contains(session: AsyncSession, needle: str, pattern: str) -> list:
+    conditions = [Link.original_url.ilike(pattern, escape="\\")]  # type: ignore
+    # FTS5 trigrams need at least 3 characters, shorter needles scan the user's links
+    if session.bind.dialect.name == "sqlite" and len(needle) >= 3:
+        phrase = '"' + needle.replace('"', '""') + '"'
+        conditions.append(
+            Link.id.in_(  # type: ignore
+                select(literal_column("rowid"))
+                .select_from(table(URL_SEARCH_TABLE))
+                .where(
+                    text(f"{URL_SEARCH_TABLE} MATCH :phrase").bindparams(phrase=phrase)
+                )
+            )
         )
+    return conditions
+
+
+def _search_conditions(
+    session: AsyncSession, query: str, mode: LinkSearchMode
+) -> Tuple[List[list], Callable[[str], bool]]:
+    """Index conditions of the candidates, one list per UNION ALL branch"""
+    if mode == "exact":
+        target = normalize_url(query)
+        # UNION ALL, since with OR sqlite uses only the user_id part of the index
+        # Links not backfilled yet have no hash, and are compared too
+        return [
+            [Link.url_hash == url_hash(query)],
+            [Link.url_hash.is_(None)],  # type: ignore
+        ], lambda url: normalize_url(url) == target
+
+    if mode == "domain":
+        hostname = urlsplit(query).hostname if "://" in query else query
+        host = (hostname or "").strip("/.").lower()
+        if not host:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="No domain to search for",
+            )
+
+        def on_host(url: str) -> bool:
+            hostname = urlsplit(url).hostname or ""
+            return hostname == host or hostname.endswith("." + host)
+
+        return [_contains(session, host, f"%{_escape_like(host)}%")], on_host
+
+    needle = query.lower()
+    if mode == "prefix":
+        pattern = f"{_escape_like(query)}%"
+        return [_contains(session, query, pattern)], lambda url: url.lower().startswith(
+            needle
+        )
+    pattern = f"%{_escape_like(query)}%"
+    return [_contains(session, query, pattern)], lambda url: needle in url.lower()
+
+
+def _search_statement(user: User, branches: List[list], after_id: int, limit: int):
+    def candidates(conditions: list):
+        return (
+            select(Link.id)
+            .where(Link.user_id == user.id, Link.id > after_id, *conditions)
+            .order_by(Link.id)  # type: ignore
+            .limit(limit)
+        )
+
+    if len(branches) == 1:
+        ids = candidates(branches[0])
+    else:
+        # Subqueries, as sqlite does not allow LIMIT in UNION ALL parts
+        subqueries = [candidates(conditions).subquery() for conditions in branches]
+        ids = union_all(*[select(subquery.c.id) for subquery in subqueries])
+    return select(Link).where(Link.id.in_(ids)).order_by(Link.id).limit(limit)  # type: ignore
 
 
-def get_service(config: ConfigDep, redis: RedisDep) -> LinkService:
-    return LinkService(config=config, redis=redis)
+def get_service(
+    config: ConfigDep,
+    redis: RedisDep,
+    local_cache: LocalCacheServiceDep,
+    short_codes: ShortCodeServiceDep,
+    engine: EngineDep,
+) -> LinkService:
+    return LinkService(
+        config=config,
+        redis=redis,
+        local_cache=local_cache,
+        short_codes=short_codes,
+        engine=engine,
+    )
 
 
 LinkServiceDep = Annotated[LinkService, Depends(get_service)]
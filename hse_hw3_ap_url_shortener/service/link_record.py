@@ -0,0 +1,63 @@
+import base64
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+
+# "<version>|<expires_at timestamp or empty>|<user_id>|<original_url>",
+# version RECORD_ZLIB means original_url is zlib compressed and base64 encoded
+RECORD_PLAIN = "1"
+RECORD_ZLIB = "1z"
+# Shorter URLs hardly ever get shorter compressed and base64 encoded
+COMPRESS_MIN_LENGTH = 256
+
+
+@dataclass(frozen=True, slots=True)
+class CachedLink:
+    """What a redirect needs from a link, cached in place of the whole row"""
+
+    short_code: str
+    original_url: str
+    expires_at: Optional[datetime]
+    user_id: int
+
+    @classmethod
+    def from_link(cls, link: Link) -> "CachedLink":
+        return cls(
+            short_code=link.short_code,
+            original_url=link.original_url,
+            expires_at=link.expires_at,
+            user_id=link.user_id,
+        )
+
+
+def encode_link(link: Link | CachedLink) -> str:
+    version, url = RECORD_PLAIN, link.original_url
+    if len(url) >= COMPRESS_MIN_LENGTH:
+        compressed = base64.b64encode(zlib.compress(url.encode())).decode()
+        if len(compressed) < len(url):
+            version, url = RECORD_ZLIB, compressed
+    expires_at = repr(link.expires_at.timestamp()) if link.expires_at else ""
+    return f"{version}|{expires_at}|{link.user_id}|{url}"
+
+
+def decode_link(short_code: str, record: str) -> Optional[CachedLink]:
+    """Returns None for records of an unknown format, they are treated as misses"""
+    if record.startswith("{"):
+        # Full Link JSON, cached before records were introduced
+        return CachedLink.from_link(Link.model_validate_json(record))
+
+    fields = record.split("|", 3)
+    if len(fields) != 4 or fields[0] not in (RECORD_PLAIN, RECORD_ZLIB):
+        return None
+    version, expires_at, user_id, url = fields
+    if version == RECORD_ZLIB:
+        url = zlib.decompress(base64.b64decode(url)).decode()
+    return CachedLink(
+        short_code=short_code,
+        original_url=url,
+        expires_at=datetime.fromtimestamp(float(expires_at)) if expires_at else None,
+        user_id=int(user_id),
+    )
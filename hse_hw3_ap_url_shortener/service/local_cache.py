@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Annotated, Any, Dict, Generic, Iterable, Optional, Tuple, TypeVar
+
+from fastapi import Depends
+from redis.asyncio import Redis
+
+from hse_hw3_ap_url_shortener.model.model import LocalCacheStatsOut
+from hse_hw3_ap_url_shortener.service.link_record import CachedLink
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+# Every worker drops short codes published here from its local cache
+LINK_INVALIDATION_CHANNEL = "link:invalidate"
+# And emails of users published here from its principal cache
+USER_INVALIDATION_CHANNEL = "user:invalidate"
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """Bounded in-process LRU cache with a TTL per entry. Not thread-safe"""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[Any, Tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key) -> Tuple[bool, Optional[V]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def set(self, key, value: V, ttl_seconds: Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class LocalCacheService:
+    def __init__(self, config: Config):
+        self.config = config
+        # None is cached for short codes which do not exist
+        self.links: LRUCache[Optional[CachedLink]] = LRUCache(
+            max_size=config.local_cache_size,
+            ttl_seconds=config.local_cache_ttl_seconds,
+        )
+        # Verified access tokens by token, and their users by email (JWT sub)
+        self.tokens: LRUCache[str] = LRUCache(
+            max_size=config.principal_cache_size,
+            ttl_seconds=config.principal_cache_ttl_seconds,
+        )
+        # Column values of the users but the password hash, see get_current_user
+        self.principals: LRUCache[Dict[str, Any]] = LRUCache(
+            max_size=config.principal_cache_size,
+            ttl_seconds=config.principal_cache_ttl_seconds,
+        )
+        # Links being loaded from the DB, resolve to (loaded, link)
+        self.loading: Dict[str, asyncio.Future] = {}
+        # Background reloads of cached links about to expire
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    def invalidate_links(self, short_codes: Iterable[str]):
+        self.links.invalidate(*short_codes)
+
+    async def publish_invalidation(self, redis: Redis, short_codes: Iterable[str]):
+        short_codes = list(short_codes)
+        self.invalidate_links(short_codes)
+        await redis.publish(LINK_INVALIDATION_CHANNEL, json.dumps(short_codes))
+
+    def invalidate_users(self, emails: Iterable[str]):
+        self.principals.invalidate(*emails)
+
+    async def publish_user_invalidation(self, redis: Redis, emails: Iterable[str]):
+        emails = list(emails)
+        self.invalidate_users(emails)
+        await redis.publish(USER_INVALIDATION_CHANNEL, json.dumps(emails))
+
+    def clear(self):
+        self.links.clear()
+        self.tokens.clear()
+        self.principals.clear()
+
+    def handle_invalidation(self, message: dict):
+        if not message or message["type"] != "message":
+            return
+        if message["channel"] == USER_INVALIDATION_CHANNEL:
+            self.invalidate_users(json.loads(message["data"]))
+        else:
+            self.invalidate_links(json.loads(message["data"]))
+
+    async def _listen(self, redis: Redis):
+        while True:
+            try:
+                async with redis.pubsub() as pubsub:
+                    await pubsub.subscribe(
+                        LINK_INVALIDATION_CHANNEL, USER_INVALIDATION_CHANNEL
+                    )
+                    # Anything could have changed while we were not subscribed
+                    self.clear()
+                    while True:
+                        self.handle_invalidation(
+                            await pubsub.get_message(
+                                ignore_subscribe_messages=True, timeout=1.0
+                            )
+                        )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Link invalidation listener failed, resubscribing")
+                self.clear()
+                await asyncio.sleep(1)
+
+    def start_listener(self, redis: Redis):
+        if not self._listener:
+            self._listener = asyncio.create_task(self._listen(redis))
+
+    async def stop_listener(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    def get_stats(self) -> LocalCacheStatsOut:
+        return LocalCacheStatsOut(
+            size=len(self.links),
+            max_size=self.links.max_size,
+            hits=self.links.hits,
+            misses=self.links.misses,
+            evictions=self.links.evictions,
+        )
+
+
+_service = None
+
+
+def get_service(config: ConfigDep) -> LocalCacheService:
+    global _service
+    if not _service:
+        _service = LocalCacheService(config=config)
+    return _service
+
+
+LocalCacheServiceDep = Annotated[LocalCacheService, Depends(get_service)]
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from typing import Annotated, Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, status
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from hse_hw3_ap_url_shortener.db import RedisDep
+from hse_hw3_ap_url_shortener.metrics import (
+    REGISTRY,
+    Labels,
+    Metric,
+    Registry,
+    SampleKey,
+)
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+# Hash of metric totals of all workers, by sample encoded as in Registry.take
+METRICS_KEY = "metrics"
+
+
+class MetricsService:
+    """
+    Adds what this worker has recorded to the totals in redis every
+    metrics_flush_interval_seconds, so that any worker answers /metrics for
+    all of them. While redis is down the deltas stay in the worker
+    """
+
+    def __init__(self, config: Config, redis: Redis, registry: Registry = REGISTRY):
+        self.config = config
+        self.redis = redis
+        self.registry = registry
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def flush(self) -> int:
+        samples = self.registry.take()
+        if not samples:
+            return 0
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for field, value in samples.items():
+                    await pipe.hincrbyfloat(METRICS_KEY, field, value)
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Could not flush metrics, keeping them until next time")
+            self.registry.restore(samples)
+            raise
+        return len(samples)
+
+    async def collect(self) -> str:
+        """All workers' metrics, up to the last flush of the others"""
+        try:
+            await self.flush()
+            totals = await self.redis.hgetall(METRICS_KEY)
+        except RedisError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Metrics are unavailable",
+            )
+        return self.registry.render(totals)
+
+    async def get_totals(self, metric: Metric) -> Dict[Tuple[Labels, SampleKey], float]:
+        """Totals of one metric, up to the last flush of the other workers"""
+        await self.flush()
+        return self.registry.totals(metric, await self.redis.hgetall(METRICS_KEY))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.config.metrics_flush_interval_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Metrics flush failed")
+
+    def start_flusher(self):
+        if not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop_flusher(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        try:
+            await self.flush()
+        except RedisError:
+            logger.warning("Metrics recorded since the last flush are lost")
+
+
+_service = None
+
+
+def get_service(config: ConfigDep, redis: RedisDep) -> MetricsService:
+    global _service
+    if not _service:
+        _service = MetricsService(config=config, redis=redis)
+    return _service
+
+
+MetricsServiceDep = Annotated[MetricsService, Depends(get_service)]
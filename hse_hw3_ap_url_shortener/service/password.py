@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Annotated, Optional, Tuple
+
+from fastapi import Depends, HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache()
+def _context(rounds: int) -> CryptContext:
+    # Hashes with any other cost factor are reported by verify_and_update
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+def _hash(password: str, rounds: int) -> str:
+    return _context(rounds).hash(password)
+
+
+def _verify_and_update(
+    password: str, hashed_password: str, rounds: int
+) -> Tuple[bool, Optional[str]]:
+    return _context(rounds).verify_and_update(password, hashed_password)
+
+
+class PasswordService:
+    """
+    Hashes passwords with bcrypt in a pool of password_hash_workers processes,
+    so neither the event loop nor the threadpool are blocked. At most
+    password_hash_max_pending passwords wait for it, the rest get 503 at once
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def _run(self, function, *args):
+        if self.pending >= self.config.password_hash_max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins, try again later",
+                headers={"Retry-After": "1"},
+            )
+        if self._executor is None:
+            # Forking would copy the running event loop and its threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.config.password_hash_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, function, *args
+            )
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password, self.config.bcrypt_rounds)
+
+    async def verify_and_update(
+        self, password: str, hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+        """Returns whether the password matches, and its new hash if it is outdated"""
+        return await self._run(
+            _verify_and_update, password, hashed_password, self.config.bcrypt_rounds
+        )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_service = None
+
+
+def get_service(config: ConfigDep) -> PasswordService:
+    global _service
+    if not _service:
+        _service = PasswordService(config=config)
+    return _service
+
+
+PasswordServiceDep = Annotated[PasswordService, Depends(get_service)]
@@ -1,55 +1,189 @@
 import logging
-from datetime import datetime, timedelta
-from typing import Annotated, List
+from datetime import datetime
+from typing import Annotated, List, Optional, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import Depends
 from redis.asyncio import Redis
-from sqlalchemy import Engine
-from sqlmodel import select, Session
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
 
-from hse_hw3_ap_url_shortener.db import RedisDep, EngineDep
+from hse_hw3_ap_url_shortener.db import RedisDep, EngineDep, create_session
+from hse_hw3_ap_url_shortener.metrics import LINK_CACHE_LOOKUPS, timed_job
 from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.model.model import PopulateCacheStatsOut
+from hse_hw3_ap_url_shortener.service.hot_links import (
+    HotLinksService,
+    HotLinksServiceDep,
+)
+from hse_hw3_ap_url_shortener.service.leader import LeaderService, LeaderServiceDep
+from hse_hw3_ap_url_shortener.service.link import link_cache_ttl
+from hse_hw3_ap_url_shortener.service.link_record import encode_link
+from hse_hw3_ap_url_shortener.service.metrics import (
+    MetricsService,
+    MetricsServiceDep,
+)
 from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
 
 logger = logging.getLogger(__name__)
 
+# Too few lookups say nothing about the hit ratio
+MIN_LOOKUPS = 100
+# How the warmed set size changes per run
+GROW_FACTOR = 2
+SHRINK_FACTOR = 0.9
+# Roughly what redis spends on a key with a TTL besides its name and value
+ENTRY_OVERHEAD_BYTES = 64
+# Shrink only when the hit ratio is this much above the target
+HIT_RATIO_SLACK = 0.05
+# Runs on one worker, see LeaderService
+POPULATE_CACHE_ELECTION = "populate_cache"
+# Hash of the last run: stats, as returned by /internal/populate-cache, and
+# hits and misses, the lookup totals of all workers the next run starts from
+POPULATE_CACHE_KEY = "populate_cache"
+
 
 class PopulateCacheService:
-    def __init__(self, config: Config, redis: Redis, engine: Engine):
+    def __init__(
+        self,
+        config: Config,
+        redis: Redis,
+        engine: AsyncEngine,
+        hot_links: HotLinksService,
+        metrics: MetricsService,
+        leader: LeaderService,
+    ):
         self.scheduler = AsyncIOScheduler()
         self.config = config
         self.redis = redis
         self.engine = engine
+        self.hot_links = hot_links
+        self.metrics = metrics
+        self.leader = leader
+        self.size = config.top_links_cache_size
+        # Average size of a warmed link in the last run, None before it
+        self.entry_bytes: Optional[float] = None
+        self.last_stats: Optional[PopulateCacheStatsOut] = None
+
+    def _next_size(self, hit_ratio: Optional[float]) -> int:
+        if hit_ratio is None:
+            size = self.size
+        elif hit_ratio < self.config.cache_target_hit_ratio:
+            size = self.size * GROW_FACTOR
+        elif hit_ratio > self.config.cache_target_hit_ratio + HIT_RATIO_SLACK:
+            size = int(self.size * SHRINK_FACTOR)
+        else:
+            size = self.size
+        if self.entry_bytes:
+            budget = self.config.cache_memory_budget_mb * 1024 * 1024
+            size = min(size, int(budget / self.entry_bytes))
+        if size == self.size:
+            return size
+        return min(
+            max(size, self.config.top_links_cache_min_size),
+            self.config.top_links_cache_max_size,
+        )
+
+    async def get_last_stats(self) -> Optional[PopulateCacheStatsOut]:
+        """Stats of the last run on whichever worker was the leader"""
+        stats = await self.redis.hget(POPULATE_CACHE_KEY, "stats")
+        return PopulateCacheStatsOut.model_validate_json(stats) if stats else None
+
+    async def _adapt_size(self) -> Tuple[float, float]:
+        """
+        Picks how many links to warm from the hit ratio of link lookups of all
+        workers since the previous run, as many as fit into the memory budget
+        at the size of the links warmed last time. Returns the lookup totals
+        to start the next run from
+        """
+        totals = await self.metrics.get_totals(LINK_CACHE_LOOKUPS)
+        hits = totals.get((("hit",), None), 0)
+        misses = totals.get((("miss",), None), 0)
+        last = await self.redis.hgetall(POPULATE_CACHE_KEY)
+        last_hits = float(last.get("hits", 0))
+        last_misses = float(last.get("misses", 0))
+        # The totals are gone with redis, count from zero then
+        if hits < last_hits or misses < last_misses:
+            last_hits = last_misses = 0
+        lookups = int(hits - last_hits + misses - last_misses)
+        hit_ratio = (hits - last_hits) / lookups if lookups else None
+
+        # The previous leader may have picked it
+        if "stats" in last:
+            self.size = PopulateCacheStatsOut.model_validate_json(last["stats"]).size
+        previous_size = self.size
+        self.size = self._next_size(hit_ratio if lookups >= MIN_LOOKUPS else None)
+        self.last_stats = PopulateCacheStatsOut(
+            updated_at=datetime.now(),
+            previous_size=previous_size,
+            hit_ratio=hit_ratio,
+            lookups=lookups,
+            entry_bytes=self.entry_bytes,
+            size=self.size,
+        )
+        logger.info("Link cache size: %s", self.last_stats)
+        return hits, misses
+
+    async def _get_top_links(self) -> List[Link]:
+        limit = self.size
+        hot_codes = await self.hot_links.get_hot_short_codes(limit)
+        async with create_session(self.engine) as session:
+            if hot_codes:
+                result = await session.exec(
+                    select(Link).where(Link.short_code.in_(hot_codes))  # type: ignore
+                )
+                links = {link.short_code: link for link in result.all()}
+                return [links[code] for code in hot_codes if code in links]
 
-    def _get_top_links(self) -> List[Link]:
-        with Session(self.engine) as session:
-            result = session.exec(
-                select(Link)
-                .order_by(Link.visits.desc())  # type: ignore
-                .limit(self.config.top_links_cache_size)
+            # Nothing is tracked yet right after a deploy, use all-time visits
+            result = await session.exec(
+                select(Link).order_by(Link.visits.desc()).limit(limit)  # type: ignore
             )
             return list(result.all())
 
     async def populate_cache(self):
-        top_links = self._get_top_links()
-        logger.info("About to populate cache with links %s", top_links)
+        hits, misses = await self._adapt_size()
+        top_links = await self._get_top_links()
+        logger.info("About to populate cache with %s links", len(top_links))
 
         all_keys = [f"link:{link.short_code}" for link in top_links]
 
-        async with self.redis.pipeline(transaction=True) as pipe:
-            await pipe.delete(*all_keys)
-            for link in top_links:
-                await pipe.setex(
-                    f"link:{link.short_code}",
-                    timedelta(hours=self.config.cache_ttl_hours),
-                    link.model_dump_json(),
-                )
-            await pipe.execute()
+        entries = {}
+        for link in top_links:
+            ttl = link_cache_ttl(
+                link, self.config.cache_ttl_hours, self.config.cache_ttl_jitter
+            )
+            if ttl:
+                entries[f"link:{link.short_code}"] = (ttl, encode_link(link))
+        if entries:
+            self.entry_bytes = sum(
+                len(key) + len(value) + ENTRY_OVERHEAD_BYTES
+                for key, (_, value) in entries.items()
+            ) / len(entries)
+
+        async def queue(pipe):
+            if all_keys:
+                await pipe.delete(*all_keys)
+            for key, (ttl, value) in entries.items():
+                await pipe.setex(key, ttl, value)
+            await pipe.hset(
+                POPULATE_CACHE_KEY,
+                mapping={
+                    "stats": self.last_stats.model_dump_json(),
+                    "hits": hits,
+                    "misses": misses,
+                },
+            )
+
+        # A deposed leader must not overwrite the cache of the new one
+        await self.leader.execute_fenced(POPULATE_CACHE_ELECTION, queue)
 
     def start_scheduler(self):
         self.scheduler.add_job(
-            self.populate_cache,
+            self.leader.leader_only(
+                POPULATE_CACHE_ELECTION,
+                timed_job(POPULATE_CACHE_ELECTION, self.populate_cache),
+            ),
             "interval",
             minutes=self.config.populate_cache_interval_minutes,
             next_run_time=datetime.now(),
@@ -61,11 +195,23 @@ _service = None
 
 
 def get_service(
-    config: ConfigDep, redis: RedisDep, engine: EngineDep
+    config: ConfigDep,
+    redis: RedisDep,
+    engine: EngineDep,
+    hot_links: HotLinksServiceDep,
+    metrics: MetricsServiceDep,
+    leader: LeaderServiceDep,
 ) -> PopulateCacheService:
     global _service
     if not _service:
-        _service = PopulateCacheService(config=config, redis=redis, engine=engine)
+        _service = PopulateCacheService(
+            config=config,
+            redis=redis,
+            engine=engine,
+            hot_links=hot_links,
+            metrics=metrics,
+            leader=leader,
+        )
     return _service
 
 
@@ -0,0 +1,158 @@
+import logging
+import math
+import time
+from typing import Annotated, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request, status
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from hse_hw3_ap_url_shortener.db import RedisDep
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.service.auth import CurrentUserDep
+from hse_hw3_ap_url_shortener.service.local_cache import LRUCache
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep, RateLimit
+
+logger = logging.getLogger(__name__)
+
+# Hash of the tokens left and the time they were counted at, per route and
+# subject ("user:{id}" or "ip:{address}")
+RATE_LIMIT_KEY = "ratelimit:{route}:{subject}"
+
+# Token bucket, atomic and on redis time, so that workers share one clock.
+# KEYS[1] - bucket, ARGV - rate per second, burst, cost.
+# Returns 0 when allowed, otherwise milliseconds until it would be
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = time[1] * 1000 + math.floor(time[2] / 1000)
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = math.ceil((cost - tokens) * 1000 / rate)
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst * 1000 / rate))
+return retry_after
+"""
+
+
+def take_tokens(
+    tokens: Optional[float], ts: Optional[int], now: int, limit: RateLimit, cost: int
+) -> Tuple[float, int]:
+    """TOKEN_BUCKET_SCRIPT in python, returns the tokens left and retry after ms"""
+    tokens = limit.burst if tokens is None else tokens
+    ts = now if ts is None else ts
+    tokens = min(limit.burst, tokens + max(0, now - ts) * limit.rate / 1000)
+    if tokens >= cost:
+        return tokens - cost, 0
+    return tokens, math.ceil((cost - tokens) * 1000 / limit.rate)
+
+
+def client_address(request: Request, trusted_proxy_hops: int) -> Optional[str]:
+    """
+    The peer address, or behind trusted_proxy_hops reverse proxies the address
+    the outermost of them saw. X-Forwarded-For entries left of it come from
+    the client and can be forged
+    """
+    peer = request.client and request.client.host
+    if not trusted_proxy_hops:
+        return peer
+    forwarded = [
+        address.strip()
+        for header in request.headers.getlist("x-forwarded-for")
+        for address in header.split(",")
+        if address.strip()
+    ]
+    if not forwarded:
+        return peer
+    return forwarded[-min(trusted_proxy_hops, len(forwarded))]
+
+
+class RateLimitService:
+    """
+    Token buckets per route and user (or IP for redirects) in redis, one
+    script call per request. While redis is down every worker limits on its
+    own buckets, so a client may get up to a worker count times more
+    """
+
+    def __init__(self, config: Config, redis: Redis):
+        self.config = config
+        self.redis = redis
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+        self.local: LRUCache[Tuple[float, int]] = LRUCache(
+            max_size=config.rate_limit_local_size, ttl_seconds=math.inf
+        )
+
+    def limit_for(self, route: str, tier: Optional[str]) -> Optional[RateLimit]:
+        limits = self.config.rate_limits.get(route, {})
+        return limits.get(tier or "default") or limits.get("default")
+
+    async def _take(self, key: str, limit: RateLimit, cost: int) -> int:
+        try:
+            return int(
+                await self._script(keys=[key], args=[limit.rate, limit.burst, cost])
+            )
+        except RedisError:
+            logger.warning("Rate limiting %s in process, redis is unavailable", key)
+
+        _, bucket = self.local.get(key)
+        tokens, ts = bucket or (None, None)
+        now = int(time.time() * 1000)
+        tokens, retry_after = take_tokens(tokens, ts, now, limit, cost)
+        self.local.set(key, (tokens, now), ttl_seconds=limit.burst / limit.rate)
+        return retry_after
+
+    async def check(
+        self, route: str, subject: str, tier: Optional[str] = None, cost: int = 1
+    ):
+        """Raises 429 with Retry-After when the subject is over the route limit"""
+        limit = self.limit_for(route, tier)
+        if not self.config.rate_limit_enabled or not limit:
+            return
+        key = RATE_LIMIT_KEY.format(route=route, subject=subject)
+        retry_after = await self._take(key, limit, cost)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after / 1000))},
+            )
+
+    async def check_user(self, route: str, user: User):
+        await self.check(route, f"user:{user.id}", user.tier)
+
+    def client_address(self, request: Request) -> Optional[str]:
+        return client_address(request, self.config.trusted_proxy_hops)
+
+    async def check_client(self, route: str, client: Optional[str]):
+        await self.check(route, f"ip:{client}")
+
+
+_service = None
+
+
+def get_service(config: ConfigDep, redis: RedisDep) -> RateLimitService:
+    global _service
+    if not _service:
+        _service = RateLimitService(config=config, redis=redis)
+    return _service
+
+
+RateLimitServiceDep = Annotated[RateLimitService, Depends(get_service)]
+
+
+def user_rate_limit(route: str):
+    """Route dependency limiting the current user"""
+
+    async def check(current_user: CurrentUserDep, rate_limits: RateLimitServiceDep):
+        await rate_limits.check_user(route, current_user)
+
+    return Depends(check)
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import logging
+import string
+from typing import Annotated, List, Optional
+
+from fastapi import Depends
+from redis.asyncio import Redis
+from sqlalchemy import case, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from hse_hw3_ap_url_shortener.db import EngineDep, RedisDep, dialect_insert
+from hse_hw3_ap_url_shortener.model.dbmodel import ShortCodeSequence
+from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
+
+logger = logging.getLogger(__name__)
+
+# Last id handed out to a worker, workers take blocks of ids from it
+SEQUENCE_KEY = "short_code:sequence"
+
+# KEYS[1] - sequence, ARGV - block size, floor. Raises a sequence which is
+# behind the floor (lost or restored from an old snapshot) to it, then takes
+# a block. Returns the end of the block and 1 if the sequence was raised
+ALLOCATE_SCRIPT = """
+local raised = 0
+local current = tonumber(redis.call("GET", KEYS[1]) or "0")
+if current < tonumber(ARGV[2]) then
+    redis.call("SET", KEYS[1], ARGV[2])
+    raised = 1
+end
+return {redis.call("INCRBY", KEYS[1], ARGV[1]), raised}
+"""
+
+_sequence_table = ShortCodeSequence.__table__  # type: ignore
+
+BASE62 = string.digits + string.ascii_lowercase + string.ascii_uppercase
+
+
+def _to_base62(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 62)
+        chars.append(BASE62[digit])
+    return "".join(reversed(chars))
+
+
+def _from_base62(code: str) -> int:
+    value = 0
+    for char in code:
+        value = value * 62 + BASE62.index(char)
+    return value
+
+
+class ShortCodeScrambler:
+    """
+    Keyed bijection between ids and base62 codes of at least min_length chars.
+
+    Ids below 62^min_length get min_length chars, larger ids get longer codes.
+    Inside one length the id is permuted with a Feistel network over the next
+    power of two, cycle-walking until the result fits into 62^length values.
+    Distinct ids always produce distinct codes, and decode reverses encode.
+    """
+
+    def __init__(self, secret: bytes, min_length: int, rounds: int = 4):
+        self.secret = hashlib.blake2b(secret, digest_size=32).digest()
+        self.min_length = min_length
+        self.rounds = rounds
+
+    def _round(self, index: int, half: int, bits: int) -> int:
+        digest = hashlib.blake2b(
+            half.to_bytes(16, "big") + bytes([index]),
+            key=self.secret,
+            digest_size=16,
+        ).digest()
+        return int.from_bytes(digest, "big") & ((1 << bits) - 1)
+
+    def _feistel(self, value: int, bits: int, inverse: bool) -> int:
+        mask = (1 << bits) - 1
+        left, right = value >> bits, value & mask
+        if not inverse:
+            for index in range(self.rounds):
+                left, right = right, left ^ self._round(index, right, bits)
+        else:
+            for index in reversed(range(self.rounds)):
+                left, right = right ^ self._round(index, left, bits), left
+        return (left << bits) | right
+
+    def _permute(self, value: int, length: int, inverse: bool = False) -> int:
+        domain = 62**length
+        half_bits = ((domain - 1).bit_length() + 1) // 2
+        while True:
+            value = self._feistel(value, half_bits, inverse)
+            if value < domain:
+                return value
+
+    def encode(self, value: int) -> str:
+        length = self.min_length
+        while value >= 62**length:
+            length += 1
+        return _to_base62(self._permute(value, length), length)
+
+    def decode(self, code: str) -> int:
+        return self._permute(_from_base62(code), len(code), inverse=True)
+
+
+class ShortCodeService:
+    """
+    Hands out sequence based short codes, taking ids from redis in blocks.
+    The end of every block is stored in the DB before its ids are used, so a
+    sequence lost by redis is raised back over the ids handed out before
+    """
+
+    def __init__(self, config: Config, redis: Redis, engine: AsyncEngine):
+        self.config = config
+        self.redis = redis
+        self.engine = engine
+        self.scrambler = ShortCodeScrambler(
+            secret=(config.short_code_secret or config.secret_key).encode(),
+            min_length=config.short_code_length,
+        )
+        self._allocate = redis.register_script(ALLOCATE_SCRIPT)
+        self._lock = asyncio.Lock()
+        self._next_id = 0
+        self._block_end = 0
+        # No id below it may be handed out again, loaded from the DB at first
+        self._floor: Optional[int] = None
+
+    async def _load_floor(self) -> int:
+        async with self.engine.connect() as connection:
+            stored = await connection.scalar(
+                select(_sequence_table.c.value).where(
+                    _sequence_table.c.name == SEQUENCE_KEY
+                )
+            )
+        return max(stored or 0, self._floor or 0)
+
+    async def _store_floor(self, block_end: int):
+        async with self.engine.begin() as connection:
+            statement = dialect_insert(connection, _sequence_table).values(
+                name=SEQUENCE_KEY, value=block_end
+            )
+            await connection.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[_sequence_table.c.name],
+                    set_={
+                        "value": case(
+                            (
+                                _sequence_table.c.value < statement.excluded.value,
+                                statement.excluded.value,
+                            ),
+                            else_=_sequence_table.c.value,
+                        )
+                    },
+                )
+            )
+
+    async def _take_block(self, size: int) -> int:
+        loaded = self._floor is None
+        if loaded:
+            self._floor = await self._load_floor()
+        block_end, raised = await self._allocate(
+            keys=[SEQUENCE_KEY], args=[size, self._floor]
+        )
+        if raised and not loaded:
+            # Raised to what this worker has used, other workers went further
+            logger.warning("Short code sequence was lost, restoring it from the DB")
+            self._floor = await self._load_floor()
+            block_end, _ = await self._allocate(
+                keys=[SEQUENCE_KEY], args=[size, self._floor]
+            )
+        block_end = int(block_end)
+        await self._store_floor(block_end)
+        self._floor = block_end
+        return block_end
+
+    async def _next_ids(self, count: int) -> List[int]:
+        ids: List[int] = []
+        async with self._lock:
+            while len(ids) < count:
+                if self._next_id >= self._block_end:
+                    size = max(self.config.short_code_block_size, count - len(ids))
+                    self._block_end = await self._take_block(size)
+                    self._next_id = self._block_end - size
+                taken = min(count - len(ids), self._block_end - self._next_id)
+                ids.extend(range(self._next_id, self._next_id + taken))
+                self._next_id += taken
+        return ids
+
+    async def generate(self, count: int = 1) -> List[str]:
+        return [self.scrambler.encode(value) for value in await self._next_ids(count)]
+
+
+_service = None
+
+
+def get_service(
+    config: ConfigDep, redis: RedisDep, engine: EngineDep
+) -> ShortCodeService:
+    global _service
+    if not _service:
+        _service = ShortCodeService(config=config, redis=redis, engine=engine)
+    return _service
+
+
+ShortCodeServiceDep = Annotated[ShortCodeService, Depends(get_service)]
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import logging
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+
+logger = logging.getLogger(__name__)
+
+_link_table = Link.__table__  # type: ignore
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def quote_url(url: str) -> str:
+    return quote(url, safe="%/:=&?~#+!$,;'@()*[]")
+
+
+def normalize_url(url: str) -> str:
+    """Same string for URLs differing in scheme/host case, default port or empty path"""
+    parts = urlsplit(quote_url(url))
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    port = f":{DEFAULT_PORTS.get(scheme)}"
+    if netloc.endswith(port):
+        netloc = netloc[: -len(port)]
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, parts.fragment))
+
+
+def url_hash(url: str) -> int:
+    """Signed 64-bit hash of the normalised URL, stored in Link.url_hash"""
+    digest = hashlib.blake2b(normalize_url(url).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+async def backfill_url_hashes(engine: AsyncEngine, batch_size: int = 1000) -> int:
+    """Fills url_hash of links created before it existed, batch by batch"""
+    filled = last_id = 0
+    while True:
+        async with engine.begin() as connection:
+            rows = (
+                await connection.execute(
+                    select(_link_table.c.id, _link_table.c.original_url)
+                    .where(_link_table.c.url_hash.is_(None), _link_table.c.id > last_id)
+                    .order_by(_link_table.c.id)
+                    .limit(batch_size)
+                )
+            ).all()
+            if rows:
+                await connection.execute(
+                    update(_link_table)
+                    .where(_link_table.c.id == bindparam("row_id"))
+                    .values(url_hash=bindparam("hash")),
+                    [
+                        {"row_id": row.id, "hash": url_hash(row.original_url)}
+                        for row in rows
+                    ],
+                )
+        if not rows:
+            break
+        filled += len(rows)
+        last_id = rows[-1].id
+        logger.info("Filled url_hash of %s links", filled)
+    return filled
+
+
+async def main():
+    from hse_hw3_ap_url_shortener.db import dispose_engine, get_engine
+    from hse_hw3_ap_url_shortener.settings.config import get_config
+
+    await backfill_url_hashes(get_engine(get_config()))
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
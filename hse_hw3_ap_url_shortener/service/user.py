@@ -1,34 +1,55 @@
 from typing import Optional, Annotated
 
 from fastapi import Depends
+from redis.asyncio import Redis
 from sqlmodel import select
 
-from hse_hw3_ap_url_shortener.db import SessionDep
+from hse_hw3_ap_url_shortener.db import RedisDep, SessionDep
 from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.service.local_cache import (
+    LocalCacheService,
+    LocalCacheServiceDep,
+)
 from hse_hw3_ap_url_shortener.settings.config import Config, ConfigDep
 
 
 class UserService:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, redis: Redis, local_cache: LocalCacheService):
         self.config = config
+        self.redis = redis
+        self.local_cache = local_cache
 
-    def find_user(self, email: str, session: SessionDep) -> Optional[User]:
-        return session.exec(select(User).where(User.email == email)).one_or_none()
+    async def find_user(self, email: str, session: SessionDep) -> Optional[User]:
+        result = await session.exec(select(User).where(User.email == email))
+        return result.one_or_none()
 
-    def create_user(self, user: User, session: SessionDep) -> User:
+    async def create_user(self, user: User, session: SessionDep) -> User:
         session.add(user)
-        session.commit()
-        session.refresh(user)
+        await session.commit()
+        await session.refresh(user)
+        return user
+
+    async def update_user(
+        self, user: User, session: SessionDep, previous_email: Optional[str] = None
+    ) -> User:
+        """Saves changes of the user and drops it from principal caches"""
+        session.add(user)
+        await session.commit()
+        await session.refresh(user)
+        emails = {user.email, previous_email or user.email}
+        await self.local_cache.publish_user_invalidation(self.redis, emails)
         return user
 
 
 _service = None
 
 
-def get_service(config: ConfigDep) -> UserService:
+def get_service(
+    config: ConfigDep, redis: RedisDep, local_cache: LocalCacheServiceDep
+) -> UserService:
     global _service
     if not _service:
-        _service = UserService(config=config)
+        _service = UserService(config=config, redis=redis, local_cache=local_cache)
     return _service
 
 
@@ -1,27 +1,110 @@
 from functools import lru_cache
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, Dict, Literal
 
 from fastapi import Depends
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 
 
+class RateLimit(BaseModel):
+    """Token bucket: `rate` requests per second on average, up to `burst` at once"""
+
+    rate: float
+    burst: int
+
+
 class Config(BaseSettings):
     db_url: str
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout_seconds: float = 30
+    db_pool_recycle_seconds: int = 1800
+    db_pool_pre_ping: bool = True
 
     redis_url: str
+    redis_max_connections: int = 50
+    redis_pool_timeout_seconds: float = 5
+    redis_socket_timeout_seconds: float = 5
+    redis_health_check_interval_seconds: int = 30
 
     secret_key: str
     algo: str
     access_token_expire_minutes: int = 30
+    bcrypt_rounds: int = 12
+    password_hash_workers: int = 2
+    password_hash_max_pending: int = 32
 
-    cleanup_interval_minutes: int = 60
+    cleanup_interval_minutes: int = 24 * 60
+    cleanup_batch_size: int = 1000
+    cleanup_time_budget_seconds: float = 60
+    expiry_reaper_batch_size: int = 500
+    expiry_reaper_max_sleep_seconds: float = 5
 
-    top_links_cache_size: int = 10
+    short_code_mode: Literal["sequence", "random"] = "sequence"
+    short_code_length: int = 6
+    short_code_block_size: int = 100
+    short_code_secret: str = ""
+    max_shorten_batch_size: int = 1000
+    search_page_size: int = 50
+    search_max_page_size: int = 500
+
+    top_links_cache_size: int = 100
+    top_links_cache_min_size: int = 10
+    top_links_cache_max_size: int = 1000
+    cache_target_hit_ratio: float = 0.9
+    cache_memory_budget_mb: float = 256
     cache_ttl_hours: int = 24
-    populate_cache_interval_minutes: int = 60
+    cache_ttl_jitter: float = 0.1
+    cache_refresh_ahead_seconds: float = 300
+    populate_cache_interval_minutes: int = 5
+    leader_lease_seconds: float = 15
+
+    hot_links_capacity: int = 1000
+    hot_links_half_life_minutes: float = 10
+    hot_links_publish_interval_seconds: int = 10
+
+    local_cache_size: int = 4096
+    local_cache_ttl_seconds: float = 30
+    principal_cache_size: int = 10000
+    principal_cache_ttl_seconds: float = 60
+    negative_cache_ttl_seconds: int = 30
+    lean_redirect: bool = True
+    single_flight_timeout_seconds: float = 2
+    single_flight_redis_lock: bool = False
+
+    visit_flush_interval_seconds: int = 10
+    visit_flush_batch_size: int = 500
+
+    rate_limit_enabled: bool = True
+    # Route to user tier ("default" for users without one) to its limit,
+    # redirects are limited per IP with the "default" tier
+    rate_limits: Dict[str, Dict[str, RateLimit]] = {
+        "redirect": {"default": RateLimit(rate=20, burst=100)},
+        "shorten": {
+            "default": RateLimit(rate=1, burst=30),
+            "premium": RateLimit(rate=20, burst=300),
+        },
+        "shorten_batch": {
+            "default": RateLimit(rate=0.1, burst=5),
+            "premium": RateLimit(rate=1, burst=30),
+        },
+    }
+    rate_limit_local_size: int = 100_000
+    # Reverse proxies in front of the app, each appending to X-Forwarded-For,
+    # 0 to use the peer address as is
+    trusted_proxy_hops: int = 0
+
+    clicks_stream_max_length: int = 1_000_000
+    clicks_buffer_size: int = 10_000
+    clicks_ingest_batch_size: int = 1000
+    clicks_ingest_block_ms: int = 1000
+    clicks_claim_idle_seconds: float = 60
+    clicks_max_buckets: int = 1000
+
+    metrics_flush_interval_seconds: float = 5
 
     model_config = SettingsConfigDict(env_file=PROJECT_ROOT / ".env")
 
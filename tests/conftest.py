@@ -1,12 +1,37 @@
+import asyncio
 import os
 
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import NullPool, event
+from sqlalchemy.ext.asyncio import create_async_engine
 from starlette.testclient import TestClient
 
-from hse_hw3_ap_url_shortener.db import get_engine, create_db_and_tables, get_redis
+from hse_hw3_ap_url_shortener.db import (
+    get_engine,
+    create_db_and_tables,
+    get_redis,
+    instrument_queries,
+)
 from hse_hw3_ap_url_shortener.main import app
+from hse_hw3_ap_url_shortener.metrics import REGISTRY
 from hse_hw3_ap_url_shortener.model.model import UserLoginIn
+from hse_hw3_ap_url_shortener.service import clicks as clicks_module
+from hse_hw3_ap_url_shortener.service import hot_links as hot_links_module
+from hse_hw3_ap_url_shortener.service import leader as leader_module
+from hse_hw3_ap_url_shortener.service import local_cache as local_cache_module
+from hse_hw3_ap_url_shortener.service import metrics as metrics_module
+from hse_hw3_ap_url_shortener.service import rate_limit as rate_limit_module
+from hse_hw3_ap_url_shortener.service import short_code as short_code_module
+from hse_hw3_ap_url_shortener.service import user as user_module
+from hse_hw3_ap_url_shortener.service.clicks import ClickService
+from hse_hw3_ap_url_shortener.service.hot_links import HotLinksService
+from hse_hw3_ap_url_shortener.service.link import LinkService
+from hse_hw3_ap_url_shortener.service.leader import LeaderService
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheService
+from hse_hw3_ap_url_shortener.service.metrics import MetricsService
+from hse_hw3_ap_url_shortener.service.rate_limit import RateLimitService
+from hse_hw3_ap_url_shortener.service.short_code import ShortCodeService
+from hse_hw3_ap_url_shortener.service.user import UserService
 from hse_hw3_ap_url_shortener.settings.config import Config, PROJECT_ROOT
 from tests.endpoints.test_auth import test_register_success
 from tests.mock.redis import MockRedis
@@ -24,15 +49,29 @@ def temp_db(tmp_path_factory):
         tmp_path_factory.mktemp("hse_hw3_ap_url_shortener_test")
         / "hse_hw3_ap_url_shortener_test.db"
     )
-    engine = create_engine(
-        f"sqlite:///{path}", connect_args={"check_same_thread": False}
+    # Test client and tests run on different event loops, so no pooling here
+    engine = instrument_queries(
+        create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=NullPool)
     )
-    create_db_and_tables(engine)
+    asyncio.run(create_db_and_tables(engine))
     app.dependency_overrides[get_engine] = lambda: engine
     yield engine
+    asyncio.run(engine.dispose())
     os.remove(path)
 
 
+@pytest.fixture(scope="function")
+def db_queries(temp_db):
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(temp_db.sync_engine, "before_cursor_execute", before_cursor_execute)
+    yield queries
+    event.remove(temp_db.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
 @pytest.fixture(scope="function", autouse=True)
 def mock_redis():
     redis = MockRedis()
@@ -41,6 +80,78 @@ def mock_redis():
     del app.dependency_overrides[get_redis]
 
 
+@pytest.fixture(scope="function", autouse=True)
+def local_cache(test_config):
+    # Process-wide caches must not leak between tests
+    local_cache = LocalCacheService(test_config)
+    app.dependency_overrides[local_cache_module.get_service] = lambda: local_cache
+    yield local_cache
+    del app.dependency_overrides[local_cache_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def short_codes(test_config, mock_redis, temp_db):
+    short_codes = ShortCodeService(test_config, mock_redis, temp_db)
+    app.dependency_overrides[short_code_module.get_service] = lambda: short_codes
+    yield short_codes
+    del app.dependency_overrides[short_code_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def hot_links(test_config, mock_redis):
+    hot_links = HotLinksService(test_config, mock_redis)
+    app.dependency_overrides[hot_links_module.get_service] = lambda: hot_links
+    yield hot_links
+    del app.dependency_overrides[hot_links_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def clicks(test_config, mock_redis, temp_db):
+    clicks = ClickService(test_config, mock_redis, temp_db)
+    app.dependency_overrides[clicks_module.get_service] = lambda: clicks
+    yield clicks
+    del app.dependency_overrides[clicks_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def leader(test_config, mock_redis):
+    leader = LeaderService(test_config, mock_redis)
+    app.dependency_overrides[leader_module.get_service] = lambda: leader
+    yield leader
+    del app.dependency_overrides[leader_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def rate_limits(test_config, mock_redis):
+    rate_limits = RateLimitService(test_config, mock_redis)
+    app.dependency_overrides[rate_limit_module.get_service] = lambda: rate_limits
+    yield rate_limits
+    del app.dependency_overrides[rate_limit_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def user_service(test_config, mock_redis, local_cache):
+    user_service = UserService(test_config, mock_redis, local_cache)
+    app.dependency_overrides[user_module.get_service] = lambda: user_service
+    yield user_service
+    del app.dependency_overrides[user_module.get_service]
+
+
+@pytest.fixture(scope="function", autouse=True)
+def metrics(test_config, mock_redis):
+    # Drops what the previous tests have recorded
+    REGISTRY.take()
+    metrics = MetricsService(test_config, mock_redis)
+    app.dependency_overrides[metrics_module.get_service] = lambda: metrics
+    yield metrics
+    del app.dependency_overrides[metrics_module.get_service]
+
+
+@pytest.fixture(scope="function")
+def link_service(test_config, mock_redis, local_cache, short_codes, temp_db):
+    return LinkService(test_config, mock_redis, local_cache, short_codes, temp_db)
+
+
 @pytest.fixture(scope="session", autouse=True)
 def test_client():
     return TestClient(app)
@@ -1,4 +1,5 @@
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime, timedelta, timezone
 
 from fastapi.testclient import TestClient
 from freezegun import freeze_time
@@ -6,6 +7,7 @@ from httpx import Response
 
 from hse_hw3_ap_url_shortener.main import app
 from hse_hw3_ap_url_shortener.model.model import LinkCreateIn, LinkUpdateIn
+from hse_hw3_ap_url_shortener.settings.config import RateLimit
 
 client = TestClient(app)
 
@@ -57,12 +59,72 @@ def test_create_expired_link(authorized_token):
     assert "future" in response.json()["detail"]
 
 
-def test_redirect_success(authorized_token):
+def create_test_links(token: str, items: list) -> Response:
+    return client.post(
+        "/links/shorten/batch",
+        json=items,
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+def test_create_short_links_batch(authorized_token):
+    response = create_test_links(
+        authorized_token,
+        [{"original_url": f"https://example.com/{i}"} for i in range(50)]
+        + [{"original_url": "https://alias.com", "custom_alias": "batchalias"}],
+    )
+
+    assert response.status_code == 200
+    results = response.json()
+    assert len(results) == 51
+    assert all(result["error"] is None for result in results)
+    assert len({result["link"]["short_code"] for result in results}) == 51
+    assert results[-1]["link"]["short_code"] == "batchalias"
+
+    redirect = client.get(
+        f"/links/{results[7]['link']['short_code']}", follow_redirects=False
+    )
+    assert redirect.headers["location"] == "https://example.com/7"
+
+
+def test_create_short_links_batch_errors(authorized_token):
+    create_test_link(authorized_token, "taken")
+    response = create_test_links(
+        authorized_token,
+        [
+            {"original_url": "https://a.com", "custom_alias": "taken"},
+            {"original_url": "https://b.com", "custom_alias": "twice"},
+            {"original_url": "https://c.com", "custom_alias": "twice"},
+            {"original_url": "https://d.com", "expires_at": "2000-01-01T00:00:00"},
+            {"original_url": "https://e.com"},
+        ],
+    )
+
+    assert response.status_code == 200
+    results = response.json()
+    assert "already exists" in results[0]["error"]
+    assert results[1]["link"]["original_url"] == "https://b.com"
+    assert "already exists" in results[2]["error"]
+    assert "future" in results[3]["error"]
+    assert results[4]["link"]["original_url"] == "https://e.com"
+
+
+def test_create_short_links_batch_too_large(authorized_token, test_config):
+    response = create_test_links(
+        authorized_token,
+        [{"original_url": "https://a.com"}] * (test_config.max_shorten_batch_size + 1),
+    )
+
+    assert response.status_code == 400
+
+
+def test_redirect_success(authorized_token, hot_links):
     link = create_test_link(authorized_token).json()
 
     response = client.get(f"/links/{link['short_code']}", follow_redirects=False)
     assert response.status_code == 307
     assert response.headers["location"] == "https://example.com"
+    assert list(hot_links.tracker.counts) == [link["short_code"]]
 
 
 def test_redirect_expired_link(authorized_token):
@@ -83,6 +145,8 @@ def test_redirect_expired_link(authorized_token):
         response = client.get(f"/links/{short_code}", follow_redirects=False)
 
     assert response.status_code == 410
+    # Deleting is left to the reaper
+    assert client.get(f"/links/{short_code}/stats").status_code == 200
 
 
 def test_delete_link_success(authorized_token):
@@ -164,6 +228,104 @@ def test_search_links(authorized_token):
     assert all(link["original_url"] == "https://example.com" for link in results)
 
 
+def test_search_links_without_domain(authorized_token):
+    response = client.get(
+        "/links/search",
+        params={"original_url": "http://", "mode": "domain"},
+        headers={"Authorization": f"Bearer {authorized_token}"},
+    )
+
+    assert response.status_code == 422
+
+
+def test_search_links_pages(authorized_token):
+    create_test_links(
+        authorized_token,
+        [{"original_url": f"https://example.com/{i}"} for i in range(3)],
+    )
+    params = {"original_url": "https://example.com/", "mode": "prefix", "limit": 2}
+    headers = {"Authorization": f"Bearer {authorized_token}"}
+
+    response = client.get("/links/search", params=params, headers=headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+    params["cursor"] = response.headers["X-Next-Cursor"]
+    response = client.get("/links/search", params=params, headers=headers)
+    assert [link["original_url"] for link in response.json()] == [
+        "https://example.com/2"
+    ]
+    assert "X-Next-Cursor" not in response.headers
+
+
 def test_invalid_short_code():
     response = client.get("/links/invalid_link")
     assert response.status_code == 404
+
+
+def test_get_stats_clicks(authorized_token, clicks):
+    link = create_test_link(authorized_token).json()
+    client.get(
+        f"/links/{link['short_code']}",
+        headers={"Referer": "https://t.me/channel"},
+        follow_redirects=False,
+    )
+    asyncio.run(clicks.ingest())
+
+    response = client.get(f"/links/{link['short_code']}/stats")
+    assert response.json()["clicks"] is None
+    assert response.json()["unique_visitors"] == 1
+
+    since = datetime.now() - timedelta(days=1)
+    response = client.get(
+        f"/links/{link['short_code']}/stats",
+        params={"since": since.isoformat(), "bucket": "day"},
+    )
+    assert response.status_code == 200
+    (bucket,) = response.json()["clicks"]
+    assert bucket["clicks"] == 1
+    assert bucket["referrers"] == {"t.me": 1}
+    assert bucket["unique_visitors"] == 1
+
+    response = client.get(
+        f"/links/{link['short_code']}/stats",
+        params={"since": (since - timedelta(days=365)).isoformat()},
+    )
+    assert response.status_code == 400
+
+
+def test_get_stats_clicks_with_utc_bounds(authorized_token, clicks):
+    link = create_test_link(authorized_token).json()
+    client.get(f"/links/{link['short_code']}", follow_redirects=False)
+    asyncio.run(clicks.ingest())
+
+    now = datetime.now(timezone.utc)
+    response = client.get(
+        f"/links/{link['short_code']}/stats",
+        params={
+            "since": (now - timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "bucket": "day",
+        },
+    )
+    assert response.status_code == 200
+    assert sum(bucket["clicks"] for bucket in response.json()["clicks"]) == 1
+
+    response = client.get(
+        f"/links/{link['short_code']}/stats",
+        params={
+            "since": (now - timedelta(hours=2)).isoformat(),
+            "until": (now - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        },
+    )
+    assert response.status_code == 200
+    assert sum(bucket["clicks"] for bucket in response.json()["clicks"]) == 0
+
+
+def test_create_link_rate_limited(authorized_token, rate_limits, monkeypatch):
+    limits = {"shorten": {"default": RateLimit(rate=1, burst=1)}}
+    monkeypatch.setattr(rate_limits.config, "rate_limits", limits)
+
+    assert create_test_link(authorized_token).status_code == 201
+    response = create_test_link(authorized_token)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
@@ -0,0 +1,148 @@
+from redis.exceptions import ConnectionError
+
+from hse_hw3_ap_url_shortener.main import app, lean_redirect
+from hse_hw3_ap_url_shortener.service import link as link_module
+from hse_hw3_ap_url_shortener.service import rate_limit as rate_limit_module
+from hse_hw3_ap_url_shortener.service.rate_limit import RateLimitService
+from hse_hw3_ap_url_shortener.settings.config import RateLimit, get_config
+from tests.endpoints.test_link import client, create_test_link
+
+
+def count_link_services(monkeypatch) -> list:
+    created = []
+    init = link_module.LinkService.__init__
+
+    def counting_init(self, *args, **kwargs):
+        created.append(self)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(link_module.LinkService, "__init__", counting_init)
+    return created
+
+
+def test_cached_redirect_skips_db(authorized_token, db_queries, monkeypatch):
+    link = create_test_link(authorized_token).json()
+    created = count_link_services(monkeypatch)
+    db_queries.clear()
+
+    for _ in range(3):
+        response = client.get(f"/links/{link['short_code']}", follow_redirects=False)
+        assert response.status_code == 307
+        assert response.headers["location"] == "https://example.com"
+
+    # Dependencies are solved on the first request only
+    assert len(created) == 1
+    # Created links are not cached yet, only the first redirect reads the DB
+    assert len(db_queries) == 1
+
+
+def test_solves_again_after_overrides_change(
+    authorized_token, test_config, mock_redis, monkeypatch
+):
+    link = create_test_link(authorized_token).json()
+
+    def redirect() -> int:
+        return client.get(
+            f"/links/{link['short_code']}", follow_redirects=False
+        ).status_code
+
+    assert redirect() == 307
+
+    limits = {"redirect": {"default": RateLimit(rate=0.1, burst=1)}}
+    limited = RateLimitService(
+        test_config.model_copy(update={"rate_limits": limits}), mock_redis
+    )
+    monkeypatch.setitem(
+        app.dependency_overrides, rate_limit_module.get_service, lambda: limited
+    )
+
+    assert redirect() == 307
+    assert redirect() == 429
+
+
+def test_unknown_short_code(db_queries):
+    assert client.get("/links/unknown").status_code == 404
+    assert client.get("/links/unknown").status_code == 404
+    assert len(db_queries) == 1
+
+
+def test_fallback_when_disabled(authorized_token, monkeypatch):
+    monkeypatch.setattr(get_config(), "lean_redirect", False)
+    link = create_test_link(authorized_token).json()
+    created = count_link_services(monkeypatch)
+
+    for _ in range(2):
+        response = client.get(f"/links/{link['short_code']}", follow_redirects=False)
+        assert response.status_code == 307
+
+    # One for the lean route, then the FastAPI route makes one per request
+    assert len(created) == 3
+    assert lean_redirect._dependencies is not None
+
+
+def test_buffers_clicks_while_redis_is_down(authorized_token, mock_redis, clicks):
+    link = create_test_link(authorized_token).json()
+    client.get(f"/links/{link['short_code']}", follow_redirects=False)
+
+    async def unavailable(*args, **kwargs):
+        raise ConnectionError()
+
+    mock_redis.xadd = unavailable
+    response = client.get(f"/links/{link['short_code']}", follow_redirects=False)
+
+    # Served from the local cache, the click waits in the buffer
+    assert response.status_code == 307
+    assert [event["c"] for event in clicks.buffer] == [link["short_code"]]
+
+
+def test_redirects_are_limited_per_ip(authorized_token, rate_limits, monkeypatch):
+    limits = {"redirect": {"default": RateLimit(rate=0.1, burst=2)}}
+    monkeypatch.setattr(rate_limits.config, "rate_limits", limits)
+    link = create_test_link(authorized_token).json()
+
+    for _ in range(2):
+        response = client.get(f"/links/{link['short_code']}", follow_redirects=False)
+        assert response.status_code == 307
+    response = client.get(f"/links/{link['short_code']}", follow_redirects=False)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "10"
+
+
+def test_redirects_are_limited_per_forwarded_ip(
+    authorized_token, rate_limits, monkeypatch
+):
+    limits = {"redirect": {"default": RateLimit(rate=0.1, burst=1)}}
+    monkeypatch.setattr(rate_limits.config, "rate_limits", limits)
+    monkeypatch.setattr(rate_limits.config, "trusted_proxy_hops", 1)
+    link = create_test_link(authorized_token).json()
+
+    def redirect(forwarded: str) -> int:
+        return client.get(
+            f"/links/{link['short_code']}",
+            headers={"X-Forwarded-For": forwarded},
+            follow_redirects=False,
+        ).status_code
+
+    assert redirect("1.1.1.1") == 307
+    assert redirect("2.2.2.2") == 307
+    # A forged entry does not make it another client
+    assert redirect("6.6.6.6, 1.1.1.1") == 429
+
+
+def test_metrics(authorized_token):
+    link = create_test_link(authorized_token).json()
+    for _ in range(2):
+        client.get(f"/links/{link['short_code']}", follow_redirects=False)
+    client.get("/links/unknown")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    redirects = 'http_requests_total{method="GET",route="/links/{short_code}",'
+    assert redirects + 'status="307"} 2' in lines
+    assert redirects + 'status="404"} 1' in lines
+    # Created links are not cached yet
+    assert 'link_lookups_total{result="db"} 1' in lines
+    assert 'link_lookups_total{result="local"} 1' in lines
+    assert 'link_lookups_total{result="not_found"} 1' in lines
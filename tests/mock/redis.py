@@ -1,23 +1,57 @@
+import asyncio
 from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Union
 
+from redis.exceptions import ResponseError, WatchError
+
+from hse_hw3_ap_url_shortener.service.expiry import CLAIM_SCRIPT
+from hse_hw3_ap_url_shortener.service.flush_visits import RESTORE_SCRIPT
+from hse_hw3_ap_url_shortener.service.leader import ACQUIRE_SCRIPT, RELEASE_SCRIPT
+from hse_hw3_ap_url_shortener.service.link import CACHE_LOADED_SCRIPT
+from hse_hw3_ap_url_shortener.service.rate_limit import TOKEN_BUCKET_SCRIPT, take_tokens
+from hse_hw3_ap_url_shortener.service.short_code import ALLOCATE_SCRIPT
+from hse_hw3_ap_url_shortener.settings.config import RateLimit
+
 
 class MockRedis:
     def __init__(self):
         self.data = defaultdict(bytes)
         self.expires = defaultdict(float)
+        self.hashes = defaultdict(dict)
+        self.zsets = defaultdict(dict)
+        self.streams = defaultdict(list)
+        # (stream, group) to the last delivered id and pending ids by consumer
+        self.stream_groups = {}
+        self.published = []
+        self.subscribers = []
 
     async def get(self, key: str):
         if self.expires[key] < datetime.now().timestamp():
             await self.delete(key)
         return self.data.get(key)
 
+    async def set(self, key: str, value: str, nx: bool = False, px: int = None):
+        if nx and await self.get(key) is not None:
+            return None
+        self.data[key] = value
+        self.expires[key] = (
+            datetime.now().timestamp() + px / 1000 if px else float("inf")
+        )
+        return True
+
     async def setex(self, key: str, ttl: Union[timedelta, int], value: str):
-        self.data[key] = value.encode()
+        self.data[key] = value
         real_ttl = ttl if isinstance(ttl, timedelta) else timedelta(seconds=ttl)
         self.expires[key] = (datetime.now() + real_ttl).timestamp()
 
+    async def pttl(self, key: str):
+        if await self.get(key) is None:
+            return -2
+        if self.expires[key] == float("inf"):
+            return -1
+        return int((self.expires[key] - datetime.now().timestamp()) * 1000)
+
     async def delete(self, *keys):
         count = 0
         for key in keys:
@@ -25,13 +59,267 @@ class MockRedis:
                 del self.data[key]
                 del self.expires[key]
                 count += 1
+            if key in self.hashes:
+                del self.hashes[key]
+                count += 1
+            if key in self.zsets:
+                del self.zsets[key]
+                count += 1
         return count
 
+    async def exists(self, *keys):
+        return sum(
+            key in self.data or key in self.hashes or key in self.zsets for key in keys
+        )
+
+    async def incrby(self, key: str, amount: int = 1):
+        self.data[key] = str(int(self.data.get(key) or 0) + amount)
+        self.expires[key] = float("inf")
+        return int(self.data[key])
+
+    async def hincrby(self, name: str, key: str, amount: int = 1):
+        self.hashes[name][key] = int(self.hashes[name].get(key, 0)) + amount
+        return self.hashes[name][key]
+
+    async def hincrbyfloat(self, name: str, key: str, amount: float = 1.0):
+        self.hashes[name][key] = float(self.hashes[name].get(key, 0)) + amount
+        return str(self.hashes[name][key])
+
+    async def hset(self, name: str, key=None, value=None, mapping=None):
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        new = items.keys() - self.hashes[name].keys()
+        self.hashes[name].update({key: str(value) for key, value in items.items()})
+        return len(new)
+
+    async def hget(self, name: str, key: str):
+        value = self.hashes.get(name, {}).get(key)
+        return str(value) if value is not None else None
+
+    async def hgetall(self, name: str):
+        return {key: str(value) for key, value in self.hashes.get(name, {}).items()}
+
+    async def zadd(self, name: str, mapping: dict, nx: bool = False):
+        new = mapping.keys() - self.zsets[name].keys()
+        if nx:
+            mapping = {member: mapping[member] for member in new}
+        self.zsets[name].update(mapping)
+        return len(new)
+
+    async def zrem(self, name: str, *members):
+        zset = self.zsets.get(name, {})
+        removed = sum(zset.pop(member, None) is not None for member in members)
+        if name in self.zsets and not zset:
+            del self.zsets[name]
+        return removed
+
+    async def zscore(self, name: str, member: str):
+        return self.zsets.get(name, {}).get(member)
+
+    def _zsorted(self, name: str):
+        return sorted(self.zsets.get(name, {}).items(), key=lambda item: item[1])
+
+    async def zrange(self, name: str, start: int, end: int, withscores=False):
+        items = self._zsorted(name)[start : None if end == -1 else end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    async def zrevrange(self, name: str, start: int, end: int, withscores=False):
+        items = self._zsorted(name)[::-1][start : None if end == -1 else end + 1]
+        return items if withscores else [member for member, _ in items]
+
+    async def zremrangebyscore(self, name: str, min, max):
+        members = [
+            member
+            for member, score in self._zsorted(name)
+            if float(min) <= score <= float(max)
+        ]
+        return await self.zrem(name, *members)
+
+    async def expire(self, key: str, ttl: Union[timedelta, int]):
+        real_ttl = ttl if isinstance(ttl, timedelta) else timedelta(seconds=ttl)
+        self.expires[key] = (datetime.now() + real_ttl).timestamp()
+        return 1
+
+    async def zrangebyscore(
+        self, name: str, min, max, start=None, num=None, withscores=False
+    ):
+        low = float(min)
+        high = float(max)
+        items = [item for item in self._zsorted(name) if low <= item[1] <= high]
+        if start is not None:
+            items = items[start : start + num]
+        return items if withscores else [member for member, _ in items]
+
+    @staticmethod
+    def _stream_id(entry_id: str):
+        ms, _, seq = entry_id.partition("-")
+        return int(ms), int(seq or 0)
+
+    async def xadd(self, name: str, fields: dict, maxlen=None, approximate=True):
+        now = int(datetime.now().timestamp() * 1000)
+        stream = self.streams[name]
+        last = self._stream_id(stream[-1][0]) if stream else (0, 0)
+        entry_id = f"{now}-0" if now > last[0] else f"{last[0]}-{last[1] + 1}"
+        stream.append((entry_id, dict(fields)))
+        if maxlen is not None and len(stream) > maxlen:
+            del stream[: len(stream) - maxlen]
+        return entry_id
+
+    async def xlen(self, name: str):
+        return len(self.streams.get(name, []))
+
+    async def xgroup_create(self, name: str, groupname: str, id="$", mkstream=False):
+        if (name, groupname) in self.stream_groups:
+            raise ResponseError("BUSYGROUP Consumer Group name already exists")
+        stream = self.streams[name]
+        last = stream[-1][0] if id == "$" and stream else id
+        self.stream_groups[(name, groupname)] = {"last": last, "pending": {}}
+        return True
+
+    def _group(self, name: str, groupname: str):
+        if (name, groupname) not in self.stream_groups:
+            raise ResponseError("NOGROUP No such key or consumer group")
+        return self.stream_groups[(name, groupname)]
+
+    async def xreadgroup(
+        self, groupname: str, consumername: str, streams: dict, count=None, block=None
+    ):
+        response = []
+        for name in streams:
+            group = self._group(name, groupname)
+            last = self._stream_id(group["last"])
+            entries = [
+                entry
+                for entry in self.streams[name]
+                if self._stream_id(entry[0]) > last
+            ][:count]
+            for entry_id, _ in entries:
+                group["pending"][entry_id] = (consumername, datetime.now())
+            if entries:
+                group["last"] = entries[-1][0]
+                response.append([name, entries])
+        return response
+
+    async def xack(self, name: str, groupname: str, *ids):
+        pending = self._group(name, groupname)["pending"]
+        return sum(pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    async def xautoclaim(
+        self, name, groupname, consumername, min_idle_time, start_id="0-0", count=None
+    ):
+        pending = self._group(name, groupname)["pending"]
+        entries = dict(self.streams[name])
+        now = datetime.now()
+        claimed = []
+        for entry_id, (_, delivered) in list(pending.items())[:count]:
+            if (now - delivered).total_seconds() * 1000 >= min_idle_time:
+                pending[entry_id] = (consumername, now)
+                claimed.append((entry_id, entries.get(entry_id)))
+        return ["0-0", claimed, []]
+
+    async def publish(self, channel: str, message: str):
+        self.published.append((channel, message))
+        receivers = [sub for sub in self.subscribers if channel in sub.channels]
+        for subscriber in receivers:
+            subscriber.messages.put_nowait(
+                {"type": "message", "channel": channel, "data": message}
+            )
+        return len(receivers)
+
+    def register_script(self, script: str):
+        # Lua is not interpreted, known scripts are replayed in python
+        scripts = {
+            TOKEN_BUCKET_SCRIPT: self._token_bucket,
+            ACQUIRE_SCRIPT: self._acquire_lease,
+            RELEASE_SCRIPT: self._release_lease,
+            ALLOCATE_SCRIPT: self._allocate_block,
+            CLAIM_SCRIPT: self._claim_due,
+            RESTORE_SCRIPT: self._restore_visits,
+            CACHE_LOADED_SCRIPT: self._cache_loaded,
+        }
+
+        async def run(keys=(), args=()):
+            return await scripts[script](keys, args)
+
+        return run
+
+    async def _token_bucket(self, keys, args):
+        bucket = self.hashes.get(keys[0])
+        now = int(datetime.now().timestamp() * 1000)
+        tokens, retry_after = take_tokens(
+            float(bucket["tokens"]) if bucket else None,
+            int(bucket["ts"]) if bucket else None,
+            now,
+            RateLimit(rate=args[0], burst=args[1]),
+            args[2],
+        )
+        self.hashes[keys[0]] = {"tokens": str(tokens), "ts": str(now)}
+        return retry_after
+
+    async def _acquire_lease(self, keys, args):
+        current = await self.get(keys[0])
+        if current is not None:
+            if current.split(":")[0] != args[0]:
+                return None
+            await self.set(keys[0], current, px=args[1])
+            return current
+        value = f"{args[0]}:{await self.incrby(keys[1])}"
+        await self.set(keys[0], value, px=args[1])
+        return value
+
+    async def _claim_due(self, keys, args):
+        due = await self.zrangebyscore(
+            keys[0], "-inf", args[0], start=0, num=args[1], withscores=True
+        )
+        await self.zrem(keys[0], *[member for member, _ in due])
+        return [str(item) for pair in due for item in pair]
+
+    async def _restore_visits(self, keys, args):
+        for code, count, last in zip(args[::3], args[1::3], args[2::3]):
+            await self.hincrby(keys[0], code, int(count))
+            current = await self.hget(keys[1], code)
+            if current is None or current < last:
+                await self.hset(keys[1], code, last)
+        return len(args) // 3
+
+    async def _cache_loaded(self, keys, args):
+        if (await self.get(keys[1]) or "") != args[0]:
+            return 0
+        return int(await self.set(keys[0], args[1], px=args[2]))
+
+    async def _allocate_block(self, keys, args):
+        raised = int(await self.get(keys[0]) or 0) < args[1]
+        if raised:
+            await self.set(keys[0], str(args[1]))
+        return [await self.incrby(keys[0], args[0]), int(raised)]
+
+    async def _release_lease(self, keys, args):
+        if await self.get(keys[0]) == args[0]:
+            return await self.delete(keys[0])
+        return 0
+
+    def pubsub(self):
+        return MockPubSub(self)
+
     def pipeline(self, *args, **kwargs):
         class MockPipeline:
             def __init__(self, redis):
                 self.redis = redis
                 self.commands = []
+                # Watched keys and their values, commands run at once until multi
+                self.watched = None
+                self.immediate = False
+
+            async def watch(self, *keys):
+                self.watched = {key: self._version(key) for key in keys}
+                self.immediate = True
+
+            def multi(self):
+                self.immediate = False
+
+            def _version(self, key):
+                return self.redis.data.get(key), self.redis.expires.get(key)
 
             async def __aenter__(self):
                 return self
@@ -40,6 +328,11 @@ class MockRedis:
                 pass
 
             async def execute(self):
+                if self.watched and any(
+                    self._version(key) != version
+                    for key, version in self.watched.items()
+                ):
+                    raise WatchError()
                 results = []
                 for cmd in self.commands:
                     fn, args, kwargs = cmd
@@ -48,9 +341,35 @@ class MockRedis:
 
             def __getattr__(self, name):
                 async def wrapper(*args, **kwargs):
+                    if self.immediate:
+                        return await getattr(self.redis, name)(*args, **kwargs)
                     self.commands.append((name, args, kwargs))
                     return self
 
                 return wrapper
 
         return MockPipeline(self)
+
+
+class MockPubSub:
+    def __init__(self, redis: MockRedis):
+        self.redis = redis
+        self.channels = set()
+        self.messages = asyncio.Queue()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        if self in self.redis.subscribers:
+            self.redis.subscribers.remove(self)
+
+    async def subscribe(self, *channels):
+        self.channels.update(channels)
+        self.redis.subscribers.append(self)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import time
+from unittest.mock import AsyncMock
+
+import jwt
+import pytest
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.service.link import LinkService
+from hse_hw3_ap_url_shortener.service.local_cache import USER_INVALIDATION_CHANNEL
+from hse_hw3_ap_url_shortener.settings.config import get_config
+
+
+def whoami(test_client, token: str):
+    return test_client.get("/auth/whoami", headers={"Authorization": f"Bearer {token}"})
+
+
+def test_principal_is_cached(test_client, authorized_token, db_queries, local_cache):
+    for _ in range(3):
+        assert whoami(test_client, authorized_token).status_code == 200
+
+    assert len([query for query in db_queries if "FROM user" in query]) == 1
+    _, fields = local_cache.principals.get("sample@a.nl")
+    assert "hashed_password" not in fields
+
+
+def test_token_is_not_cached_after_expiry(
+    test_client, authorized_token, local_cache, monkeypatch
+):
+    monkeypatch.setattr(get_config(), "principal_cache_ttl_seconds", 10**9)
+    assert whoami(test_client, authorized_token).status_code == 200
+
+    expires_at, email = local_cache.tokens._entries[authorized_token]
+    assert email == "sample@a.nl"
+    token_ttl = (
+        jwt.decode(authorized_token, options={"verify_signature": False})["exp"]
+        - time.time()
+    )
+    assert expires_at == pytest.approx(time.monotonic() + token_ttl, abs=5)
+
+
+def test_principal_survives_rollback(
+    test_client, authorized_token, local_cache, monkeypatch
+):
+    headers = {"Authorization": f"Bearer {authorized_token}"}
+    shorten = {"original_url": "https://example.com", "custom_alias": "taken"}
+    assert (
+        test_client.post("/links/shorten", json=shorten, headers=headers).status_code
+        == 201
+    )
+
+    # The principal is loaded by a request which rolls back, as when the alias
+    # is taken between the check and the insert
+    local_cache.principals.clear()
+    monkeypatch.setattr(LinkService, "_find_link", AsyncMock(return_value=None))
+    response = test_client.post("/links/shorten", json=shorten, headers=headers)
+    assert response.status_code == 400
+
+    for _ in range(2):
+        response = whoami(test_client, authorized_token)
+        assert response.status_code == 200
+        assert response.json()["name"] == "sample"
+
+
+@pytest.mark.asyncio
+async def test_update_invalidates_principal(
+    test_client, authorized_token, temp_db, user_service, mock_redis
+):
+    assert whoami(test_client, authorized_token).json()["name"] == "sample"
+
+    async with create_session(temp_db) as session:
+        user = await session.get(User, 1)
+        user.name = "renamed"
+        await user_service.update_user(user, session)
+
+    assert whoami(test_client, authorized_token).json()["name"] == "renamed"
+    assert (USER_INVALIDATION_CHANNEL, json.dumps(["sample@a.nl"])) in (
+        mock_redis.published
+    )
+
+    async with create_session(temp_db) as session:
+        user = await session.get(User, 1)
+        user.email = "other@a.nl"
+        await user_service.update_user(user, session, previous_email="sample@a.nl")
+
+    assert whoami(test_client, authorized_token).status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_listener_drops_invalidated_users(mock_redis, local_cache):
+    local_cache.start_listener(mock_redis)
+    await asyncio.sleep(0.01)
+    local_cache.principals.set("other@a.nl", {"name": "other", "email": "other@a.nl"})
+    local_cache.principals.set("kept@a.nl", {"name": "kept", "email": "kept@a.nl"})
+
+    await mock_redis.publish(USER_INVALIDATION_CHANNEL, json.dumps(["other@a.nl"]))
+    await asyncio.sleep(0.01)
+    await local_cache.stop_listener()
+
+    assert local_cache.principals.get("other@a.nl") == (False, None)
+    assert local_cache.principals.get("kept@a.nl")[0]
@@ -1,15 +1,15 @@
 from datetime import datetime, timedelta
 
 import pytest
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from hse_hw3_ap_url_shortener.model.dbmodel import Link
 from hse_hw3_ap_url_shortener.service.cleanup import CleanupService
-from hse_hw3_ap_url_shortener.service.link import LinkService
 
 
-def create_test_links(engine, created_user, expired_count=1, valid_count=1):
-    with Session(engine) as session:
+async def create_test_links(engine, created_user, expired_count=1, valid_count=1):
+    async with AsyncSession(engine) as session:
         for i in range(expired_count):
             session.add(
                 Link(
@@ -30,32 +30,35 @@ def create_test_links(engine, created_user, expired_count=1, valid_count=1):
                 )
             )
 
-        session.commit()
+        await session.commit()
 
 
 @pytest.mark.asyncio
-async def test_deletes_expired_links(test_config, created_user, temp_db, mock_redis):
-    create_test_links(temp_db, created_user, expired_count=2, valid_count=1)
-    service = CleanupService(test_config, temp_db, LinkService(test_config, mock_redis))
+async def test_deletes_expired_links(
+    test_config, created_user, temp_db, mock_redis, link_service, leader
+):
+    await create_test_links(temp_db, created_user, expired_count=2, valid_count=1)
+    service = CleanupService(test_config, temp_db, link_service, leader)
 
     await service.delete_expired_links()
 
-    with Session(temp_db) as session:
-        links = session.exec(select(Link)).all()
+    async with AsyncSession(temp_db) as session:
+        links = (await session.exec(select(Link))).all()
         assert len(links) == 1
         assert all(link.short_code.startswith("valid") for link in links)
 
 
 @pytest.mark.asyncio
-async def test_removes_redis_entries(test_config, created_user, temp_db, mock_redis):
-    create_test_links(temp_db, created_user)
-    link_service = LinkService(test_config, mock_redis)
+async def test_removes_redis_entries(
+    test_config, created_user, temp_db, mock_redis, link_service, leader
+):
+    await create_test_links(temp_db, created_user)
 
-    with Session(temp_db) as session:
-        expired_link = session.exec(select(Link)).first()
+    async with AsyncSession(temp_db) as session:
+        expired_link = (await session.exec(select(Link))).first()
         await mock_redis.setex(f"link:{expired_link.short_code}", 3600, "data")
 
-    service = CleanupService(test_config, temp_db, link_service)
+    service = CleanupService(test_config, temp_db, link_service, leader)
 
     await service.delete_expired_links()
 
@@ -63,44 +66,54 @@ async def test_removes_redis_entries(test_config, created_user, temp_db, mock_re
 
 
 @pytest.mark.asyncio
-async def test_handles_no_expired_links(test_config, created_user, temp_db, mock_redis):
-    create_test_links(temp_db, created_user, expired_count=0, valid_count=3)
-    service = CleanupService(test_config, temp_db, LinkService(test_config, mock_redis))
+async def test_handles_no_expired_links(
+    test_config, created_user, temp_db, mock_redis, link_service, leader
+):
+    await create_test_links(temp_db, created_user, expired_count=0, valid_count=3)
+    service = CleanupService(test_config, temp_db, link_service, leader)
 
     await service.delete_expired_links()
 
-    with Session(temp_db) as session:
-        assert len(session.exec(select(Link)).all()) == 3
+    async with AsyncSession(temp_db) as session:
+        assert len((await session.exec(select(Link))).all()) == 3
 
 
 @pytest.mark.asyncio
-async def test_scheduler_configuration(test_config, temp_db, mock_redis):
+async def test_scheduler_configuration(
+    test_config, temp_db, mock_redis, link_service, leader
+):
     test_config.cleanup_interval_minutes = 30
-    service = CleanupService(test_config, temp_db, LinkService(test_config, mock_redis))
+    service = CleanupService(test_config, temp_db, link_service, leader)
 
     service.start_scheduler()
 
     assert len(service.scheduler.get_jobs()) == 1
     job = service.scheduler.get_jobs()[0]
     assert job.trigger.interval.total_seconds() == 30 * 60
+    # Do not let the first run outlive the test event loop
+    service.scheduler.pause()
 
 
 @pytest.mark.asyncio
-async def test_batch_deletion(test_config, created_user, temp_db, mock_redis):
-    create_test_links(temp_db, created_user, expired_count=5, valid_count=0)
-    link_service = LinkService(test_config, mock_redis)
-    service = CleanupService(test_config, temp_db, link_service)
+async def test_batch_deletion(
+    test_config, created_user, temp_db, mock_redis, link_service, leader
+):
+    await create_test_links(temp_db, created_user, expired_count=5, valid_count=0)
+    service = CleanupService(test_config, temp_db, link_service, leader)
 
     await service.delete_expired_links()
 
-    with Session(temp_db) as session:
-        assert len(session.exec(select(Link)).all()) == 0
-    assert len(mock_redis.data) == 0
+    async with AsyncSession(temp_db) as session:
+        assert len((await session.exec(select(Link))).all()) == 0
+    # Only the generations bumped by the invalidation are left
+    assert all(key.endswith(":gen") for key in mock_redis.data)
 
 
 @pytest.mark.asyncio
-async def test_partial_expiration(test_config, created_user, temp_db, mock_redis):
-    with Session(temp_db) as session:
+async def test_partial_expiration(
+    test_config, created_user, temp_db, mock_redis, link_service, leader
+):
+    async with AsyncSession(temp_db) as session:
         session.add(
             Link(
                 short_code="partial1",
@@ -117,13 +130,49 @@ async def test_partial_expiration(test_config, created_user, temp_db, mock_redis
                 user_id=created_user,
             )
         )
-        session.commit()
+        await session.commit()
 
-    service = CleanupService(test_config, temp_db, LinkService(test_config, mock_redis))
+    service = CleanupService(test_config, temp_db, link_service, leader)
 
     await service.delete_expired_links()
 
-    with Session(temp_db) as session:
-        remaining = session.exec(select(Link)).all()
+    async with AsyncSession(temp_db) as session:
+        remaining = (await session.exec(select(Link))).all()
         assert len(remaining) == 1
         assert remaining[0].short_code == "partial2"
+
+
+@pytest.mark.asyncio
+async def test_deletes_in_chunks(
+    test_config, created_user, temp_db, mock_redis, link_service, leader, db_queries
+):
+    await create_test_links(temp_db, created_user, expired_count=5, valid_count=2)
+    config = test_config.model_copy(update=dict(cleanup_batch_size=2))
+    service = CleanupService(config, temp_db, link_service, leader)
+
+    stats = await service.delete_expired_links()
+
+    assert stats.deleted == 5
+    assert stats.chunks == 3
+    assert stats.finished
+    assert service.last_stats == stats
+    assert sum(query.startswith("DELETE") for query in db_queries) == 3
+    assert not any(query.startswith("SELECT") for query in db_queries)
+    async with AsyncSession(temp_db) as session:
+        assert len((await session.exec(select(Link))).all()) == 2
+
+
+@pytest.mark.asyncio
+async def test_stops_after_time_budget(
+    test_config, created_user, temp_db, mock_redis, link_service, leader
+):
+    await create_test_links(temp_db, created_user, expired_count=3, valid_count=0)
+    config = test_config.model_copy(update=dict(cleanup_time_budget_seconds=0))
+    service = CleanupService(config, temp_db, link_service, leader)
+
+    stats = await service.delete_expired_links()
+
+    assert stats.deleted == 0
+    assert not stats.finished
+    async with AsyncSession(temp_db) as session:
+        assert len((await session.exec(select(Link))).all()) == 3
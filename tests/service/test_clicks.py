@@ -0,0 +1,187 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.service.clicks import (
+    ClickService,
+    _merge_visitors,
+    agent_class,
+    bucket_start,
+    referrer_host,
+)
+from hse_hw3_ap_url_shortener.service.link_record import CachedLink
+
+CHROME = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+)
+IPHONE = (
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) "
+    "AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148"
+)
+GOOGLEBOT = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+
+
+def test_event_fields():
+    assert referrer_host("https://News.example.com/a?b=c") == "news.example.com"
+    assert referrer_host(None) == ""
+    assert referrer_host("not a url") == ""
+    assert agent_class(CHROME) == "desktop"
+    assert agent_class(IPHONE) == "mobile"
+    assert agent_class(GOOGLEBOT) == "bot"
+    assert agent_class("curl/8.5.0") == "bot"
+    assert agent_class(None) == "other"
+
+
+async def visit(link_service, clicks, short_code: str, headers: dict, client="1.1.1.1"):
+    link = CachedLink(short_code, "https://example.com", None, 1)
+    click = clicks.click_event(short_code, headers, client)
+    await link_service.record_visit(link, click)
+
+
+async def get_clicks(clicks: ClickService, engine, bucket="hour"):
+    now = datetime.now()
+    async with create_session(engine) as session:
+        return await clicks.get_clicks(
+            session,
+            "first",
+            now - timedelta(days=1),
+            now - timedelta(days=1),
+            now + timedelta(days=1),
+            bucket,
+        )
+
+
+@pytest.mark.asyncio
+async def test_ingest_rolls_up_clicks(clicks, link_service, temp_db):
+    referred = {"referer": "https://t.me/channel", "user-agent": IPHONE}
+    await visit(link_service, clicks, "first", referred)
+    await visit(link_service, clicks, "first", referred)
+    await visit(link_service, clicks, "first", {"user-agent": CHROME})
+    await visit(link_service, clicks, "second", {"user-agent": CHROME})
+
+    assert await clicks.ingest() == 4
+    assert await clicks.ingest() == 0
+    # Later batches add up in the same buckets
+    await visit(link_service, clicks, "first", {"user-agent": CHROME})
+    assert await clicks.ingest() == 1
+
+    for bucket in ("hour", "day"):
+        (out,) = await get_clicks(clicks, temp_db, bucket)
+        assert out.start == bucket_start(datetime.now(), bucket)
+        assert out.clicks == 4
+        assert out.referrers == {"t.me": 2, "": 2}
+        assert out.agents == {"mobile": 2, "desktop": 2}
+
+
+@pytest.mark.asyncio
+async def test_publishes_buffered_clicks(clicks, temp_db):
+    clicks.buffer_click(clicks.click_event("first", {}, None))
+    clicks.buffer_click(clicks.click_event("first", {}, None))
+
+    assert await clicks.ingest() == 2
+    assert not clicks.buffer
+    (out,) = await get_clicks(clicks, temp_db)
+    assert out.clicks == 2
+    assert out.agents == {"other": 2}
+
+
+def test_buffer_drops_oldest_clicks(test_config, mock_redis, temp_db):
+    test_config = test_config.model_copy(update={"clicks_buffer_size": 2})
+    clicks = ClickService(test_config, mock_redis, temp_db)
+    for short_code in ("first", "second", "third"):
+        clicks.buffer_click(clicks.click_event(short_code, {}, None))
+
+    assert [event["c"] for event in clicks.buffer] == ["second", "third"]
+    assert clicks.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_claims_clicks_of_dead_worker(
+    test_config, clicks, link_service, mock_redis, temp_db, monkeypatch
+):
+    dead = ClickService(test_config, mock_redis, temp_db)
+    await visit(link_service, clicks, "first", {})
+    # Read, but never written and acknowledged
+    await dead._create_group()
+    assert len(await dead._read(None)) == 1
+
+    assert await clicks.ingest() == 0
+    monkeypatch.setattr(test_config, "clicks_claim_idle_seconds", 0)
+    assert await clicks.ingest() == 1
+    assert (await get_clicks(clicks, temp_db))[0].clicks == 1
+
+
+@pytest.mark.asyncio
+async def test_counts_unique_visitors(clicks, link_service, temp_db):
+    for client in ("1.1.1.1", "2.2.2.2", "1.1.1.1"):
+        await visit(link_service, clicks, "first", {"user-agent": CHROME}, client)
+    await visit(link_service, clicks, "first", {"user-agent": IPHONE}, "1.1.1.1")
+    await clicks.ingest()
+    # Sketches merge with the stored ones, repeated visitors count once
+    await visit(link_service, clicks, "first", {"user-agent": CHROME}, "2.2.2.2")
+    await visit(link_service, clicks, "first", {"user-agent": CHROME}, "3.3.3.3")
+    await clicks.ingest()
+
+    created_at = datetime.now() - timedelta(days=1)
+    async with create_session(temp_db) as session:
+        assert await clicks.get_unique_visitors(session, "first", created_at) == 4
+        assert await clicks.get_unique_visitors(session, "second", created_at) == 0
+    (out,) = await get_clicks(clicks, temp_db, "day")
+    assert out.clicks == 6
+    assert out.unique_visitors == 4
+    (out,) = await get_clicks(clicks, temp_db, "hour")
+    assert out.unique_visitors is None
+
+
+def visitor_entries(*fingerprints: int):
+    now_ms = int(time.time() * 1000)
+    return [
+        (f"{now_ms}-{index}", {"c": "first", "v": f"{fingerprint:016x}"})
+        for index, fingerprint in enumerate(fingerprints)
+    ]
+
+
+class RacingConnection:
+    """Lets another ingest store its sketches right after the first read"""
+
+    def __init__(self, connection, entries):
+        self.connection = connection
+        self.entries = entries
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    async def execute(self, statement, *args):
+        result = await self.connection.execute(statement, *args)
+        if self.entries and statement.is_select:
+            entries, self.entries = self.entries, None
+            await _merge_visitors(self.connection, entries)
+        return result
+
+
+@pytest.mark.asyncio
+async def test_merges_visitors_stored_after_the_read(clicks, temp_db):
+    first, second, third = (index << 60 for index in (1, 2, 3))
+    async with temp_db.begin() as connection:
+        racing = RacingConnection(connection, visitor_entries(first, second))
+        await _merge_visitors(racing, visitor_entries(second, third))
+
+    yesterday = datetime.now() - timedelta(days=1)
+    async with create_session(temp_db) as session:
+        assert await clicks.get_unique_visitors(session, "first", yesterday) == 3
+        ((_, daily),) = await clicks._daily_sketches(
+            session, "first", yesterday, datetime.max
+        )
+        assert daily.count() == 3
+
+
+@pytest.mark.asyncio
+async def test_reused_alias_counts_its_own_visitors(clicks, link_service, temp_db):
+    await visit(link_service, clicks, "first", {}, "1.1.1.1")
+    await clicks.ingest()
+    # The stored sketch started before the link with this alias was created
+    tomorrow = datetime.now() + timedelta(days=1)
+    async with create_session(temp_db) as session:
+        assert await clicks.get_unique_visitors(session, "first", tomorrow) == 0
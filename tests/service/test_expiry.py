@@ -0,0 +1,160 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.service.expiry import INDEXED_MARKER, ExpiryService
+from hse_hw3_ap_url_shortener.service.link import EXPIRY_KEY
+
+
+async def create_link(temp_db, link_service, created_user, alias, expires_at):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        return await link_service.create_link(
+            session, user, "https://a.com", alias, expires_at=expires_at
+        )
+
+
+async def remaining_codes(temp_db):
+    async with AsyncSession(temp_db) as session:
+        return {link.short_code for link in (await session.exec(select(Link))).all()}
+
+
+@pytest.mark.asyncio
+async def test_create_and_delete_maintain_index(
+    mock_redis, temp_db, created_user, link_service
+):
+    expires_at = datetime.now() + timedelta(hours=1)
+    await create_link(temp_db, link_service, created_user, "expiring", expires_at)
+    await create_link(temp_db, link_service, created_user, "forever", None)
+
+    assert mock_redis.zsets[EXPIRY_KEY] == {"expiring": expires_at.timestamp()}
+
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.delete_link(session, user, "expiring")
+    assert EXPIRY_KEY not in mock_redis.zsets
+
+
+@pytest.mark.asyncio
+async def test_reaps_only_due_links(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    now = datetime.now()
+    await create_link(temp_db, link_service, created_user, "due", now)
+    await create_link(
+        temp_db, link_service, created_user, "later", now + timedelta(seconds=2)
+    )
+    await mock_redis.setex("link:due", 60, "cached")
+    service = ExpiryService(test_config, mock_redis, temp_db, link_service)
+
+    delay = await service.reap_due_links()
+
+    assert await remaining_codes(temp_db) == {"later"}
+    assert list(mock_redis.zsets[EXPIRY_KEY]) == ["later"]
+    assert "link:due" not in mock_redis.data
+    assert 0 < delay <= 2
+
+
+@pytest.mark.asyncio
+async def test_rebuilds_index_from_db(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    expires_at = datetime.now() + timedelta(hours=1)
+    for i in range(3):
+        await create_link(temp_db, link_service, created_user, f"c{i}", expires_at)
+    await create_link(temp_db, link_service, created_user, "forever", None)
+    await mock_redis.delete(EXPIRY_KEY)
+    config = test_config.model_copy(update=dict(expiry_reaper_batch_size=2))
+    service = ExpiryService(config, mock_redis, temp_db, link_service)
+
+    assert await service.rebuild_index() == 3
+    assert set(mock_redis.zsets[EXPIRY_KEY]) == {"c0", "c1", "c2", INDEXED_MARKER}
+    assert await service.rebuild_index() == 0
+
+
+@pytest.mark.asyncio
+async def test_rebuilds_index_lost_later(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    expires_at = datetime.now() + timedelta(hours=1)
+    await create_link(temp_db, link_service, created_user, "old", expires_at)
+    service = ExpiryService(test_config, mock_redis, temp_db, link_service)
+    assert await service.rebuild_index() == 1
+
+    # Redis restarted, a new link recreated the set before the reaper woke up
+    await mock_redis.delete(EXPIRY_KEY)
+    await create_link(temp_db, link_service, created_user, "new", expires_at)
+    service.start_reaper()
+    await asyncio.sleep(0.1)
+    await service.stop_reaper()
+
+    assert set(mock_redis.zsets[EXPIRY_KEY]) == {"old", "new", INDEXED_MARKER}
+
+
+@pytest.mark.asyncio
+async def test_reaper_wakes_at_deadline(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    config = test_config.model_copy(update=dict(expiry_reaper_max_sleep_seconds=5))
+    service = ExpiryService(config, mock_redis, temp_db, link_service)
+    expires_at = datetime.now() + timedelta(seconds=0.3)
+    await create_link(temp_db, link_service, created_user, "soon", expires_at)
+
+    service.start_reaper()
+    await asyncio.sleep(0.6)
+    await service.stop_reaper()
+
+    assert await remaining_codes(temp_db) == set()
+
+
+@pytest.mark.asyncio
+async def test_keeps_links_extended_after_indexing(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    now = datetime.now()
+    await create_link(temp_db, link_service, created_user, "extended", now)
+    later = now + timedelta(hours=1)
+    # Extended in the DB, the index still has the old deadline
+    async with create_session(temp_db) as session:
+        link = (
+            await session.exec(select(Link).where(Link.short_code == "extended"))
+        ).one()
+        link.expires_at = later
+        await session.commit()
+    service = ExpiryService(test_config, mock_redis, temp_db, link_service)
+
+    await service.reap_due_links()
+
+    assert await remaining_codes(temp_db) == {"extended"}
+    assert mock_redis.zsets[EXPIRY_KEY] == {"extended": later.timestamp()}
+
+
+@pytest.mark.asyncio
+async def test_returns_claimed_links_on_failure(
+    test_config, mock_redis, temp_db, created_user, link_service, monkeypatch
+):
+    now = datetime.now()
+    await create_link(temp_db, link_service, created_user, "due", now)
+    await create_link(temp_db, link_service, created_user, "moved", now)
+    service = ExpiryService(test_config, mock_redis, temp_db, link_service)
+
+    class UnavailableEngine:
+        def begin(self):
+            # Another worker moves a deadline meanwhile
+            mock_redis.zsets[EXPIRY_KEY]["moved"] = now.timestamp() + 60
+            raise ConnectionError()
+
+    monkeypatch.setattr(service, "engine", UnavailableEngine())
+    with pytest.raises(ConnectionError):
+        await service.reap_due_links()
+
+    assert mock_redis.zsets[EXPIRY_KEY] == {
+        "due": now.timestamp(),
+        "moved": now.timestamp() + 60,
+    }
+    assert await remaining_codes(temp_db) == {"due", "moved"}
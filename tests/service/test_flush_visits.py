@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.service.flush_visits import FlushVisitsService
+from hse_hw3_ap_url_shortener.service.link import (
+    VISITS_COUNT_KEY,
+    VISITS_LAST_KEY,
+)
+
+
+async def create_test_links(engine, created_user, last_visit=None):
+    async with AsyncSession(engine) as session:
+        session.add_all(
+            [
+                Link(
+                    short_code="first",
+                    original_url="https://first.com",
+                    visits=3,
+                    last_visit=last_visit,
+                    user_id=created_user,
+                ),
+                Link(
+                    short_code="second",
+                    original_url="https://second.com",
+                    user_id=created_user,
+                ),
+            ]
+        )
+        await session.commit()
+
+
+async def get_link(engine, short_code: str) -> Link:
+    async with AsyncSession(engine) as session:
+        return (
+            await session.exec(select(Link).where(Link.short_code == short_code))
+        ).one()
+
+
+@pytest.mark.asyncio
+async def test_flushes_aggregated_visits(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    await create_test_links(temp_db, created_user)
+    for _ in range(5):
+        await link_service.record_visit(Link(short_code="first", original_url=""))
+    await link_service.record_visit(Link(short_code="second", original_url=""))
+
+    service = FlushVisitsService(test_config, mock_redis, temp_db)
+    assert await service.flush_visits() == 2
+
+    assert (await get_link(temp_db, "first")).visits == 8
+    assert (await get_link(temp_db, "second")).visits == 1
+    assert (await get_link(temp_db, "second")).last_visit is not None
+    assert VISITS_COUNT_KEY not in mock_redis.hashes
+    assert VISITS_LAST_KEY not in mock_redis.hashes
+
+
+@pytest.mark.asyncio
+async def test_keeps_latest_last_visit(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    future_visit = datetime.now() + timedelta(days=1)
+    await create_test_links(temp_db, created_user, last_visit=future_visit)
+    await link_service.record_visit(Link(short_code="first", original_url=""))
+
+    await FlushVisitsService(test_config, mock_redis, temp_db).flush_visits()
+
+    link = await get_link(temp_db, "first")
+    assert link.visits == 4
+    assert link.last_visit == future_visit
+
+
+@pytest.mark.asyncio
+async def test_restores_visits_keeping_newer_last_visit(
+    test_config, mock_redis, temp_db, created_user, link_service, monkeypatch
+):
+    await create_test_links(temp_db, created_user)
+    await link_service.record_visit(Link(short_code="first", original_url=""))
+    service = FlushVisitsService(test_config, mock_redis, temp_db)
+    newer = (datetime.now() + timedelta(minutes=1)).isoformat()
+
+    class UnavailableEngine:
+        def begin(self):
+            # A visit is recorded after the drain
+            mock_redis.hashes[VISITS_COUNT_KEY] = {"first": "1"}
+            mock_redis.hashes[VISITS_LAST_KEY] = {"first": newer}
+            raise ConnectionError()
+
+    monkeypatch.setattr(service, "engine", UnavailableEngine())
+    with pytest.raises(ConnectionError):
+        await service.flush_visits()
+
+    assert mock_redis.hashes[VISITS_COUNT_KEY] == {"first": 2}
+    assert mock_redis.hashes[VISITS_LAST_KEY] == {"first": newer}
+
+
+@pytest.mark.asyncio
+async def test_flushes_in_batches(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    test_config.visit_flush_batch_size = 1
+    await create_test_links(temp_db, created_user)
+    await link_service.record_visit(Link(short_code="first", original_url=""))
+    await link_service.record_visit(Link(short_code="second", original_url=""))
+
+    await FlushVisitsService(test_config, mock_redis, temp_db).flush_visits()
+
+    assert (await get_link(temp_db, "first")).visits == 4
+    assert (await get_link(temp_db, "second")).visits == 1
+
+
+@pytest.mark.asyncio
+async def test_nothing_to_flush(test_config, mock_redis, temp_db):
+    service = FlushVisitsService(test_config, mock_redis, temp_db)
+    assert await service.flush_visits() == 0
+
+
+@pytest.mark.asyncio
+async def test_stats_include_pending_visits(
+    test_config, mock_redis, temp_db, created_user, link_service
+):
+    await create_test_links(temp_db, created_user)
+    await link_service.record_visit(Link(short_code="first", original_url=""))
+
+    async with AsyncSession(temp_db) as session:
+        link = await link_service.get_stats(session, "first")
+
+    assert link.visits == 4
+    assert link.last_visit is not None
+
+
+@pytest.mark.asyncio
+async def test_scheduler_configuration(test_config, mock_redis, temp_db):
+    test_config.visit_flush_interval_seconds = 15
+    service = FlushVisitsService(test_config, mock_redis, temp_db)
+
+    service.start_scheduler()
+
+    assert len(service.scheduler.get_jobs()) == 1
+    job = service.scheduler.get_jobs()[0]
+    assert job.trigger.interval.total_seconds() == 15
+    await service.shutdown()
@@ -0,0 +1,82 @@
+import random
+import time
+
+import pytest
+from freezegun import freeze_time
+
+from hse_hw3_ap_url_shortener.service.hot_links import (
+    HOT_WORKERS_KEY,
+    HotLinksService,
+    SpaceSaving,
+)
+
+
+def test_space_saving_keeps_heavy_hitters():
+    tracker = SpaceSaving(capacity=20)
+    stream = [f"heavy{i}" for i in range(5) for _ in range(200)]
+    stream += [f"rare{i}" for i in range(2000)]
+    random.Random(42).shuffle(stream)
+
+    for key in stream:
+        tracker.add(key)
+
+    assert len(tracker) == 20
+    assert {key for key, _ in tracker.top(5)} == {f"heavy{i}" for i in range(5)}
+    # Counts are never underestimated
+    assert all(count >= 200 for _, count in tracker.top(5))
+
+
+def test_space_saving_decay():
+    tracker = SpaceSaving(capacity=2)
+    tracker.add("a", 4)
+    tracker.add("b", 2)
+    tracker.decay(0.5)
+    tracker.add("c")
+
+    assert tracker.counts == {"a": 2, "c": 2}
+
+
+@pytest.mark.asyncio
+async def test_workers_are_merged(test_config, mock_redis):
+    first = HotLinksService(test_config, mock_redis)
+    second = HotLinksService(test_config, mock_redis)
+    for _ in range(3):
+        first.record_visit("both")
+        second.record_visit("both")
+    for _ in range(4):
+        first.record_visit("first")
+    second.record_visit("second")
+
+    await first.publish()
+    await second.publish()
+
+    assert await first.get_hot_short_codes(2) == ["both", "first"]
+    assert await second.get_hot_short_codes(10) == ["both", "first", "second"]
+
+
+@pytest.mark.asyncio
+async def test_stale_workers_are_ignored(test_config, mock_redis):
+    service = HotLinksService(test_config, mock_redis)
+    service.record_visit("old")
+    await service.publish()
+    await mock_redis.zadd(HOT_WORKERS_KEY, {service.worker_id: time.time() - 3600})
+
+    assert await service.get_hot_short_codes(10) == []
+
+
+@pytest.mark.asyncio
+async def test_old_visits_decay(test_config, mock_redis):
+    service = HotLinksService(test_config, mock_redis)
+    half_life = test_config.hot_links_half_life_minutes * 60
+    with freeze_time() as frozen:
+        service._decayed_at = time.monotonic()
+        for _ in range(10):
+            service.record_visit("yesterday")
+        frozen.tick(5 * half_life)
+        for _ in range(2):
+            service.record_visit("now")
+        frozen.tick(1)
+        await service.publish()
+
+    assert service.tracker.counts["yesterday"] < 1
+    assert await service.get_hot_short_codes(1) == ["now"]
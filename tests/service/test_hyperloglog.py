@@ -0,0 +1,28 @@
+import random
+
+import pytest
+
+from hse_hw3_ap_url_shortener.service.hyperloglog import HyperLogLog
+
+
+@pytest.mark.parametrize("count", [0, 1, 100, 10_000, 200_000])
+def test_estimates_distinct_count(count):
+    rng = random.Random(count)
+    sketch = HyperLogLog().update(rng.getrandbits(64) for _ in range(count))
+    assert sketch.count() == pytest.approx(count, rel=0.05)
+
+
+def test_duplicates_and_merge():
+    rng = random.Random(1)
+    hashes = [rng.getrandbits(64) for _ in range(20_000)]
+    whole = HyperLogLog().update(hashes)
+    halves = HyperLogLog().update(hashes[:12_000] + hashes[:5_000])
+    halves.merge(HyperLogLog().update(hashes[8_000:]))
+
+    assert halves.registers == whole.registers
+    assert HyperLogLog.from_bytes(whole.to_bytes()).registers == whole.registers
+
+
+def test_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog.from_bytes(HyperLogLog(bytearray(16)).to_bytes())
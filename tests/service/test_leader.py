@@ -0,0 +1,89 @@
+import time
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from hse_hw3_ap_url_shortener.service.leader import (
+    LEADER_KEY,
+    LeaderService,
+    NotLeaderError,
+)
+
+
+async def set_key(pipe):
+    await pipe.set("fenced", "1")
+
+
+@pytest.mark.asyncio
+async def test_one_leader_per_election(test_config, leader, mock_redis):
+    other = LeaderService(test_config, mock_redis)
+
+    assert await leader.elect("jobs")
+    assert not await other.elect("jobs")
+    # Renewal keeps the lease and its token
+    assert await leader.elect("jobs")
+    assert leader.fencing_token("jobs") == 1
+    assert other.fencing_token("jobs") is None
+    # Elections are independent
+    assert await other.elect("other jobs")
+
+
+@pytest.mark.asyncio
+async def test_failover_fences_old_leader(test_config, leader, mock_redis):
+    other = LeaderService(test_config, mock_redis)
+    await leader.elect("jobs")
+    await leader.execute_fenced("jobs", set_key)
+    assert mock_redis.data["fenced"] == "1"
+
+    # The leader hangs past its lease, which expires in redis
+    await mock_redis.delete(LEADER_KEY.format(name="jobs"))
+    assert await other.elect("jobs")
+    assert other.fencing_token("jobs") == 2
+
+    # It still believes it leads, but its writes are rejected
+    assert leader.is_leader("jobs")
+    with pytest.raises(NotLeaderError):
+        await leader.execute_fenced("jobs", set_key)
+    assert not await leader.elect("jobs")
+    assert not leader.is_leader("jobs")
+
+
+@pytest.mark.asyncio
+async def test_steps_down_when_redis_is_down(leader, mock_redis, monkeypatch):
+    await leader.elect("jobs")
+
+    async def unavailable(*args, **kwargs):
+        raise ConnectionError()
+
+    leader._acquire = unavailable
+    # Still within the lease
+    assert await leader.elect("jobs")
+    lease = leader.leases["jobs"]
+    monkeypatch.setattr(time, "monotonic", lambda: lease.valid_until + 0.001)
+    assert not await leader.elect("jobs")
+
+
+@pytest.mark.asyncio
+async def test_stop_releases_leases(test_config, leader, mock_redis):
+    other = LeaderService(test_config, mock_redis)
+    await leader.start_elections("jobs")
+    assert leader.is_leader("jobs")
+
+    await leader.stop_elections()
+    assert not leader.is_leader("jobs")
+    assert await other.elect("jobs")
+
+
+@pytest.mark.asyncio
+async def test_leader_only_jobs(test_config, leader, mock_redis):
+    other = LeaderService(test_config, mock_redis)
+    await leader.elect("jobs")
+    await other.elect("jobs")
+    runs = []
+
+    async def job():
+        runs.append(1)
+
+    await leader.leader_only("jobs", job)()
+    await other.leader_only("jobs", job)()
+    assert len(runs) == 1
@@ -0,0 +1,441 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.metrics import LINK_CACHE_LOOKUPS
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.model.model import LinkCreateIn
+from hse_hw3_ap_url_shortener.service.link import (
+    LINK_TOMBSTONE,
+    LinkService,
+    link_cache_ttl,
+)
+from hse_hw3_ap_url_shortener.service.local_cache import LocalCacheService
+from hse_hw3_ap_url_shortener.service.local_cache import LINK_INVALIDATION_CHANNEL
+
+
+@pytest.mark.asyncio
+async def test_missing_codes_are_cached(
+    test_config, mock_redis, temp_db, link_service, db_queries
+):
+    async with create_session(temp_db) as session:
+        assert await link_service.get_link_by_short_code(session, "unknown") is None
+        assert await link_service.get_link_by_short_code(session, "unknown") is None
+
+    assert len(db_queries) == 1
+    assert mock_redis.data["link:unknown"] == LINK_TOMBSTONE
+    assert mock_redis.expires["link:unknown"] == pytest.approx(
+        datetime.now().timestamp() + test_config.negative_cache_ttl_seconds, abs=5
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_tombstone_skips_db(
+    mock_redis, temp_db, link_service, local_cache, db_queries
+):
+    await mock_redis.setex("link:unknown", 60, LINK_TOMBSTONE)
+
+    async with create_session(temp_db) as session:
+        assert await link_service.get_link_by_short_code(session, "unknown") is None
+
+    assert db_queries == []
+    assert local_cache.links.get("unknown") == (True, None)
+
+
+@pytest.mark.asyncio
+async def test_create_clears_tombstone(
+    mock_redis, temp_db, created_user, link_service, local_cache
+):
+    async with create_session(temp_db) as session:
+        assert await link_service.get_link_by_short_code(session, "alias") is None
+
+        user = await session.get(User, created_user)
+        await link_service.create_link(session, user, "https://a.com", "alias")
+
+        assert "link:alias" not in mock_redis.data
+        assert local_cache.links.get("alias") == (False, None)
+        assert (LINK_INVALIDATION_CHANNEL, '["alias"]') in mock_redis.published
+        link = await link_service.get_link_by_short_code(session, "alias")
+        assert link.original_url == "https://a.com"
+
+
+@pytest.mark.asyncio
+async def test_deleted_link_becomes_tombstone(
+    mock_redis, temp_db, created_user, link_service, db_queries
+):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.create_link(session, user, "https://a.com", "gone")
+        await link_service.delete_link(session, user, "gone")
+
+        db_queries.clear()
+        assert await link_service.get_link_by_short_code(session, "gone") is None
+        assert await link_service.get_link_by_short_code(session, "gone") is None
+
+    assert len(db_queries) == 1
+    assert mock_redis.data["link:gone"] == LINK_TOMBSTONE
+
+
+@pytest.mark.asyncio
+async def test_load_does_not_cache_over_invalidation(
+    mock_redis, temp_db, created_user, link_service, local_cache, monkeypatch
+):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.create_link(session, user, "https://a.com", "raced")
+    local_cache.clear()
+    find_link = link_service._find_link
+
+    async def find_and_invalidate(session, short_code):
+        found = await find_link(session, short_code)
+        # Updated by another request before the loader has cached it
+        await link_service.invalidate_cached([short_code])
+        return found
+
+    monkeypatch.setattr(link_service, "_find_link", find_and_invalidate)
+    async with create_session(temp_db) as session:
+        link = await link_service.load_link(session, "raced")
+        assert link.original_url == "https://a.com"
+        assert await link_service.load_link(session, "missing") is None
+
+    assert "link:raced" not in mock_redis.data
+    assert "link:missing" not in mock_redis.data
+    assert local_cache.links.get("raced") == (False, None)
+    assert local_cache.links.get("missing") == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_lookups_are_counted(temp_db, link_service):
+    async with create_session(temp_db) as session:
+        for short_code in ["unknown", "unknown", "other"]:
+            await link_service.get_link_by_short_code(session, short_code)
+
+    assert LINK_CACHE_LOOKUPS.take() == {(("hit",), None): 1, (("miss",), None): 2}
+
+
+async def create_link(temp_db, link_service, created_user, alias, expires_at=None):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.create_link(
+            session, user, "https://a.com", alias, expires_at=expires_at
+        )
+
+
+@pytest.mark.asyncio
+async def test_db_hit_populates_cache(
+    test_config, mock_redis, temp_db, created_user, link_service, db_queries
+):
+    await create_link(temp_db, link_service, created_user, "fresh")
+    db_queries.clear()
+
+    async with create_session(temp_db) as session:
+        first = await link_service.get_link_by_short_code(session, "fresh")
+        second = await link_service.get_link_by_short_code(session, "fresh")
+
+    assert len(db_queries) == 1
+    assert first.original_url == second.original_url == "https://a.com"
+    assert "link:fresh" in mock_redis.data
+    ttl = mock_redis.expires["link:fresh"] - datetime.now().timestamp()
+    max_ttl = test_config.cache_ttl_hours * 3600
+    assert max_ttl * (1 - test_config.cache_ttl_jitter) - 5 <= ttl <= max_ttl
+
+
+@pytest.mark.asyncio
+async def test_cache_ttl_follows_expiration(
+    mock_redis, temp_db, created_user, link_service
+):
+    expires_at = datetime.now() + timedelta(minutes=10)
+    await create_link(temp_db, link_service, created_user, "soon", expires_at)
+
+    async with create_session(temp_db) as session:
+        await link_service.get_link_by_short_code(session, "soon")
+
+    assert mock_redis.expires["link:soon"] == pytest.approx(
+        expires_at.timestamp(), abs=5
+    )
+
+
+@pytest.mark.asyncio
+async def test_expired_link_is_not_cached(
+    mock_redis, temp_db, created_user, link_service, local_cache
+):
+    await create_link(
+        temp_db,
+        link_service,
+        created_user,
+        "expired",
+        datetime.now() - timedelta(minutes=1),
+    )
+
+    async with create_session(temp_db) as session:
+        link = await link_service.get_link_by_short_code(session, "expired")
+
+    assert link.short_code == "expired"
+    assert "link:expired" not in mock_redis.data
+    assert local_cache.links.get("expired") == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_batch_create_is_one_insert(
+    mock_redis, temp_db, created_user, link_service, short_codes, db_queries
+):
+    await create_link(
+        temp_db, link_service, created_user, short_codes.scrambler.encode(0)
+    )
+    await mock_redis.setex("link:alias", 60, LINK_TOMBSTONE)
+    links_in = [LinkCreateIn(original_url=f"https://{i}.com") for i in range(100)]
+    links_in.append(LinkCreateIn(original_url="https://a.com", custom_alias="alias"))
+    db_queries.clear()
+
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        results = await link_service.create_links(session, user, links_in)
+
+    assert [error for _, error in results] == [None] * 101
+    assert results[-1][0].short_code == "alias"
+    assert "link:alias" not in mock_redis.data
+    # The first generated code was taken, caught by the check before inserting
+    inserts = [
+        query
+        for query in db_queries
+        if query.startswith("INSERT") and "short_code_sequence" not in query
+    ]
+    assert len(inserts) == 1
+
+
+async def search(temp_db, link_service, created_user, query, mode, limit=50):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        pages = []
+        cursor = None
+        while True:
+            links, cursor = await link_service.search_links(
+                session, user, query, mode, limit, cursor
+            )
+            pages.append([link.short_code for link in links])
+            if cursor is None:
+                return pages
+
+
+@pytest.mark.asyncio
+async def test_search_modes(temp_db, link_service, created_user):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.create_links(
+            session,
+            user,
+            [
+                LinkCreateIn(original_url=url, custom_alias=alias)
+                for alias, url in [
+                    ("root", "https://Example.com/"),
+                    ("docs", "https://docs.example.com/a_b"),
+                    ("path", "https://other.com/example.com/a%b"),
+                    ("lookalike", "https://notexample.com/"),
+                ]
+            ],
+        )
+
+    async def codes(query, mode):
+        (page,) = await search(temp_db, link_service, created_user, query, mode)
+        return page
+
+    assert await codes("https://example.com", "exact") == ["root"]
+    assert await codes("https://EXAMPLE.com/", "prefix") == ["root"]
+    assert await codes("https://docs.", "prefix") == ["docs"]
+    assert await codes("example.com", "domain") == ["root", "docs"]
+    assert await codes("https://example.com/x", "domain") == ["root", "docs"]
+    assert await codes("example.com", "contains") == [
+        "root",
+        "docs",
+        "path",
+        "lookalike",
+    ]
+    # LIKE wildcards are matched literally
+    assert await codes("a_b", "contains") == ["docs"]
+    assert await codes("a%b", "contains") == ["path"]
+    assert await codes("_", "contains") == ["docs"]
+
+
+@pytest.mark.asyncio
+async def test_search_pages(temp_db, link_service, created_user, db_queries):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.create_links(
+            session,
+            user,
+            [
+                LinkCreateIn(
+                    original_url=f"https://{host}.com/{i}", custom_alias=f"{host}{i}"
+                )
+                for i in range(5)
+                for host in ["a", "sub.b"]
+            ],
+        )
+    db_queries.clear()
+
+    assert await search(temp_db, link_service, created_user, "b.com", "domain", 2) == [
+        ["sub.b0", "sub.b1"],
+        ["sub.b2", "sub.b3"],
+        ["sub.b4"],
+    ]
+    # Only links of the page and the one after are read
+    assert all("LIMIT" in query for query in db_queries if "FROM link" in query)
+
+
+async def concurrent_lookups(temp_db, services, short_code):
+    async def lookup(service):
+        async with create_session(temp_db) as session:
+            return await service.get_link_by_short_code(session, short_code)
+
+    return await asyncio.gather(*map(lookup, services), return_exceptions=True)
+
+
+def link_selects(db_queries):
+    return [query for query in db_queries if query.startswith("SELECT link")]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_query_once(
+    temp_db, created_user, link_service, db_queries
+):
+    await create_link(temp_db, link_service, created_user, "popular")
+    db_queries.clear()
+
+    links = await concurrent_lookups(temp_db, [link_service] * 20, "popular")
+
+    assert {link.original_url for link in links} == {"https://a.com"}
+    assert len(link_selects(db_queries)) == 1
+
+
+@pytest.mark.asyncio
+async def test_redis_lock_across_workers(
+    test_config,
+    mock_redis,
+    temp_db,
+    created_user,
+    link_service,
+    db_queries,
+    monkeypatch,
+):
+    monkeypatch.setattr(test_config, "single_flight_redis_lock", True)
+    await create_link(temp_db, link_service, created_user, "popular")
+    # Every worker has its own local cache
+    workers = [
+        LinkService(
+            test_config,
+            mock_redis,
+            LocalCacheService(test_config),
+            link_service.short_codes,
+            temp_db,
+        )
+        for _ in range(3)
+    ]
+    db_queries.clear()
+
+    links = await concurrent_lookups(temp_db, workers * 5, "popular")
+
+    assert {link.original_url for link in links} == {"https://a.com"}
+    assert len(link_selects(db_queries)) == 1
+    assert "link:popular:lock" not in mock_redis.data
+
+
+@pytest.mark.asyncio
+async def test_keeps_redis_lock_taken_over_by_another_worker(
+    test_config, mock_redis, temp_db, created_user, link_service, monkeypatch
+):
+    monkeypatch.setattr(test_config, "single_flight_redis_lock", True)
+    await create_link(temp_db, link_service, created_user, "slow")
+    find_link = LinkService._find_link
+
+    async def outlives_lock(self, session, short_code):
+        # The lock has expired and another worker has taken it
+        await mock_redis.set("link:slow:lock", "other")
+        return await find_link(self, session, short_code)
+
+    monkeypatch.setattr(LinkService, "_find_link", outlives_lock)
+
+    await concurrent_lookups(temp_db, [link_service], "slow")
+
+    assert mock_redis.data["link:slow:lock"] == "other"
+
+
+@pytest.mark.asyncio
+async def test_waiters_load_after_timeout_or_failure(
+    test_config, temp_db, created_user, link_service, db_queries, monkeypatch
+):
+    monkeypatch.setattr(test_config, "single_flight_timeout_seconds", 0.05)
+    await create_link(temp_db, link_service, created_user, "slow")
+    find_link = LinkService._find_link
+    calls = []
+
+    async def first_call_fails(self, session, short_code):
+        calls.append(short_code)
+        if len(calls) == 1:
+            await asyncio.sleep(0.1)
+            raise RuntimeError("DB is down")
+        return await find_link(self, session, short_code)
+
+    monkeypatch.setattr(LinkService, "_find_link", first_call_fails)
+
+    results = await concurrent_lookups(temp_db, [link_service] * 3, "slow")
+
+    assert isinstance(results[0], RuntimeError)
+    assert [link.short_code for link in results[1:]] == ["slow", "slow"]
+    assert link_service.local_cache.loading == {}
+
+
+@pytest.mark.asyncio
+async def test_expiring_entry_is_refreshed(
+    test_config,
+    mock_redis,
+    temp_db,
+    created_user,
+    link_service,
+    db_queries,
+    monkeypatch,
+):
+    monkeypatch.setattr(test_config, "cache_refresh_ahead_seconds", 10**9)
+    await create_link(temp_db, link_service, created_user, "hot")
+    async with create_session(temp_db) as session:
+        await link_service.get_link_by_short_code(session, "hot")
+    await mock_redis.setex("link:hot", 5, mock_redis.data["link:hot"])
+    # Only lookups reaching redis see the TTL
+    link_service.local_cache.links.clear()
+    db_queries.clear()
+
+    found, link = await link_service.get_cached_link("hot")
+    await asyncio.gather(*link_service.local_cache.refreshing.values())
+
+    assert found and link.original_url == "https://a.com"
+    assert len(link_selects(db_queries)) == 1
+    assert await mock_redis.pttl("link:hot") > 3600 * 1000
+    assert link_service.local_cache.refreshing == {}
+
+
+@pytest.mark.asyncio
+async def test_fresh_entry_is_not_refreshed(
+    test_config, temp_db, created_user, link_service, db_queries, monkeypatch
+):
+    monkeypatch.setattr(test_config, "cache_refresh_ahead_seconds", 60)
+    await create_link(temp_db, link_service, created_user, "hot")
+    async with create_session(temp_db) as session:
+        await link_service.get_link_by_short_code(session, "hot")
+    link_service.local_cache.links.clear()
+    db_queries.clear()
+
+    for _ in range(100):
+        assert (await link_service.get_cached_link("hot"))[0]
+        link_service.local_cache.links.clear()
+
+    assert link_service.local_cache.refreshing == {}
+    assert db_queries == []
+
+
+def test_cache_ttl_jitter():
+    link = Link(short_code="a", original_url="https://a.com", user_id=1)
+    ttls = {link_cache_ttl(link, 24, jitter=0.1) for _ in range(100)}
+
+    assert len(ttls) > 1
+    assert all(timedelta(hours=21.6) <= ttl <= timedelta(hours=24) for ttl in ttls)
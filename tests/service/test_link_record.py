@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link
+from hse_hw3_ap_url_shortener.service.link_record import (
+    RECORD_PLAIN,
+    RECORD_ZLIB,
+    CachedLink,
+    decode_link,
+    encode_link,
+)
+from tests.service.test_link import create_link
+
+
+def test_round_trip():
+    expires_at = datetime.now() + timedelta(days=1)
+    link = Link(
+        id=7,
+        short_code="abc",
+        original_url="https://a.com/?q=a|b",
+        user_id=3,
+        expires_at=expires_at,
+        visits=10,
+    )
+
+    record = encode_link(link)
+    assert record.startswith(RECORD_PLAIN + "|")
+    assert decode_link("abc", record) == CachedLink(
+        short_code="abc",
+        original_url="https://a.com/?q=a|b",
+        expires_at=expires_at,
+        user_id=3,
+    )
+
+    link.expires_at = None
+    assert decode_link("abc", encode_link(link)).expires_at is None
+
+
+def test_long_urls_are_compressed():
+    url = "https://a.com/?" + "&".join(f"utm_{i}=campaign" for i in range(50))
+    link = CachedLink(short_code="abc", original_url=url, expires_at=None, user_id=1)
+
+    record = encode_link(link)
+    assert record.startswith(RECORD_ZLIB + "|")
+    assert len(record) < len(url)
+    assert decode_link("abc", record) == link
+
+
+def test_legacy_and_unknown_records():
+    link = Link(short_code="abc", original_url="https://a.com", user_id=1)
+    assert decode_link("abc", link.model_dump_json()) == CachedLink.from_link(link)
+    assert decode_link("abc", "9|||https://a.com") is None
+    assert decode_link("abc", "garbage") is None
+
+
+@pytest.mark.asyncio
+async def test_unknown_record_is_a_miss(
+    mock_redis, temp_db, created_user, link_service
+):
+    await create_link(temp_db, link_service, created_user, "newer")
+    # Written by a newer version during a rolling deploy
+    await mock_redis.setex("link:newer", 60, "2|whatever")
+
+    async with create_session(temp_db) as session:
+        link = await link_service.get_link_by_short_code(session, "newer")
+
+    assert link.original_url == "https://a.com"
+    assert mock_redis.data["link:newer"].startswith(RECORD_PLAIN + "|")
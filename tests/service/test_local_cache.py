@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+import pytest
+from freezegun import freeze_time
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.service.link_record import encode_link
+from hse_hw3_ap_url_shortener.service.local_cache import (
+    LRUCache,
+    LINK_INVALIDATION_CHANNEL,
+)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_size=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == (True, 1)
+    cache.set("c", 3)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    assert cache.evictions == 1
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+
+def test_lru_expires_entries():
+    with freeze_time() as frozen:
+        cache = LRUCache(max_size=10, ttl_seconds=5)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl_seconds=60)
+        frozen.tick(10)
+
+        assert cache.get("a") == (False, None)
+        assert cache.get("b") == (True, 2)
+        assert len(cache) == 1
+
+
+async def cache_link_in_redis(mock_redis, created_user) -> Link:
+    link = Link(
+        id=1, short_code="cached", original_url="https://a.com", user_id=created_user
+    )
+    await mock_redis.setex("link:cached", 60, encode_link(link))
+    return link
+
+
+@pytest.mark.asyncio
+async def test_redis_hits_are_cached_locally(
+    mock_redis, temp_db, created_user, link_service, local_cache
+):
+    await cache_link_in_redis(mock_redis, created_user)
+
+    async with AsyncSession(temp_db) as session:
+        first = await link_service.get_link_by_short_code(session, "cached")
+        await mock_redis.delete("link:cached")
+        second = await link_service.get_link_by_short_code(session, "cached")
+
+    assert first.original_url == "https://a.com"
+    assert second is first
+    stats = local_cache.get_stats()
+    assert stats.hits == 1
+    assert stats.misses == 1
+    assert stats.size == 1
+
+
+@pytest.mark.asyncio
+async def test_update_invalidates_local_cache(
+    mock_redis, temp_db, created_user, link_service, local_cache
+):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        link = await link_service.create_link(session, user, "https://a.com", "mine")
+        await mock_redis.setex("link:mine", 60, link.model_dump_json())
+        await link_service.get_link_by_short_code(session, "mine")
+
+        await link_service.update_link(session, user, "mine", "https://b.com")
+
+        assert local_cache.links.get("mine") == (False, None)
+        assert "link:mine" not in mock_redis.data
+        assert mock_redis.published[-1] == (LINK_INVALIDATION_CHANNEL, '["mine"]')
+        updated = await link_service.get_link_by_short_code(session, "mine")
+        assert updated.original_url == "https://b.com"
+
+
+@pytest.mark.asyncio
+async def test_listener_drops_invalidated_links(mock_redis, local_cache):
+    local_cache.start_listener(mock_redis)
+    await asyncio.sleep(0.01)
+    local_cache.links.set("other", Link(short_code="other", original_url=""))
+    local_cache.links.set("kept", Link(short_code="kept", original_url=""))
+
+    await mock_redis.publish(LINK_INVALIDATION_CHANNEL, json.dumps(["other"]))
+    await asyncio.sleep(0.01)
+    await local_cache.stop_listener()
+
+    assert local_cache.links.get("other") == (False, None)
+    assert local_cache.links.get("kept")[0]
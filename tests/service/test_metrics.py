@@ -0,0 +1,121 @@
+import pytest
+from redis.exceptions import ConnectionError
+from sqlalchemy import text
+
+from hse_hw3_ap_url_shortener.metrics import (
+    JOB_FAILURES,
+    JOB_SECONDS,
+    Counter,
+    Histogram,
+    Registry,
+    timed_job,
+)
+from hse_hw3_ap_url_shortener.service.metrics import METRICS_KEY, MetricsService
+
+
+def make_registry():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests", ("route",)))
+    latency = registry.register(
+        Histogram("latency_seconds", "Latency", ("route",), (0.1, 1))
+    )
+    return registry, requests, latency
+
+
+def test_render():
+    registry, requests, latency = make_registry()
+    requests.inc("/a")
+    requests.inc("/a")
+    requests.inc('/"b"', value=0.5)
+    latency.observe(0.1, "/a")
+    latency.observe(0.5, "/a")
+    latency.observe(3, "/a")
+
+    assert registry.render(registry.take()).splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{route="/\\"b\\""} 0.5',
+        'requests_total{route="/a"} 2',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 3.6',
+        'latency_seconds_count{route="/a"} 3',
+    ]
+    # Taken
+    assert registry.take() == {}
+
+
+def test_restore():
+    registry, requests, _ = make_registry()
+    requests.inc("/a")
+    samples = registry.take()
+    requests.inc("/a")
+    registry.restore(samples)
+    assert 'requests_total{route="/a"} 2' in registry.render(registry.take())
+
+
+@pytest.mark.asyncio
+async def test_workers_share_totals(test_config, mock_redis):
+    registry, requests, latency = make_registry()
+    other_registry, other_requests, _ = make_registry()
+    service = MetricsService(test_config, mock_redis, registry)
+    other = MetricsService(test_config, mock_redis, other_registry)
+
+    requests.inc("/a")
+    latency.observe(0.5, "/a")
+    other_requests.inc("/a", value=2)
+    await other.flush()
+
+    rendered = await service.collect()
+    assert 'requests_total{route="/a"} 3' in rendered
+    assert 'latency_seconds_count{route="/a"} 1' in rendered
+    # Nothing new to add
+    assert await service.flush() == 0
+
+
+@pytest.mark.asyncio
+async def test_keeps_metrics_while_redis_is_down(test_config, mock_redis):
+    registry, requests, _ = make_registry()
+    service = MetricsService(test_config, mock_redis, registry)
+    requests.inc("/a")
+
+    async def unavailable(*args, **kwargs):
+        raise ConnectionError()
+
+    mock_redis.hincrbyfloat = unavailable
+    with pytest.raises(ConnectionError):
+        await service.flush()
+    assert METRICS_KEY not in mock_redis.hashes
+
+    del mock_redis.hincrbyfloat
+    assert await service.flush() == 1
+    assert 'requests_total{route="/a"} 1' in await service.collect()
+
+
+@pytest.mark.asyncio
+async def test_timed_job(metrics):
+    async def fails():
+        raise ValueError()
+
+    await timed_job("job", lambda: metrics.flush())()
+    with pytest.raises(ValueError):
+        await timed_job("job", fails)()
+
+    rendered = await metrics.collect()
+    assert 'job_duration_seconds_count{job="job"} 2' in rendered
+    assert 'job_failures_total{job="job"} 1' in rendered
+    assert JOB_SECONDS.name in rendered and JOB_FAILURES.name in rendered
+
+
+@pytest.mark.asyncio
+async def test_db_queries(metrics, temp_db):
+    async with temp_db.connect() as connection:
+        await connection.execute(text("SELECT 1"))
+        await connection.execute(text("PRAGMA user_version"))
+
+    rendered = await metrics.collect()
+    assert 'db_query_duration_seconds_count{statement="SELECT"} 1' in rendered
+    assert 'db_query_duration_seconds_count{statement="OTHER"} 1' in rendered
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.service.password import PasswordService
+from hse_hw3_ap_url_shortener.settings.config import get_config
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify(test_config):
+    service = PasswordService(test_config)
+    try:
+        hashed = await service.hash("secret")
+        assert hashed.startswith(f"$2b${test_config.bcrypt_rounds:02}$")
+        assert await service.verify_and_update("secret", hashed) == (True, None)
+        assert await service.verify_and_update("other", hashed) == (False, None)
+    finally:
+        service.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_queue_limit(test_config):
+    service = PasswordService(
+        test_config.model_copy(
+            update={"password_hash_workers": 1, "password_hash_max_pending": 2}
+        )
+    )
+    try:
+        results = await asyncio.gather(
+            *[service.hash("secret") for _ in range(3)], return_exceptions=True
+        )
+        assert isinstance(results[2], HTTPException)
+        assert results[2].status_code == 503
+        assert all(isinstance(result, str) for result in results[:2])
+        assert service.rejected == 1
+        assert service.pending == 0
+    finally:
+        service.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_login_rehashes_password(test_client, created_user, temp_db, monkeypatch):
+    rounds = get_config().bcrypt_rounds + 1
+    monkeypatch.setattr(get_config(), "bcrypt_rounds", rounds)
+
+    response = test_client.post(
+        "/auth/login", json={"email": "sample@a.nl", "password": "test123"}
+    )
+    assert response.status_code == 200
+
+    async with AsyncSession(temp_db) as session:
+        user = await session.get(User, created_user)
+    assert user.hashed_password.startswith(f"$2b${rounds:02}$")
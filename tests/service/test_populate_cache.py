@@ -1,14 +1,31 @@
-from datetime import datetime
+import asyncio
+import json
+from datetime import datetime, timedelta
 
 import pytest
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from hse_hw3_ap_url_shortener.metrics import LINK_CACHE_LOOKUPS
 from hse_hw3_ap_url_shortener.model.dbmodel import Link
-from hse_hw3_ap_url_shortener.service.populate_cache import PopulateCacheService
+from hse_hw3_ap_url_shortener.service.metrics import METRICS_KEY
+from hse_hw3_ap_url_shortener.service.populate_cache import (
+    POPULATE_CACHE_ELECTION,
+    PopulateCacheService,
+)
 
 
-def create_test_links(engine, created_user):
-    with Session(engine) as session:
+@pytest.fixture(autouse=True)
+def elected(leader):
+    asyncio.run(leader.elect(POPULATE_CACHE_ELECTION))
+
+
+def record_lookups(hits, misses):
+    LINK_CACHE_LOOKUPS.inc("hit", value=hits)
+    LINK_CACHE_LOOKUPS.inc("miss", value=misses)
+
+
+async def create_test_links(engine, created_user):
+    async with AsyncSession(engine) as session:
         links = [
             Link(
                 short_code="most",
@@ -30,14 +47,18 @@ def create_test_links(engine, created_user):
             ),
         ]
         session.add_all(links)
-        session.commit()
+        await session.commit()
 
 
 @pytest.mark.asyncio
-async def test_populates_top_links(test_config, mock_redis, temp_db, created_user):
+async def test_populates_top_links(
+    test_config, mock_redis, temp_db, hot_links, metrics, created_user, leader
+):
     test_config.top_links_cache_size = 2
-    create_test_links(temp_db, created_user)
-    service = PopulateCacheService(test_config, mock_redis, temp_db)
+    await create_test_links(temp_db, created_user)
+    service = PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
     await service.populate_cache()
     assert mock_redis.data["link:most"] is not None
     assert mock_redis.data["link:middle"] is not None
@@ -45,18 +66,26 @@ async def test_populates_top_links(test_config, mock_redis, temp_db, created_use
 
 
 @pytest.mark.asyncio
-async def test_respects_cache_size_limit(test_config, mock_redis, temp_db):
+async def test_respects_cache_size_limit(
+    test_config, mock_redis, temp_db, hot_links, metrics, leader
+):
     test_config.top_links_cache_size = 2
-    service = PopulateCacheService(test_config, mock_redis, temp_db)
+    service = PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
     await service.populate_cache()
-    assert len(mock_redis.data) == 0
+    assert not [key for key in mock_redis.data if key.startswith("link:")]
 
 
 @pytest.mark.asyncio
-async def test_sets_correct_ttl(test_config, mock_redis, temp_db, created_user):
+async def test_sets_correct_ttl(
+    test_config, mock_redis, temp_db, hot_links, metrics, created_user, leader
+):
     test_config.top_links_cache_size = 2
-    create_test_links(temp_db, created_user)
-    service = PopulateCacheService(test_config, mock_redis, temp_db)
+    await create_test_links(temp_db, created_user)
+    service = PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
     test_start = datetime.now()
     await service.populate_cache()
     for code in ["most", "middle"]:
@@ -69,11 +98,15 @@ async def test_sets_correct_ttl(test_config, mock_redis, temp_db, created_user):
 
 
 @pytest.mark.asyncio
-async def test_clears_old_entries(test_config, mock_redis, temp_db, created_user):
+async def test_clears_old_entries(
+    test_config, mock_redis, temp_db, hot_links, metrics, created_user, leader
+):
     test_config.top_links_cache_size = 2
-    service = PopulateCacheService(test_config, mock_redis, temp_db)
+    service = PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
 
-    with Session(temp_db) as session:
+    async with AsyncSession(temp_db) as session:
         links = [
             Link(
                 short_code="old1",
@@ -89,9 +122,9 @@ async def test_clears_old_entries(test_config, mock_redis, temp_db, created_user
             ),
         ]
         session.add_all(links)
-        session.commit()
+        await session.commit()
 
-    create_test_links(temp_db, created_user)
+    await create_test_links(temp_db, created_user)
     await service.populate_cache()
 
     assert "link:old1" not in mock_redis.data
@@ -99,12 +132,174 @@ async def test_clears_old_entries(test_config, mock_redis, temp_db, created_user
 
 
 @pytest.mark.asyncio
-async def test_scheduler_initialization(test_config, mock_redis, temp_db):
+async def test_scheduler_initialization(
+    test_config, mock_redis, temp_db, hot_links, metrics, leader
+):
     test_config.populate_cache_interval_minutes = 10
-    service = PopulateCacheService(test_config, mock_redis, temp_db)
+    service = PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
 
     service.start_scheduler()
 
     assert len(service.scheduler.get_jobs()) == 1
     job = service.scheduler.get_jobs()[0]
     assert job.trigger.interval.total_seconds() == 10 * 60
+    # Do not let the first run outlive the test event loop
+    service.scheduler.pause()
+
+
+@pytest.mark.asyncio
+async def test_ttl_follows_expiration(
+    test_config, mock_redis, temp_db, hot_links, metrics, created_user, leader
+):
+    test_config.top_links_cache_size = 2
+    expires_at = datetime.now() + timedelta(minutes=10)
+    async with AsyncSession(temp_db) as session:
+        session.add_all(
+            [
+                Link(
+                    short_code="soon",
+                    original_url="https://soon.com",
+                    visits=10,
+                    expires_at=expires_at,
+                    user_id=created_user,
+                ),
+                Link(
+                    short_code="expired",
+                    original_url="https://expired.com",
+                    visits=5,
+                    expires_at=datetime.now() - timedelta(minutes=1),
+                    user_id=created_user,
+                ),
+            ]
+        )
+        await session.commit()
+
+    await PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    ).populate_cache()
+
+    assert mock_redis.expires["link:soon"] == pytest.approx(
+        expires_at.timestamp(), abs=5
+    )
+    assert "link:expired" not in mock_redis.data
+
+
+@pytest.mark.asyncio
+async def test_populates_hot_links(
+    test_config, mock_redis, temp_db, created_user, hot_links, metrics, leader
+):
+    test_config.top_links_cache_size = 2
+    await create_test_links(temp_db, created_user)
+    for _ in range(3):
+        hot_links.record_visit("least")
+    hot_links.record_visit("middle")
+    await hot_links.publish()
+
+    await PopulateCacheService(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    ).populate_cache()
+
+    assert "link:least" in mock_redis.data
+    assert "link:middle" in mock_redis.data
+    assert "link:most" not in mock_redis.data
+
+
+def sized_service(
+    test_config, mock_redis, temp_db, hot_links, metrics, leader, **config
+):
+    config = test_config.model_copy(
+        update={
+            "top_links_cache_size": 100,
+            "top_links_cache_min_size": 10,
+            "top_links_cache_max_size": 150,
+            "cache_target_hit_ratio": 0.9,
+            **config,
+        }
+    )
+    return PopulateCacheService(config, mock_redis, temp_db, hot_links, metrics, leader)
+
+
+@pytest.mark.asyncio
+async def test_adapts_size_to_hit_ratio(
+    test_config, mock_redis, temp_db, hot_links, metrics, leader
+):
+    service = sized_service(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
+
+    record_lookups(800, 200)
+    await service.populate_cache()
+    assert service.size == 150
+    assert service.last_stats.hit_ratio == 0.8
+    assert service.last_stats.previous_size == 100
+
+    record_lookups(990, 10)
+    await service.populate_cache()
+    assert service.size == 135
+
+    # Not enough lookups to judge
+    record_lookups(1, 9)
+    await service.populate_cache()
+    assert service.size == 135
+    assert service.last_stats.lookups == 10
+
+
+@pytest.mark.asyncio
+async def test_counts_lookups_of_all_workers(
+    test_config, mock_redis, temp_db, hot_links, metrics, leader
+):
+    service = sized_service(
+        test_config, mock_redis, temp_db, hot_links, metrics, leader
+    )
+    # Flushed by another worker
+    hit = json.dumps(["link_cache_lookups_total", ["hit"], None])
+    await mock_redis.hincrbyfloat(METRICS_KEY, hit, 500)
+    record_lookups(0, 500)
+
+    await service.populate_cache()
+    assert service.last_stats.hit_ratio == 0.5
+    assert service.size == 150
+
+    # Any worker answers with what the leader has picked
+    other = sized_service(test_config, mock_redis, temp_db, hot_links, metrics, leader)
+    assert await other.get_last_stats() == service.last_stats
+
+    # A new leader counts from where the previous one stopped
+    record_lookups(99, 1)
+    await other.populate_cache()
+    assert other.last_stats.previous_size == 150
+    assert other.last_stats.lookups == 100
+    assert other.size == 135
+
+
+@pytest.mark.asyncio
+async def test_caps_size_by_memory_budget(
+    test_config, mock_redis, temp_db, created_user, hot_links, metrics, leader
+):
+    await create_test_links(temp_db, created_user)
+    # Other data in redis does not count against the budget of the cache
+    await mock_redis.setex("big", 60, "x" * 1024 * 1024)
+    service = sized_service(
+        test_config,
+        mock_redis,
+        temp_db,
+        hot_links,
+        metrics,
+        leader,
+        top_links_cache_min_size=1,
+        cache_memory_budget_mb=0.5 / 1024,
+    )
+
+    # Nothing is warmed yet to know the size of a link
+    record_lookups(0, 1000)
+    await service.populate_cache()
+    assert service.size == 150
+    assert service.last_stats.entry_bytes is None
+
+    record_lookups(0, 1000)
+    await service.populate_cache()
+    assert 1 < service.size < 10
+    assert service.size == int(512 / service.entry_bytes)
+    assert service.last_stats.entry_bytes == service.entry_bytes
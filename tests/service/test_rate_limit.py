@@ -0,0 +1,81 @@
+import pytest
+from fastapi import HTTPException, Request
+from redis.exceptions import ConnectionError
+
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.service.rate_limit import client_address, take_tokens
+from hse_hw3_ap_url_shortener.settings.config import RateLimit
+
+LIMITS = {
+    "shorten": {
+        "default": RateLimit(rate=1, burst=2),
+        "premium": RateLimit(rate=10, burst=5),
+    }
+}
+
+
+def test_take_tokens():
+    limit = RateLimit(rate=2, burst=3)
+    assert take_tokens(None, None, 0, limit, 1) == (2, 0)
+    # Half a second refills one token
+    assert take_tokens(0, 0, 500, limit, 1) == (0, 0)
+    assert take_tokens(0, 0, 250, limit, 1) == (0.5, 250)
+    # Never more than the burst
+    assert take_tokens(0, 0, 60_000, limit, 1) == (2, 0)
+
+
+async def take_all(rate_limits, user: User) -> int:
+    allowed = 0
+    while True:
+        try:
+            await rate_limits.check_user("shorten", user)
+        except HTTPException as e:
+            assert e.status_code == 429
+            assert e.headers["Retry-After"] == "1"
+            return allowed
+        allowed += 1
+
+
+def test_client_address():
+    def request(*forwarded: str) -> Request:
+        headers = [(b"x-forwarded-for", value.encode()) for value in forwarded]
+        return Request({"type": "http", "headers": headers, "client": ("10.0.0.2", 1)})
+
+    assert client_address(request("6.6.6.6"), 0) == "10.0.0.2"
+    assert client_address(request(), 1) == "10.0.0.2"
+    # Entries the client sent itself are left of the ones the proxies added
+    assert client_address(request("6.6.6.6, 1.1.1.1"), 1) == "1.1.1.1"
+    assert client_address(request("6.6.6.6", "1.1.1.1, 10.0.0.1"), 2) == "1.1.1.1"
+    assert client_address(request("1.1.1.1"), 2) == "1.1.1.1"
+
+
+@pytest.mark.asyncio
+async def test_limits_per_user_and_tier(rate_limits, monkeypatch):
+    monkeypatch.setattr(rate_limits.config, "rate_limits", LIMITS)
+
+    assert await take_all(rate_limits, User(id=1)) == 2
+    assert await take_all(rate_limits, User(id=2, tier="unknown")) == 2
+    assert await take_all(rate_limits, User(id=3, tier="premium")) == 5
+    # Routes without limits are not limited
+    for _ in range(10):
+        await rate_limits.check_client("redirect_everything", "1.1.1.1")
+
+
+@pytest.mark.asyncio
+async def test_limits_in_process_while_redis_is_down(rate_limits, monkeypatch):
+    monkeypatch.setattr(rate_limits.config, "rate_limits", LIMITS)
+
+    async def unavailable(*args, **kwargs):
+        raise ConnectionError()
+
+    rate_limits._script = unavailable
+    assert await take_all(rate_limits, User(id=1)) == 2
+    assert len(rate_limits.local) == 1
+
+
+@pytest.mark.asyncio
+async def test_disabled(rate_limits, monkeypatch):
+    monkeypatch.setattr(rate_limits.config, "rate_limits", LIMITS)
+    monkeypatch.setattr(rate_limits.config, "rate_limit_enabled", False)
+    for _ in range(10):
+        await rate_limits.check_user("shorten", User(id=1))
@@ -0,0 +1,99 @@
+import pytest
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import User
+from hse_hw3_ap_url_shortener.service.short_code import (
+    ShortCodeScrambler,
+    ShortCodeService,
+    SEQUENCE_KEY,
+)
+
+
+def test_scrambler_is_a_bijection():
+    scrambler = ShortCodeScrambler(secret=b"secret", min_length=6)
+    codes = [scrambler.encode(value) for value in range(20_000)]
+
+    assert len(set(codes)) == len(codes)
+    assert all(len(code) == 6 and code.isalnum() for code in codes)
+    assert [scrambler.decode(code) for code in codes] == list(range(20_000))
+
+
+def test_scrambler_grows_code_length():
+    scrambler = ShortCodeScrambler(secret=b"secret", min_length=2)
+
+    assert len(scrambler.encode(62**2 - 1)) == 2
+    assert len(scrambler.encode(62**2)) == 3
+    assert scrambler.decode(scrambler.encode(62**2)) == 62**2
+
+
+def test_scrambler_depends_on_secret():
+    first = ShortCodeScrambler(secret=b"first", min_length=6)
+    second = ShortCodeScrambler(secret=b"second", min_length=6)
+    assert [first.encode(i) for i in range(10)] != [second.encode(i) for i in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_ids_are_taken_in_blocks(test_config, mock_redis, temp_db):
+    config = test_config.model_copy(update=dict(short_code_block_size=10))
+    first_worker = ShortCodeService(config, mock_redis, temp_db)
+    second_worker = ShortCodeService(config, mock_redis, temp_db)
+
+    codes = await first_worker.generate(5)
+    codes += await second_worker.generate(25)
+    codes += await first_worker.generate(5)
+
+    assert len(set(codes)) == 35
+    # The second worker needed more than a block and took 25 ids at once
+    assert mock_redis.data[SEQUENCE_KEY] == "35"
+
+
+@pytest.mark.asyncio
+async def test_sequence_survives_redis_reset(test_config, mock_redis, temp_db):
+    config = test_config.model_copy(update=dict(short_code_block_size=10))
+    first_worker = ShortCodeService(config, mock_redis, temp_db)
+    second_worker = ShortCodeService(config, mock_redis, temp_db)
+    codes = await first_worker.generate(5)
+    codes += await second_worker.generate(25)
+
+    # Redis restarts without persistence
+    await mock_redis.delete(SEQUENCE_KEY)
+    # The first worker still has ids of its block, then it takes a new one
+    codes += await first_worker.generate(10)
+    # A worker started after the reset
+    codes += await ShortCodeService(config, mock_redis, temp_db).generate(5)
+    await mock_redis.delete(SEQUENCE_KEY)
+    codes += await second_worker.generate(5)
+
+    assert len(set(codes)) == len(codes)
+
+
+@pytest.mark.asyncio
+async def test_create_skips_taken_codes(
+    temp_db, created_user, link_service, short_codes, db_queries
+):
+    taken = short_codes.scrambler.encode(0)
+
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        await link_service.create_link(session, user, "https://a.com", taken)
+        db_queries.clear()
+        link = await link_service.create_link(session, user, "https://b.com")
+
+    assert link.short_code == short_codes.scrambler.encode(1)
+    # No lookups before inserting, the taken code is caught by the constraint
+    link_queries = [query for query in db_queries if "short_code_sequence" not in query]
+    assert link_queries[0].startswith("INSERT")
+    # Nor after, RETURNING gives the created link
+    assert not [query for query in link_queries if query.startswith("SELECT")]
+    assert link.id is not None
+
+
+@pytest.mark.asyncio
+async def test_random_mode(test_config, temp_db, created_user, link_service):
+    link_service.config = test_config.model_copy(update=dict(short_code_mode="random"))
+
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        link = await link_service.create_link(session, user, "https://a.com")
+
+    assert len(link.short_code) == test_config.short_code_length
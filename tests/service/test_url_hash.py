@@ -0,0 +1,95 @@
+import pytest
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from hse_hw3_ap_url_shortener.db import create_session
+from hse_hw3_ap_url_shortener.model.dbmodel import Link, User
+from hse_hw3_ap_url_shortener.service.url_hash import (
+    backfill_url_hashes,
+    normalize_url,
+    url_hash,
+)
+
+
+def test_normalize_url():
+    assert normalize_url("HTTPS://Example.COM:443") == "https://example.com/"
+    assert normalize_url("http://example.com:80/a?b=C") == "http://example.com/a?b=C"
+    assert normalize_url("http://example.com:8080/") == "http://example.com:8080/"
+    assert normalize_url("https://example.com/Path") != normalize_url(
+        "https://example.com/path"
+    )
+    assert url_hash("https://EXAMPLE.com") == url_hash("https://example.com/")
+
+
+async def add_links(temp_db, created_user, *links):
+    async with AsyncSession(temp_db) as session:
+        for short_code, original_url, hashed in links:
+            session.add(
+                Link(
+                    short_code=short_code,
+                    original_url=original_url,
+                    url_hash=hashed,
+                    user_id=created_user,
+                )
+            )
+        await session.commit()
+
+
+async def search(temp_db, created_user, link_service, original_url):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        links, _ = await link_service.search_links(session, user, original_url)
+        return sorted(link.short_code for link in links)
+
+
+@pytest.mark.asyncio
+async def test_search_confirms_full_url(temp_db, created_user, link_service):
+    target = "https://example.com/a"
+    await add_links(
+        temp_db,
+        created_user,
+        ("match", "https://EXAMPLE.com/a", url_hash(target)),
+        # Same hash, as if it collided
+        ("collision", "https://other.com/", url_hash(target)),
+        ("legacy", target, None),
+        ("other", "https://example.com/b", url_hash("https://example.com/b")),
+    )
+
+    assert await search(temp_db, created_user, link_service, target) == [
+        "legacy",
+        "match",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_created_and_updated_links_are_hashed(
+    temp_db, created_user, link_service
+):
+    async with create_session(temp_db) as session:
+        user = await session.get(User, created_user)
+        link = await link_service.create_link(session, user, "https://a.com/", "a")
+        assert link.url_hash == url_hash("https://a.com")
+        await link_service.update_link(session, user, "a", "https://b.com/")
+
+    assert await search(temp_db, created_user, link_service, "https://b.com") == ["a"]
+    assert await search(temp_db, created_user, link_service, "https://a.com") == []
+
+
+@pytest.mark.asyncio
+async def test_backfill(temp_db, created_user):
+    await add_links(
+        temp_db,
+        created_user,
+        *[(f"c{i}", f"https://{i}.com", None) for i in range(5)],
+        ("done", "https://done.com", 42),
+    )
+
+    assert await backfill_url_hashes(temp_db, batch_size=2) == 5
+    assert await backfill_url_hashes(temp_db, batch_size=2) == 0
+
+    async with AsyncSession(temp_db) as session:
+        links = (await session.exec(select(Link))).all()
+    assert {link.short_code: link.url_hash for link in links} == {
+        **{f"c{i}": url_hash(f"https://{i}.com") for i in range(5)},
+        "done": 42,
+    }
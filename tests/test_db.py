@@ -0,0 +1,152 @@
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Inspector
+
+from hse_hw3_ap_url_shortener.db import (
+    get_engine,
+    dispose_engine,
+    get_db_pool_stats,
+    get_redis,
+    close_redis,
+    get_redis_pool_stats,
+    create_db_and_tables,
+    InstrumentedPipeline,
+    InstrumentedRedis,
+)
+
+
+@pytest.fixture
+def pooled_config(test_config, tmp_path):
+    return test_config.model_copy(
+        update=dict(
+            db_url=f"sqlite:///{tmp_path / 'pool.db'}",
+            db_pool_size=1,
+            db_max_overflow=0,
+            db_pool_timeout_seconds=0.1,
+            redis_url="redis://localhost:6379",
+            redis_max_connections=7,
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_engine_is_created_once(pooled_config):
+    engine = get_engine(pooled_config)
+    assert get_engine(pooled_config) is engine
+
+    await dispose_engine()
+    assert get_engine(pooled_config) is not engine
+    await dispose_engine()
+
+
+@pytest.mark.asyncio
+async def test_db_pool_stats(pooled_config):
+    engine = get_engine(pooled_config)
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+            stats = get_db_pool_stats(engine)
+            assert stats.size == 1
+            assert stats.checked_out == 1
+            assert stats.waits == 0
+
+            with pytest.raises(Exception):
+                async with engine.connect() as other:
+                    await other.execute(text("SELECT 1"))
+
+        stats = get_db_pool_stats(engine)
+        assert stats.checked_out == 0
+        assert stats.checked_in == 1
+        assert stats.waits == 1
+        assert stats.timeouts == 1
+    finally:
+        await dispose_engine()
+
+
+@pytest.mark.asyncio
+async def test_redis_is_created_once(pooled_config):
+    redis = get_redis(pooled_config)
+    try:
+        assert get_redis(pooled_config) is redis
+        stats = get_redis_pool_stats(redis)
+        assert stats.max_connections == 7
+        assert stats.in_use == 0
+    finally:
+        await close_redis()
+
+
+def test_pool_stats_endpoint_without_pools(test_client):
+    response = test_client.get("/internal/pools")
+    assert response.status_code == 200
+    assert response.json() == {"db": None, "redis": None}
+
+
+@pytest.mark.asyncio
+async def test_missing_indexes_are_created(pooled_config):
+    engine = get_engine(pooled_config)
+    await create_db_and_tables(engine)
+    async with engine.begin() as connection:
+        await connection.execute(text("DROP INDEX ix_link_expires_at"))
+
+    await create_db_and_tables(engine)
+
+    async with engine.connect() as connection:
+        indexes = await connection.run_sync(
+            lambda sync: inspect(sync).get_indexes("link")
+        )
+    assert "ix_link_expires_at" in {index["name"] for index in indexes}
+    await dispose_engine()
+
+
+@pytest.mark.asyncio
+async def test_missing_columns_are_added(pooled_config):
+    engine = get_engine(pooled_config)
+    await create_db_and_tables(engine)
+    async with engine.begin() as connection:
+        await connection.execute(text("DROP INDEX ix_link_user_id_url_hash"))
+        await connection.execute(text("ALTER TABLE link DROP COLUMN url_hash"))
+
+    await create_db_and_tables(engine)
+
+    async with engine.connect() as connection:
+        columns = await connection.run_sync(
+            lambda sync: inspect(sync).get_columns("link")
+        )
+        indexes = await connection.run_sync(
+            lambda sync: inspect(sync).get_indexes("link")
+        )
+    assert "url_hash" in {column["name"] for column in columns}
+    assert "ix_link_user_id_url_hash" in {index["name"] for index in indexes}
+    await dispose_engine()
+
+
+@pytest.mark.asyncio
+async def test_column_added_by_another_worker(pooled_config, monkeypatch):
+    engine = get_engine(pooled_config)
+    await create_db_and_tables(engine)
+    get_columns = Inspector.get_columns
+    inspected = []
+
+    def before_the_other_worker(self, table_name, *args, **kwargs):
+        columns = get_columns(self, table_name, *args, **kwargs)
+        if table_name == "link" and not inspected:
+            inspected.append(table_name)
+            return [column for column in columns if column["name"] != "url_hash"]
+        return columns
+
+    monkeypatch.setattr(Inspector, "get_columns", before_the_other_worker)
+    try:
+        await create_db_and_tables(engine)
+    finally:
+        await dispose_engine()
+    assert inspected == ["link"]
+
+
+@pytest.mark.asyncio
+async def test_redis_is_instrumented(pooled_config):
+    redis = get_redis(pooled_config)
+    try:
+        assert isinstance(redis, InstrumentedRedis)
+        assert isinstance(redis.pipeline(), InstrumentedPipeline)
+    finally:
+        await close_redis()